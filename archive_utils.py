@@ -0,0 +1,491 @@
+import collections
+import os
+import queue
+import shutil
+import struct
+import tempfile
+import threading
+import time
+import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics_utils
+from deploy_constants import MAX_FILE_SIZE_BYTES
+
+# Default number of compression threads: number of CPUs, up to this number
+MAX_DEFAULT_THREADS = 8
+# Max uncompressed bytes of the members held in memory while they are compressed
+MAX_PENDING_BYTES = 256 * 2**20
+# Files larger than this are compressed while they are read (see ParallelZipFile.write_file)
+STREAM_FILE_SIZE = 16 * 2**20
+# Size of the chunks read from the files that are compressed while they are read
+FILE_CHUNK_SIZE = 2**20
+# Max bytes of the frames of a DICOM file kept in memory until the file is committed (see FileStaging)
+FILE_STAGING_MEMORY_BYTES = 64 * 2**20
+
+
+def check_file_size(file_size):
+    """
+    Make sure the file that will be uploaded does not exceed the max file size
+    :param file_size: int. Size of the file in bytes
+    :return: None
+    """
+    if file_size > MAX_FILE_SIZE_BYTES:
+        raise Exception(f"Max file size exceeded, the file cannot be uploaded ({file_size / 2**30} GB)." \
+                        f" Please limit the uploaded file size to {MAX_FILE_SIZE_BYTES / 2**30} GB")
+
+
+def default_threads(threads=None):
+    """
+    :param threads: int. Number of compression threads requested (optional)
+    :return: int. The requested number of threads, or the number of CPUs up to MAX_DEFAULT_THREADS
+    """
+    return threads or min(os.cpu_count() or 1, MAX_DEFAULT_THREADS)
+
+
+def deflate_member(arcname, data, compresslevel):
+    """
+    Compress a zip member. zlib releases the GIL, so members can be compressed concurrently in a thread pool
+    :param arcname: str. Name of the member in the zip file
+    :param data: bytes. Uncompressed content
+    :param compresslevel: int. Deflate compression level (0-9)
+    :return: 4-tuple: arcname, crc32, compressed data, uncompressed size
+    """
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS)
+    compressed = compressor.compress(data) + compressor.flush()
+    return arcname, zlib.crc32(data), compressed, len(data)
+
+
+class ParallelZipFile(object):
+    """
+    Zip file whose members are deflated concurrently in a thread pool and written in the order they were added.
+    The result is a standard zip file (deflate method, no encryption), readable by zipfile or any unzip tool.
+    """
+    _local_header = struct.Struct('<IHHHHHIIIHH')
+    _central_header = struct.Struct('<IHHHHHHIIIHHHHHII')
+    _zip64_end_record = struct.Struct('<IQHHIIQQQQ')
+    _zip64_end_locator = struct.Struct('<IIQI')
+    _end_record = struct.Struct('<IHHHHIIH')
+
+    def __init__(self, fp, compresslevel=9, threads=None, max_pending_bytes=MAX_PENDING_BYTES):
+        """
+        :param fp: file object opened in binary write mode (seekable if write_file is used)
+        :param compresslevel: int. Deflate compression level (0-9)
+        :param threads: int. Number of compression threads (default: number of CPUs, up to MAX_DEFAULT_THREADS)
+        :param max_pending_bytes: int. Max uncompressed bytes of the members held in memory while they are compressed.
+        A larger member is compressed alone
+        """
+        self.fp = fp
+        self.compresslevel = compresslevel
+        threads = default_threads(threads)
+        self._executor = ThreadPoolExecutor(max_workers=threads)
+        # Bound the number of members and the bytes held in memory while they are compressed
+        self._max_pending = 2 * threads
+        self._max_pending_bytes = max_pending_bytes
+        self._pending_bytes = 0
+        # (future, uncompressed size) of the members being compressed, in the order they were added
+        self._pending = collections.deque()
+        self._entries = []
+        date_time = time.localtime(time.time())[0:6]
+        self._dos_time = date_time[3] << 11 | date_time[4] << 5 | (date_time[5] // 2)
+        self._dos_date = (date_time[0] - 1980) << 9 | date_time[1] << 5 | date_time[2]
+
+    @property
+    def size(self):
+        """
+        Number of bytes written so far
+        """
+        return self.fp.tell()
+
+    def write(self, arcname, data):
+        """
+        Add a member to the zip file. Blocks while too many members (or bytes) are being compressed
+        :param arcname: str. Name of the member in the zip file
+        :param data: bytes. Uncompressed content
+        :return: None
+        """
+        metrics_utils.add_bytes('zip', bytes_in=len(data))
+        while self._pending and (len(self._pending) >= self._max_pending or
+                                 self._pending_bytes + len(data) > self._max_pending_bytes):
+            self._write_next()
+        self._pending.append((self._executor.submit(deflate_member, arcname, data, self.compresslevel), len(data)))
+        self._pending_bytes += len(data)
+
+    def write_file(self, arcname, path):
+        """
+        Add a file to the zip file. Files up to STREAM_FILE_SIZE are read and compressed in the thread pool (see
+        write). Larger files are compressed chunk by chunk while they are read, so they are never loaded in memory
+        :param arcname: str. Name of the member in the zip file
+        :param path: str. Path to the file
+        :return: None
+        """
+        if os.path.getsize(path) <= STREAM_FILE_SIZE:
+            with open(path, 'rb') as f:
+                self.write(arcname, f.read())
+            return
+        # Members are written in the order they were added
+        while self._pending:
+            self._write_next()
+        offset = self.fp.tell()
+        name = arcname.encode('utf-8')
+        # The header is written again with the crc and the sizes once the file is compressed
+        self._write_local_header(name, 0, 0, 0)
+        compressor = zlib.compressobj(self.compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS)
+        crc, compressed_size, uncompressed_size = 0, 0, 0
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(FILE_CHUNK_SIZE), b''):
+                metrics_utils.add_bytes('zip', bytes_in=len(chunk))
+                crc = zlib.crc32(chunk, crc)
+                uncompressed_size += len(chunk)
+                compressed = compressor.compress(chunk)
+                compressed_size += len(compressed)
+                self.fp.write(compressed)
+        compressed = compressor.flush()
+        compressed_size += len(compressed)
+        self.fp.write(compressed)
+        end = self.fp.tell()
+        if end >= 0xFFFFFFFF or uncompressed_size >= 0xFFFFFFFF:
+            raise Exception("Zip members larger than 4 GB are not supported")
+        self.fp.seek(offset)
+        self._write_local_header(name, crc, compressed_size, uncompressed_size)
+        self.fp.seek(end)
+        self._entries.append((name, crc, compressed_size, uncompressed_size, offset))
+
+    def _write_next(self):
+        job, uncompressed_size = self._pending.popleft()
+        self._pending_bytes -= uncompressed_size
+        self._write_deflated(*job.result())
+
+    def _write_local_header(self, name, crc, compressed_size, uncompressed_size):
+        # Flag 0x800: the member name is encoded in UTF-8
+        self.fp.write(self._local_header.pack(0x04034b50, 20, 0x800, zipfile.ZIP_DEFLATED, self._dos_time,
+                                              self._dos_date, crc, compressed_size, uncompressed_size,
+                                              len(name), 0))
+        self.fp.write(name)
+
+    def _write_deflated(self, arcname, crc, compressed, uncompressed_size):
+        offset = self.fp.tell()
+        if offset + len(compressed) >= 0xFFFFFFFF or uncompressed_size >= 0xFFFFFFFF:
+            raise Exception("Zip members larger than 4 GB are not supported")
+        name = arcname.encode('utf-8')
+        self._write_local_header(name, crc, len(compressed), uncompressed_size)
+        self.fp.write(compressed)
+        self._entries.append((name, crc, len(compressed), uncompressed_size, offset))
+
+    def close(self):
+        """
+        Write the remaining members and the central directory
+        :return: None
+        """
+        try:
+            while self._pending:
+                self._write_next()
+        finally:
+            self._executor.shutdown(wait=True)
+        central_directory_offset = self.fp.tell()
+        for name, crc, compressed_size, uncompressed_size, offset in self._entries:
+            # Created on Unix (3 << 8), regular file with 0644 permissions
+            self.fp.write(self._central_header.pack(0x02014b50, 3 << 8 | 20, 20, 0x800, zipfile.ZIP_DEFLATED,
+                                                    self._dos_time, self._dos_date, crc, compressed_size,
+                                                    uncompressed_size, len(name), 0, 0, 0, 0, 0o100644 << 16,
+                                                    offset))
+            self.fp.write(name)
+        central_directory_size = self.fp.tell() - central_directory_offset
+        num_entries = len(self._entries)
+        if num_entries >= 0xFFFF:
+            # Too many members for the classic end of central directory record
+            zip64_end_offset = self.fp.tell()
+            self.fp.write(self._zip64_end_record.pack(0x06064b50, self._zip64_end_record.size - 12, 45, 45, 0, 0,
+                                                      num_entries, num_entries, central_directory_size,
+                                                      central_directory_offset))
+            self.fp.write(self._zip64_end_locator.pack(0x07064b50, 0, zip64_end_offset, 1))
+            num_entries = 0xFFFF
+        self.fp.write(self._end_record.pack(0x06054b50, 0, 0, num_entries, num_entries, central_directory_size,
+                                            central_directory_offset, 0))
+        metrics_utils.add_bytes('zip', bytes_out=self.fp.tell())
+
+
+class DirectoryWriter(object):
+    """
+    Writes the preprocessed files into a folder, using the archive name as relative path
+    """
+    # The writer only holds a path, so it can be sent to worker processes
+    process_safe = True
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def write(self, arcname, data):
+        path = os.path.join(self.directory, arcname)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+
+
+class TeeWriter(object):
+    """
+    Writes the preprocessed files into several writers
+    """
+    def __init__(self, writers):
+        self.writers = writers
+        self.process_safe = all(getattr(writer, 'process_safe', False) for writer in writers)
+
+    def write(self, arcname, data):
+        for writer in self.writers:
+            writer.write(arcname, data)
+
+
+class StudyStaging(object):
+    """
+    Keeps the preprocessed files of each study apart until it is known whether the study is sent (see
+    cache_utils.ResultsCache). Studies are written to staging_writer, and then committed to the writer or discarded.
+    Studies written to a DirectoryWriter are written in place and removed if they are discarded. For other writers,
+    they are written to a temporary folder first
+    """
+
+    def __init__(self, writer):
+        """
+        :param writer: Writer the preprocessed files of the committed studies are written to
+        """
+        self.writer = writer
+        if isinstance(writer, DirectoryWriter):
+            self.directory = None
+            self.staging_writer = writer
+        else:
+            self.directory = tempfile.mkdtemp(prefix='staging_')
+            self.staging_writer = DirectoryWriter(self.directory)
+
+    def commit(self, study_path_hash):
+        if self.directory is None:
+            return
+        study_dir = os.path.join(self.directory, study_path_hash)
+        for root, _, fns in os.walk(study_dir):
+            for fn in sorted(fns):
+                with open(os.path.join(root, fn), 'rb') as f:
+                    self.writer.write(os.path.relpath(os.path.join(root, fn), self.directory), f.read())
+        shutil.rmtree(study_dir)
+
+    def discard(self, study_path_hash):
+        shutil.rmtree(os.path.join(self.staging_writer.directory, study_path_hash), ignore_errors=True)
+
+    def close(self):
+        if self.directory is not None:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class FileStaging(object):
+    """
+    Keeps the preprocessed files of one DICOM file apart until all its frames are preprocessed, so that a file that
+    fails halfway does not leave some of its frames in the writer. Files written to a DirectoryWriter or a MemberBuffer
+    are written in place and removed if they are discarded. For other writers (e.g. the zip file being uploaded), they
+    are kept in memory up to FILE_STAGING_MEMORY_BYTES and in a temporary folder beyond that
+    """
+
+    def __init__(self, writer):
+        """
+        :param writer: Writer the preprocessed files are written to when the file is committed
+        """
+        self.writer = writer
+        self.in_place = isinstance(writer, (DirectoryWriter, MemberBuffer))
+        self.arcnames = []
+        # Members kept in memory, until they exceed FILE_STAGING_MEMORY_BYTES and are moved to the temporary folder
+        self._members = []
+        self._size = 0
+        self._directory = None
+        self._start = len(writer) if isinstance(writer, MemberBuffer) else None
+
+    def write(self, arcname, data):
+        if self.in_place:
+            self.writer.write(arcname, data)
+        elif self._directory is None and self._size + len(data) <= FILE_STAGING_MEMORY_BYTES:
+            self._members.append(data)
+        else:
+            if self._directory is None:
+                self._directory = tempfile.mkdtemp(prefix='staging_')
+                for i, member in enumerate(self._members):
+                    self._write_staged(i, member)
+                self._members = []
+            self._write_staged(len(self.arcnames), data)
+        self.arcnames.append(arcname)
+        self._size += len(data)
+
+    def _write_staged(self, i, data):
+        with open(os.path.join(self._directory, str(i)), 'wb') as f:
+            f.write(data)
+
+    def commit(self):
+        """
+        Write the staged files to the writer
+        :return: None
+        """
+        if self.in_place:
+            return
+        try:
+            for i, arcname in enumerate(self.arcnames):
+                if self._directory is None:
+                    data = self._members[i]
+                else:
+                    with open(os.path.join(self._directory, str(i)), 'rb') as f:
+                        data = f.read()
+                self.writer.write(arcname, data)
+        finally:
+            self.discard()
+
+    def discard(self):
+        """
+        Remove the staged files
+        :return: None
+        """
+        if isinstance(self.writer, MemberBuffer):
+            del self.writer[self._start:]
+        elif isinstance(self.writer, DirectoryWriter):
+            for arcname in self.arcnames:
+                try:
+                    os.remove(os.path.join(self.writer.directory, arcname))
+                except FileNotFoundError:
+                    pass
+        self._members = []
+        if self._directory is not None:
+            shutil.rmtree(self._directory, ignore_errors=True)
+            self._directory = None
+
+
+class MemberBuffer(list):
+    """
+    Keeps the preprocessed files in memory as (arcname, data) tuples, so that they can be sent back from a worker
+    process and replayed into a writer that lives in the main process
+    """
+    def write(self, arcname, data):
+        self.append((arcname, data))
+
+
+class ArchiveWriter(object):
+    """
+    Writes the preprocessed files straight into the zip file that will be uploaded.
+    Producers call write() and a background thread hands the members to a ParallelZipFile. The queue between them
+    is bounded, so producers block when compression falls behind and memory usage is capped.
+    The zip file can be read with iter_chunks() while it is being written, so that it can be uploaded at the same time.
+    """
+    process_safe = False
+
+    def __init__(self, path, compresslevel=9, threads=None, max_queued_members=32):
+        """
+        :param path: str. Path to the zip file
+        :param compresslevel: int. Deflate compression level (0-9)
+        :param threads: int. Number of compression threads (default: number of CPUs, up to MAX_DEFAULT_THREADS)
+        :param max_queued_members: int. Max number of members waiting to be compressed
+        """
+        self.path = path
+        self.compresslevel = compresslevel
+        self.threads = threads
+        # Bytes written (and flushed) so far and number of members added to the zip file
+        self.size = 0
+        self.num_members = 0
+        self._done = False
+        self._error = None
+        self._condition = threading.Condition()
+        self._queue = queue.Queue(maxsize=max_queued_members)
+        self._thread = threading.Thread(target=self._consume, daemon=True)
+        self._thread.start()
+
+    def write(self, arcname, data):
+        self._queue.put((arcname, data))
+
+    def _consume(self):
+        closed = False
+        try:
+            with open(self.path, 'wb') as fp:
+                zip_fp = ParallelZipFile(fp, compresslevel=self.compresslevel, threads=self.threads)
+                try:
+                    while self._error is None:
+                        member = self._queue.get()
+                        if member is None:
+                            closed = True
+                            break
+                        zip_fp.write(*member)
+                        # Make the members written so far visible to iter_chunks
+                        fp.flush()
+                        with self._condition:
+                            self.size = zip_fp.size
+                            self.num_members += 1
+                            self._condition.notify_all()
+                        check_file_size(self.size)
+                finally:
+                    zip_fp.close()
+            check_file_size(os.stat(self.path).st_size)
+        except Exception as ex:
+            self._error = ex
+        with self._condition:
+            if self._error is None:
+                self.size = os.stat(self.path).st_size
+            self._done = True
+            self._condition.notify_all()
+        # Keep draining the queue so producers are not blocked
+        while not closed and self._queue.get() is not None:
+            pass
+
+    @property
+    def final_size(self):
+        """
+        Size of the zip file in bytes, or None while it is being written
+        """
+        return self.size if self._done and self._error is None else None
+
+    def wait_for_members(self):
+        """
+        Block until the first member is added to the zip file or the zip file is closed
+        :return: bool. True if the zip file has members, False if it was closed (or aborted) without members
+        """
+        with self._condition:
+            while self.num_members == 0 and not self._done:
+                self._condition.wait()
+            return self.num_members > 0 and self._error is None
+
+    def iter_chunks(self, chunk_size=2**20):
+        """
+        Read the zip file from the beginning while it is being written. Blocks until more data is written and
+        ends when the zip file is closed. Raises an exception if the zip file could not be written or was aborted.
+        :param chunk_size: int. Max size of the chunks in bytes
+        :return: generator of bytes
+        """
+        with open(self.path, 'rb') as f:
+            position = 0
+            while True:
+                with self._condition:
+                    while position >= self.size and not self._done and self._error is None:
+                        self._condition.wait()
+                    if self._error is not None:
+                        raise Exception(f"The zip file could not be written ({self._error})")
+                    available = self.size - position
+                    done = self._done
+                if available <= 0 and done:
+                    return
+                chunk = f.read(min(chunk_size, available))
+                position += len(chunk)
+                yield chunk
+
+    def close(self):
+        """
+        Wait until all the members are written and close the zip file
+        :return: str. Path to the zip file
+        """
+        self._queue.put(None)
+        self._thread.join()
+        if self._error is not None:
+            os.remove(self.path)
+            raise self._error
+        return self.path
+
+    def abort(self):
+        """
+        Stop writing and remove the zip file
+        :return: None
+        """
+        with self._condition:
+            self._error = self._error or Exception("Archive aborted")
+            self._condition.notify_all()
+        self._queue.put(None)
+        self._thread.join()
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -0,0 +1,85 @@
+"""
+Compression level vs. wall time vs. size of the zip file sent to the server, using frames preprocessed from real
+DICOM files. Example of use:
+python benchmarks/bench_compression.py --input /my/local/dicom_data --levels 1 3 6 9 --threads 8
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import zipfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import archive_utils
+import utils
+
+
+def load_members(input_, max_files):
+    """
+    Preprocess the DICOM files in the input folder and keep the zip members in memory
+    :param input_: str. Study folder or folder of study folders
+    :param max_files: int. Max number of DICOM files read
+    :return: list of (arcname, data) tuples
+    """
+    members = archive_utils.MemberBuffer()
+    num_files = 0
+    for root, dirs, files in os.walk(input_):
+        if len(dirs) == 0 and len(files) > 0:
+            num_files += len(utils.read_study(root, members))
+            if num_files >= max_files:
+                break
+    return members
+
+
+def time_zip(members, compresslevel, threads):
+    """
+    Write the members into a temporary zip file
+    :param members: list of (arcname, data) tuples
+    :param compresslevel: int. Deflate compression level
+    :param threads: int. Number of compression threads. 0 uses zipfile in a single thread (previous implementation)
+    :return: 2-tuple: wall time in seconds, zip file size in bytes
+    """
+    with tempfile.NamedTemporaryFile(suffix='.zip') as fp:
+        start = time.perf_counter()
+        if threads == 0:
+            with zipfile.ZipFile(fp, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=compresslevel) as zip_fp:
+                for arcname, data in members:
+                    zip_fp.writestr(arcname, data)
+        else:
+            zip_fp = archive_utils.ParallelZipFile(fp, compresslevel=compresslevel, threads=threads)
+            for arcname, data in members:
+                zip_fp.write(arcname, data)
+            zip_fp.close()
+        fp.flush()
+        return time.perf_counter() - start, os.stat(fp.name).st_size
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of the compression of the zip file sent to the server')
+    parser.add_argument('--input', type=str, required=True, help='Study directory or directory of study directories')
+    parser.add_argument('--levels', type=int, nargs='+', default=[1, 3, 6, 9], help='Compression levels to compare')
+    parser.add_argument('--threads', type=int, default=os.cpu_count(), help='Number of compression threads')
+    parser.add_argument('--max_files', type=int, default=50, help='Max number of DICOM files read')
+    parser.add_argument('--output_json', type=str, help='Save the results to a json file (optional)')
+    args = parser.parse_args()
+
+    members = load_members(os.path.realpath(args.input), args.max_files)
+    raw_size = sum(len(data) for _, data in members)
+    print(f"{len(members)} members, {raw_size / 2**20:.1f} MB uncompressed")
+
+    results = []
+    runs = [(level, args.threads) for level in args.levels] + [(9, 0)]
+    for level, threads in runs:
+        wall_time, size = time_zip(members, level, threads)
+        results.append({'level': level, 'threads': threads, 'wall_time_s': wall_time, 'size_bytes': size,
+                        'ratio': size / raw_size if raw_size else None,
+                        'throughput_mb_s': raw_size / 2**20 / wall_time if wall_time else None})
+        engine = f"{threads} threads" if threads else "zipfile (1 thread)"
+        print(f"level {level} {engine:>20}: {wall_time:8.2f} s {size / 2**20:10.1f} MB "
+              f"(ratio {size / raw_size:.3f})")
+
+    if args.output_json:
+        with open(args.output_json, 'w') as f:
+            json.dump({'members': len(members), 'uncompressed_bytes': raw_size, 'results': results}, f, indent=2)
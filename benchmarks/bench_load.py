@@ -0,0 +1,133 @@
+"""
+End-to-end load test of the client pipeline against a local mock server (see mock_server.py): many runs of
+deploy_evaluation.py are started concurrently, each one in its own process and output folder, and the throughput and
+latency of the full runs (pre-processing, upload, polling, download and unhashing) are measured. The stage timings of
+each run are collected with --metrics. The real server is never used. Example of use:
+python benchmarks/bench_load.py --clients 16 --concurrency 4 --delay 5 --output_json bench_load.json
+"""
+import argparse
+import json
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import mock_server
+import synthetic_dicom
+
+
+def run_client(index, input_, server_url, work_dir, client_args):
+    """
+    Run deploy_evaluation.py once, answering yes to the Terms of Service
+    :param index: int. Number of the run
+    :param input_: str. Input folder
+    :param server_url: str. Url of the mock server
+    :param work_dir: str. Folder where the output folder of the run is created
+    :param client_args: list of str. Additional arguments of deploy_evaluation.py
+    :return: dict. Latency, exit code and stage metrics of the run
+    """
+    output_dir = os.path.join(work_dir, f'client_{index:04d}')
+    os.makedirs(output_dir)
+    metrics_path = os.path.join(output_dir, 'metrics.json')
+    command = [sys.executable, os.path.join(REPO_DIR, 'deploy_evaluation.py'), '--input', input_,
+               '--output', output_dir, '--access_key', 'benchmark', '--server', server_url, '--plot_images', 'n',
+               '--metrics', metrics_path] + client_args
+    start = time.perf_counter()
+    process = subprocess.run(command, input=b'y\n' * 10, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    result = {'client': index, 'latency_s': time.perf_counter() - start, 'returncode': process.returncode}
+    if process.returncode != 0 or not os.path.isfile(metrics_path):
+        result['output'] = process.stdout.decode('utf-8', errors='replace')[-2000:]
+    else:
+        with open(metrics_path) as f:
+            result['stages'] = {name: stage['wall_s'] for name, stage in json.load(f)['stages'].items()}
+    return result
+
+
+def percentiles(values):
+    values = np.array(values)
+    return {'p50_s': float(np.percentile(values, 50)), 'p90_s': float(np.percentile(values, 90)),
+            'p99_s': float(np.percentile(values, 99)), 'max_s': float(values.max()), 'mean_s': float(values.mean())}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load test of deploy_evaluation.py against a local mock server')
+    parser.add_argument('--clients', type=int, default=8, help='Total number of client runs (default: 8)')
+    parser.add_argument('--concurrency', type=int, default=4, help='Number of runs at the same time (default: 4)')
+    parser.add_argument('--delay', type=float, default=0,
+                        help='Seconds the mock server takes to generate the results of a session (default: 0)')
+    parser.add_argument('--server', type=str,
+                        help='Url of an already running mock_server.py (default: one is started in this process)')
+    parser.add_argument('--client_args', type=str, default='',
+                        help='Additional arguments of deploy_evaluation.py, e.g. "--stream --workers 2"')
+    parser.add_argument('--input', type=str,
+                        help='Directory of study directories to send instead of synthetic files (optional)')
+    synthetic_dicom.add_dataset_arguments(parser)
+    parser.add_argument('--output_json', type=str, help='Save the results to a json file (optional)')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='bench_load_')
+    server = None
+    try:
+        if args.input is not None:
+            input_ = os.path.realpath(args.input)
+        else:
+            input_ = os.path.join(work_dir, 'dicom')
+            print("Generating synthetic DICOM files...")
+            dataset = synthetic_dicom.generate_dataset(input_, **synthetic_dicom.dataset_options(args))
+            print(f"{dataset['studies']} studies, {dataset['files']} files, {dataset['bytes'] / 2**20:.1f} MB")
+        server_url = args.server
+        if server_url is None:
+            server = mock_server.start_server(delay=args.delay, storage_dir=os.path.join(work_dir, 'server'))
+            os.makedirs(server.storage_dir, exist_ok=True)
+            server_url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+        print(f"Running {args.clients} clients against {server_url}, {args.concurrency} at a time...")
+
+        client_args = shlex.split(args.client_args)
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            runs = list(executor.map(lambda i: run_client(i, input_, server_url, work_dir, client_args),
+                                     range(args.clients)))
+        total_s = time.perf_counter() - start
+    finally:
+        if server is not None:
+            server.shutdown()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    succeeded = [run for run in runs if run['returncode'] == 0 and 'stages' in run]
+    for run in runs:
+        if run not in succeeded:
+            print(f"Client {run['client']} failed (exit code {run['returncode']}):\n{run.get('output', '')}")
+    results = {'clients': args.clients, 'concurrency': args.concurrency, 'delay_s': args.delay,
+               'client_args': client_args, 'total_s': total_s, 'succeeded': len(succeeded),
+               'failed': len(runs) - len(succeeded), 'runs_per_min': 60 * len(succeeded) / total_s,
+               'runs': runs}
+    if server is not None:
+        results['server'] = server.stats
+    if len(succeeded) > 0:
+        results['latency'] = percentiles([run['latency_s'] for run in succeeded])
+        stage_names = sorted(set(name for run in succeeded for name in run['stages']))
+        results['stages'] = {name: percentiles([run['stages'][name] for run in succeeded if name in run['stages']])
+                             for name in stage_names}
+        print(f"{len(succeeded)}/{len(runs)} runs in {total_s:.1f} s ({results['runs_per_min']:.1f} runs/min). "
+              f"Latency p50 {results['latency']['p50_s']:.1f} s, p90 {results['latency']['p90_s']:.1f} s, "
+              f"max {results['latency']['max_s']:.1f} s")
+        for name, stage in results['stages'].items():
+            print(f"{name:>12}: p50 {stage['p50_s']:8.2f} s, p90 {stage['p90_s']:8.2f} s, max {stage['max_s']:8.2f} s")
+    if server is not None:
+        print(f"Server: {server.stats['uploads']} uploads ({server.stats['uploaded_bytes'] / 2**20:.1f} MB), "
+              f"{server.stats['rejected_uploads']} rejected")
+
+    if args.output_json:
+        with open(args.output_json, 'w') as f:
+            json.dump(results, f, indent=2)
+    if len(succeeded) < len(runs):
+        sys.exit(1)
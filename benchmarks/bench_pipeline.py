@@ -0,0 +1,269 @@
+"""
+End-to-end benchmark of the client pipeline on synthetic (or real) DICOM files: preprocessing (read_dicom), zip
+file (zip_files), unhashing of the results (unhash_results) and plotting (plot_and_save_ims). The server is not
+used: the results are generated locally from the manifest of the preprocessed files.
+Each stage runs in a new process, so that its peak RSS is measured on its own. The wall time, CPU time, throughput,
+peak RSS and bytes produced by each stage are printed and saved to a json file, which can be compared with the
+results of another commit with --compare. Example of use:
+python benchmarks/bench_pipeline.py --output_json bench_new.json --compare bench_old.json --studies 8 --workers 4
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import synthetic_dicom
+
+# Name of the fake session whose results are unhashed and plotted
+SESSION_ID = 'benchmark'
+
+
+def folder_size(path):
+    """
+    :return: int. Total size of the files in a folder (or size of a file) in bytes
+    """
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, fn)) for root, _, fns in os.walk(path) for fn in fns)
+
+
+def peak_rss_bytes():
+    """
+    :return: int. Peak RSS of this process and of its finished child processes (e.g. preprocessing workers) in bytes
+    """
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    unit = 1 if sys.platform == 'darwin' else 1024
+    return unit * max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                      resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+
+def cpu_seconds():
+    """
+    :return: float. User and system CPU time of this process and of its finished child processes in seconds
+    """
+    return sum(r.ru_utime + r.ru_stime for r in (resource.getrusage(resource.RUSAGE_SELF),
+                                                 resource.getrusage(resource.RUSAGE_CHILDREN)))
+
+
+def stage_preprocess(input_, work_dir, workers, windowing):
+    import deploy_evaluation
+    import archive_utils
+    import manifest_utils
+    preprocess_dir = os.path.join(work_dir, 'preprocessed')
+    shutil.rmtree(preprocess_dir, ignore_errors=True)
+    manifest = dict()
+    num_images = deploy_evaluation.preprocess_input(input_, archive_utils.DirectoryWriter(preprocess_dir),
+                                                    workers=workers, windowing=windowing, manifest=manifest)
+    manifest_utils.save_manifest(manifest, os.path.join(work_dir, 'manifest.csv'))
+    dicom_paths = [path for path in manifest.values() if os.path.isfile(path)]
+    return {'items': num_images, 'bytes_in': sum(os.path.getsize(path) for path in dicom_paths),
+            'bytes_out': folder_size(preprocess_dir)}
+
+
+def stage_zip(input_, work_dir, workers, windowing, compresslevel, threads):
+    import deploy_evaluation
+    preprocess_dir = os.path.join(work_dir, 'preprocessed')
+    zip_file_path = deploy_evaluation.zip_files(preprocess_dir, compresslevel=compresslevel, threads=threads)
+    shutil.move(zip_file_path, os.path.join(work_dir, 'upload.zip'))
+    with zipfile.ZipFile(os.path.join(work_dir, 'upload.zip')) as zip_fp:
+        num_members = len(zip_fp.namelist())
+    return {'items': num_members, 'bytes_in': folder_size(preprocess_dir),
+            'bytes_out': os.path.getsize(os.path.join(work_dir, 'upload.zip'))}
+
+
+def make_results(work_dir):
+    """
+    Results zip file like the one returned by the server, with a score for each study and a box for each file of the
+    manifest
+    :return: str. Path to the results zip file
+    """
+    import pandas as pd
+    import manifest_utils
+    manifest = manifest_utils.load_manifest(os.path.join(work_dir, 'manifest.csv'))
+    dicom_rows, study_hashes = [], set()
+    for i, (path_hash, path) in enumerate(manifest.items()):
+        if not os.path.isfile(path):
+            continue
+        study_hash = manifest_utils.create_hash(os.path.dirname(path))
+        study_hashes.add(study_hash)
+        dicom_rows.append({'StudyInstanceUID': study_hash, 'SOPInstanceUID': path_hash, 'x1': 100.0, 'y1': 100.0,
+                           'x2': 600.0, 'y2': 500.0, 'slice': -1, 'score': (i % 100) / 100})
+    study_df = pd.DataFrame({'StudyInstanceUID': sorted(study_hashes), 'score': 0.5})
+    results_zip_file = os.path.join(work_dir, SESSION_ID + '.zip')
+    with zipfile.ZipFile(results_zip_file, 'w') as zip_fp:
+        zip_fp.writestr(SESSION_ID + '_study.csv', study_df.to_csv(index=False))
+        zip_fp.writestr(SESSION_ID + '_dicom.csv', pd.DataFrame(dicom_rows).to_csv(index=False))
+    return results_zip_file
+
+
+def stage_unhash(input_, work_dir, workers, windowing):
+    import deploy_evaluation
+    output_dir = os.path.join(work_dir, 'output')
+    shutil.rmtree(output_dir, ignore_errors=True)
+    results_zip_file = make_results(work_dir)
+    os.makedirs(os.path.join(output_dir, SESSION_ID))
+    shutil.copy(os.path.join(work_dir, 'manifest.csv'), deploy_evaluation.manifest_path(output_dir, SESSION_ID))
+    study_df, dicom_df = deploy_evaluation.unhash_results(results_zip_file, input_, output_dir)
+    return {'items': len(study_df) + len(dicom_df), 'bytes_in': os.path.getsize(results_zip_file),
+            'bytes_out': folder_size(os.path.join(output_dir, SESSION_ID, 'csv'))}
+
+
+def stage_plot(input_, work_dir, workers, windowing, preprocessed=False, image_format='png'):
+    import pandas as pd
+    import plotting_utils
+    output_dir = os.path.join(work_dir, 'plots')
+    shutil.rmtree(output_dir, ignore_errors=True)
+    dicom_df = pd.read_csv(os.path.join(work_dir, 'output', SESSION_ID, 'csv', SESSION_ID + '_dicom.csv'))
+    frames = None
+    if preprocessed:
+        frames = plotting_utils.PreprocessedFrames([os.path.join(work_dir, 'preprocessed')])
+    plotting_utils.plot_and_save_ims(dicom_df, output_dir, workers=workers, frames=frames, image_format=image_format)
+    num_images = sum(len(fns) for _, _, fns in os.walk(output_dir))
+    return {'items': num_images, 'bytes_in': folder_size(input_), 'bytes_out': folder_size(output_dir)}
+
+
+def run_stage(function, *args):
+    """
+    Run a stage and measure it. Called in a new process
+    :return: dict. Measures of the stage
+    """
+    cpu_start = cpu_seconds()
+    start = time.perf_counter()
+    result = function(*args)
+    result['wall_s'] = time.perf_counter() - start
+    result['cpu_s'] = cpu_seconds() - cpu_start
+    result['peak_rss_bytes'] = peak_rss_bytes()
+    return result
+
+
+def measure(name, function, args, repeat):
+    """
+    Run a stage several times, each one in a new process
+    :return: dict. Measures of the fastest run, with the wall times of all of them
+    """
+    runs = []
+    for _ in range(repeat):
+        # 'spawn' so that the peak RSS of the new process does not include the memory of this one
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+            runs.append(executor.submit(run_stage, function, *args).result())
+    result = min(runs, key=lambda run: run['wall_s'])
+    result['stage'] = name
+    result['wall_s_runs'] = [run['wall_s'] for run in runs]
+    result['peak_rss_bytes'] = max(run['peak_rss_bytes'] for run in runs)
+    result['throughput_mb_s'] = result['bytes_in'] / 2**20 / result['wall_s'] if result['wall_s'] else None
+    result['items_per_s'] = result['items'] / result['wall_s'] if result['wall_s'] else None
+    return result
+
+
+def environment():
+    """
+    :return: dict. Commit, Python and library versions, so that results of different runs can be compared
+    """
+    import numpy as np
+    import pandas as pd
+    import pydicom
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                         cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'commit': commit, 'python': platform.python_version(), 'platform': platform.platform(),
+            'cpus': os.cpu_count(), 'numpy': np.__version__, 'pandas': pd.__version__, 'pydicom': pydicom.__version__}
+
+
+def print_comparison(results, baseline):
+    """
+    Print the change of each stage against the results of a previous run
+    :param results: dict. Results of this run
+    :param baseline: dict. Results of the previous run (json file saved by this script)
+    :return: None
+    """
+    baseline_stages = {stage['stage']: stage for stage in baseline['stages']}
+    print(f"\nComparison with commit {baseline['environment'].get('commit')}:")
+    for stage in results['stages']:
+        old = baseline_stages.get(stage['stage'])
+        if old is None:
+            continue
+        print(f"{stage['stage']:>18}: wall {old['wall_s']:8.2f} s -> {stage['wall_s']:8.2f} s "
+              f"({old['wall_s'] / stage['wall_s']:.2f}x), peak RSS {old['peak_rss_bytes'] / 2**20:8.0f} MB -> "
+              f"{stage['peak_rss_bytes'] / 2**20:8.0f} MB, bytes out {old['bytes_out'] / 2**20:8.1f} MB -> "
+              f"{stage['bytes_out'] / 2**20:8.1f} MB")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of the preprocessing, zip, unhash and plotting stages')
+    parser.add_argument('--input', type=str,
+                        help='Directory of study directories to use instead of generating synthetic files (optional)')
+    parser.add_argument('--data_dir', type=str,
+                        help='Directory where the synthetic files are generated and kept. If it already contains '
+                             'files, they are used as they are (default: temporary directory)')
+    synthetic_dicom.add_dataset_arguments(parser)
+    parser.add_argument('--workers', type=int, default=1, help='Number of processes of the preprocessing and plotting')
+    parser.add_argument('--windowing', type=str, default='pydicom', choices=('pydicom', 'lut'),
+                        help='Windowing engine of the preprocessing (default: pydicom)')
+    parser.add_argument('--compression_level', type=int, default=9, help='Compression level of the zip file')
+    parser.add_argument('--compression_threads', type=int, help='Number of compression threads (default: CPUs)')
+    parser.add_argument('--image_format', type=str, default='png', help='Format of the plotted images (default: png)')
+    parser.add_argument('--repeat', type=int, default=1, help='Number of runs of each stage (the fastest is kept)')
+    parser.add_argument('--stages', type=str, nargs='+',
+                        default=['preprocess', 'zip', 'unhash', 'plot', 'plot_preprocessed'],
+                        help='Stages to run, in order. Each stage needs the output of the previous ones')
+    parser.add_argument('--output_json', type=str, help='Save the results to a json file (optional)')
+    parser.add_argument('--compare', type=str, help='Json file of a previous run to compare with (optional)')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='bench_pipeline_')
+    try:
+        if args.input is not None:
+            input_ = os.path.realpath(args.input)
+            dataset = {'input': input_, 'bytes': folder_size(input_)}
+        else:
+            input_ = os.path.realpath(args.data_dir or os.path.join(work_dir, 'dicom'))
+            if os.path.isdir(input_) and len(os.listdir(input_)) > 0:
+                print(f"Using the files in {input_}")
+                dataset = {'input': input_, 'bytes': folder_size(input_)}
+            else:
+                print("Generating synthetic DICOM files...")
+                start = time.perf_counter()
+                dataset = synthetic_dicom.generate_dataset(input_, **synthetic_dicom.dataset_options(args))
+                print(f"{dataset['files']} files, {dataset['frames']} frames, {dataset['bytes'] / 2**20:.1f} MB "
+                      f"generated in {time.perf_counter() - start:.1f} s")
+
+        stages = {
+            'preprocess': (stage_preprocess, (input_, work_dir, args.workers, args.windowing)),
+            'zip': (stage_zip, (input_, work_dir, args.workers, args.windowing, args.compression_level,
+                                args.compression_threads)),
+            'unhash': (stage_unhash, (input_, work_dir, args.workers, args.windowing)),
+            'plot': (stage_plot, (input_, work_dir, args.workers, args.windowing, False, args.image_format)),
+            'plot_preprocessed': (stage_plot, (input_, work_dir, args.workers, args.windowing, True,
+                                               args.image_format)),
+        }
+        results = {'environment': environment(), 'config': vars(args), 'dataset': dataset, 'stages': []}
+        for name in args.stages:
+            function, stage_args = stages[name]
+            result = measure(name, function, stage_args, args.repeat)
+            results['stages'].append(result)
+            print(f"{name:>18}: {result['wall_s']:8.2f} s wall, {result['cpu_s']:8.2f} s CPU, "
+                  f"{result['items']:6d} items ({result['items_per_s']:.1f}/s), "
+                  f"{result['throughput_mb_s']:8.1f} MB/s in, {result['bytes_out'] / 2**20:8.1f} MB out, "
+                  f"peak RSS {result['peak_rss_bytes'] / 2**20:.0f} MB")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.output_json:
+        with open(args.output_json, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            print_comparison(results, json.load(f))
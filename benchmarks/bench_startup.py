@@ -0,0 +1,140 @@
+"""
+Startup benchmark of deploy_evaluation.py: the interpreter startup and import time (python -X importtime) and the wall
+time of the runs that do not pre-process files, i.e. --help and retrieving the results of a previous session with
+--results_url and --plot_images n. The DICOM, image and array libraries (pydicom, cv2, PIL, numpy, pandas) must not be
+imported by these runs, except pandas (and numpy) to read the results, and the benchmark fails if they are. A session is sent once to a local mock server (see mock_server.py) so that
+its results can be retrieved. Example of use:
+python benchmarks/bench_startup.py --repeats 10 --output_json bench_startup.json
+"""
+import argparse
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import mock_server
+import synthetic_dicom
+
+# Modules that are only needed to pre-process files, to generate images or to read the results
+HEAVY_MODULES = ('pydicom', 'cv2', 'PIL', 'numpy', 'pandas')
+# Heavy modules that each scenario needs: the results are read with pandas
+ALLOWED_MODULES = {'help': (), 'results_url': ('numpy', 'pandas')}
+# Line of the output of -X importtime: self time (us), cumulative time (us), module name indented by nesting level
+IMPORTTIME_LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$')
+
+
+def parse_importtime(stderr):
+    """
+    :param stderr: str. Standard error of a python -X importtime run
+    :return: dict. Total import time, cumulative time of each top level import and imported modules
+    """
+    modules = []
+    top_level = dict()
+    for line in stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if match is None:
+            continue
+        cumulative_us, indent, name = int(match.group(2)), len(match.group(3)), match.group(4)
+        modules.append(name)
+        if indent == 1:
+            top_level[name] = top_level.get(name, 0) + cumulative_us / 1e6
+    return {'import_s': sum(top_level.values()), 'top_level_s': top_level, 'modules': modules}
+
+
+def run_timed(command):
+    """
+    Run a command with -X importtime
+    :param command: list of str. Arguments of the python interpreter
+    :return: dict. Wall time, import times and heavy modules imported by the run
+    """
+    start = time.perf_counter()
+    process = subprocess.run([sys.executable, '-X', 'importtime'] + command, input=b'y\n' * 10,
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    wall_s = time.perf_counter() - start
+    if process.returncode != 0:
+        raise Exception(f"{' '.join(command)} failed:\n{process.stdout.decode()[-2000:]}"
+                        f"{process.stderr.decode()[-2000:]}")
+    result = parse_importtime(process.stderr.decode())
+    result['wall_s'] = wall_s
+    result['heavy_modules'] = sorted(set(name.split('.')[0] for name in result.pop('modules')
+                                         if name.split('.')[0] in HEAVY_MODULES))
+    return result
+
+
+def send_session(input_, output_dir, server_url):
+    """
+    Send the input to the server once
+    :return: str. Results url of the session
+    """
+    process = subprocess.run([sys.executable, os.path.join(REPO_DIR, 'deploy_evaluation.py'), '--input', input_,
+                              '--output', output_dir, '--access_key', 'benchmark', '--server', server_url,
+                              '--plot_images', 'n'], input=b'y\n' * 10, stdout=subprocess.PIPE,
+                             stderr=subprocess.STDOUT)
+    urls = re.findall(r'^(http\S+/results/\S+\.zip)$', process.stdout.decode(), flags=re.MULTILINE)
+    if process.returncode != 0 or len(urls) == 0:
+        raise Exception(f"The input could not be sent:\n{process.stdout.decode()[-2000:]}")
+    return urls[0]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Startup and import time of deploy_evaluation.py')
+    parser.add_argument('--repeats', type=int, default=5, help='Runs of each scenario (default: 5)')
+    parser.add_argument('--output_json', type=str, help='Save the results to a json file (optional)')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='bench_startup_')
+    server = mock_server.start_server(storage_dir=os.path.join(work_dir, 'server'))
+    os.makedirs(server.storage_dir, exist_ok=True)
+    server_url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+    try:
+        input_ = os.path.join(work_dir, 'dicom')
+        synthetic_dicom.generate_dataset(input_, num_studies=1, ffdm_shape=(256, 256), dbt_frames=0)
+        results_url = send_session(input_, os.path.join(work_dir, 'sent'), server_url)
+
+        script = os.path.join(REPO_DIR, 'deploy_evaluation.py')
+        # A new output folder for each run, so that the hash map is built from the input (no local manifest)
+        for i in range(args.repeats):
+            os.makedirs(os.path.join(work_dir, f'results_{i}'))
+        scenarios = {
+            'help': lambda i: [script, '--help'],
+            'results_url': lambda i: [script, '--input', input_, '--output', os.path.join(work_dir, f'results_{i}'),
+                                      '--access_key', 'benchmark', '--server', server_url,
+                                      '--results_url', results_url, '--plot_images', 'n'],
+        }
+        results = {'python': sys.version.split()[0], 'repeats': args.repeats, 'scenarios': dict()}
+        for name, command in scenarios.items():
+            runs = [run_timed(command(i)) for i in range(args.repeats)]
+            top_level = runs[-1]['top_level_s']
+            results['scenarios'][name] = {
+                'wall_s': float(np.median([run['wall_s'] for run in runs])),
+                'import_s': float(np.median([run['import_s'] for run in runs])),
+                'slowest_imports_s': dict(sorted(top_level.items(), key=lambda item: -item[1])[:5]),
+                'heavy_modules': sorted(set(module for run in runs for module in run['heavy_modules']
+                                            if module not in ALLOWED_MODULES[name]))}
+    finally:
+        server.shutdown()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    failed = False
+    for name, scenario in results['scenarios'].items():
+        print(f"{name:>12}: wall {scenario['wall_s']:.3f} s, imports {scenario['import_s']:.3f} s (median of "
+              f"{args.repeats}). Slowest: " +
+              ", ".join(f"{module} {seconds:.3f} s" for module, seconds in scenario['slowest_imports_s'].items()))
+        if scenario['heavy_modules']:
+            print(f"ERROR: {name} imported {', '.join(scenario['heavy_modules'])}")
+            failed = True
+
+    if args.output_json:
+        with open(args.output_json, 'w') as f:
+            json.dump(results, f, indent=2)
+    if failed:
+        sys.exit(1)
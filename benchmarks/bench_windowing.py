@@ -0,0 +1,111 @@
+"""
+Numeric equivalence and speed of the lookup table windowing (windowing_utils.apply_voi_lut) against
+pydicom.pixel_data_handlers.apply_voi_lut. The lookup table output must be the pydicom output rounded to integers,
+i.e. the absolute difference must be <= 0.5 for every pixel. The script exits with an error otherwise.
+Synthetic frames are always checked. DICOM files can be added with --input. Example of use:
+python benchmarks/bench_windowing.py --input /my/local/dicom_data
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import pydicom
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import utils
+import windowing_utils
+
+
+def synthetic_cases(rows=2457, cols=1890):
+    """
+    Frames covering the windowing parameters found in mammography
+    :return: generator of (name, frame, dataset) tuples
+    """
+    rng = np.random.RandomState(0)
+    for voi_function in ('LINEAR', 'LINEAR_EXACT', 'SIGMOID'):
+        for bits_stored, pixel_representation in ((12, 0), (14, 0), (16, 0), (12, 1), (16, 1)):
+            ds = pydicom.Dataset()
+            ds.PhotometricInterpretation = 'MONOCHROME2'
+            ds.PixelRepresentation = pixel_representation
+            ds.BitsStored = bits_stored
+            ds.WindowCenter = [2 ** (bits_stored - 2), 2 ** (bits_stored - 3)]
+            ds.WindowWidth = [2 ** (bits_stored - 1) + 0.5, 2 ** (bits_stored - 2)]
+            ds.VOILUTFunction = voi_function
+            dtype = np.int16 if pixel_representation else np.uint16
+            low = -2 ** (bits_stored - 1) if pixel_representation else 0
+            high = 2 ** (bits_stored - 1) if pixel_representation else 2 ** bits_stored
+            frame = rng.randint(low, high, size=(rows, cols)).astype(dtype)
+            yield f"synthetic {voi_function} {bits_stored} bits {'signed' if pixel_representation else 'unsigned'}", \
+                frame, ds
+
+
+def dicom_cases(input_, max_files):
+    """
+    First frame of the DICOM files in the input folder
+    :return: generator of (name, frame, dataset) tuples
+    """
+    num_files = 0
+    for root, dirs, files in os.walk(input_):
+        for fn in files:
+            try:
+                ds = pydicom.dcmread(os.path.join(root, fn), defer_size=utils.DEFER_SIZE)
+                frame = next(utils.iter_frames(ds))
+            except Exception:
+                continue
+            yield os.path.join(root, fn), frame, ds
+            num_files += 1
+            if num_files >= max_files:
+                return
+
+
+def compare(frame, ds, repeat):
+    """
+    :return: dict with the max absolute difference, times and output sizes of both engines
+    """
+    start = time.perf_counter()
+    for _ in range(repeat):
+        expected = pydicom.pixel_data_handlers.apply_voi_lut(frame, ds)
+    pydicom_time = (time.perf_counter() - start) / repeat
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = windowing_utils.apply_voi_lut(frame, ds)
+    lut_time = (time.perf_counter() - start) / repeat
+    max_diff = float(np.abs(result.astype(np.float64) - expected).max())
+    return {'max_abs_diff': max_diff, 'pydicom_s': pydicom_time, 'lut_s': lut_time,
+            'pydicom_dtype': str(expected.dtype), 'lut_dtype': str(result.dtype),
+            'pydicom_bytes': len(utils.frame_to_bytes(expected)), 'lut_bytes': len(utils.frame_to_bytes(result))}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Equivalence and benchmark of the lookup table windowing')
+    parser.add_argument('--input', type=str, help='Directory of DICOM files to check as well (optional)')
+    parser.add_argument('--max_files', type=int, default=20, help='Max number of DICOM files checked')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of timed runs for each frame')
+    parser.add_argument('--output_json', type=str, help='Save the results to a json file (optional)')
+    args = parser.parse_args()
+
+    cases = list(synthetic_cases())
+    if args.input:
+        cases += list(dicom_cases(args.input, args.max_files))
+
+    results = []
+    failed = False
+    for name, frame, ds in cases:
+        result = compare(frame, ds, args.repeat)
+        result['case'] = name
+        results.append(result)
+        ok = result['max_abs_diff'] <= 0.5
+        failed = failed or not ok
+        print(f"{'OK  ' if ok else 'FAIL'} {name}: max diff {result['max_abs_diff']:.4f}, "
+              f"pydicom {result['pydicom_s'] * 1000:.1f} ms ({result['pydicom_dtype']}), "
+              f"lut {result['lut_s'] * 1000:.1f} ms ({result['lut_dtype']}), "
+              f"{result['pydicom_bytes'] / result['lut_bytes']:.1f}x smaller")
+
+    if args.output_json:
+        with open(args.output_json, 'w') as f:
+            json.dump(results, f, indent=2)
+    if failed:
+        sys.exit(1)
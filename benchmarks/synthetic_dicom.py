@@ -0,0 +1,199 @@
+"""
+Synthetic FFDM and DBT DICOM files for the benchmarks, in the SOP classes accepted by the evaluation server.
+The pixel data imitates a mammogram (breast tissue with texture and noise over an empty background), so the files
+compress like real images. Raw (explicit VR little endian) and lossless JPEG 2000 files can be generated, the latter
+encoded with Pillow. Example of use:
+python benchmarks/synthetic_dicom.py --output /my/local/synthetic_data --studies 4 --transfer_syntaxes raw j2k
+"""
+import argparse
+import io
+import os
+
+import numpy as np
+import pydicom
+from pydicom.dataset import FileDataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+FFDM_SOP_CLASS_UID = '1.2.840.10008.5.1.4.1.1.1.2'
+DBT_SOP_CLASS_UID = '1.2.840.10008.5.1.4.1.1.13.1.3'
+# Transfer syntax UID of each supported encoding
+TRANSFER_SYNTAXES = {'raw': ExplicitVRLittleEndian, 'j2k': '1.2.840.10008.1.2.4.90'}
+# Manufacturer values as found in real files. Hologic and GE frames are preprocessed without windowing
+MANUFACTURERS = ['HOLOGIC, Inc.', 'GE MEDICAL SYSTEMS', 'SIEMENS', 'FUJIFILM Corporation']
+# Laterality and view of the images of a study
+VIEWS = [('L', 'CC'), ('R', 'CC'), ('L', 'MLO'), ('R', 'MLO')]
+
+
+def synthetic_frames(rows, cols, num_frames, rng, laterality='L', bits_stored=12):
+    """
+    :param rows: int. Number of rows
+    :param cols: int. Number of columns
+    :param num_frames: int. Number of frames
+    :param rng: numpy.random.RandomState
+    :param laterality: str. 'L' or 'R', side of the image where the breast is
+    :param bits_stored: int. Bits per pixel used
+    :return: numpy array of shape (num_frames, rows, cols) and dtype uint16
+    """
+    max_value = 2 ** bits_stored - 1
+    yy, xx = np.ogrid[0:rows, 0:cols]
+    if laterality == 'R':
+        xx = cols - 1 - xx
+    # Half ellipse against the chest wall
+    breast = (xx / (0.7 * cols)) ** 2 + ((yy - rows / 2) / (0.45 * rows)) ** 2 <= 1
+    # Low frequency texture: coarse random grid repeated to the image size
+    cell = max(rows, cols) // 32 + 1
+    coarse = rng.normal(0.55, 0.08, size=(rows // cell + 1, cols // cell + 1))
+    texture = np.repeat(np.repeat(coarse, cell, axis=0), cell, axis=1)[0:rows, 0:cols]
+    frames = np.zeros((num_frames, rows, cols), dtype=np.uint16)
+    for i in range(num_frames):
+        frame = (texture + rng.normal(0, 0.005, size=(rows, cols))) * max_value
+        frames[i] = np.where(breast, np.clip(frame, 0, max_value), 0).astype(np.uint16)
+    return frames
+
+
+def encode_j2k(frame):
+    """
+    Lossless JPEG 2000 codestream of a frame
+    :param frame: numpy array. 2D array of dtype uint16
+    :return: bytes
+    """
+    from PIL import Image
+    buffer = io.BytesIO()
+    Image.fromarray(frame).save(buffer, format='JPEG2000', irreversible=False, no_jp2=True)
+    codestream = buffer.getvalue()
+    # Start of codestream marker. Older Pillow versions ignore no_jp2 and write a JP2 file
+    if codestream[0:2] != b'\xff\x4f':
+        raise Exception('The installed version of Pillow cannot write JPEG 2000 codestreams')
+    return codestream
+
+
+def write_dicom(path, frames, dbt=False, manufacturer=MANUFACTURERS[0], transfer_syntax='raw', laterality='L',
+                view='CC', bits_stored=12):
+    """
+    Save a synthetic FFDM or DBT DICOM file
+    :param path: str. Output path
+    :param frames: numpy array of shape (num_frames, rows, cols) and dtype uint16 (one frame for FFDM)
+    :param dbt: bool. DBT (multi-frame) file, otherwise FFDM
+    :param manufacturer: str. Manufacturer DICOM field
+    :param transfer_syntax: str. 'raw' or 'j2k' (see TRANSFER_SYNTAXES)
+    :param laterality: str. ImageLaterality DICOM field
+    :param view: str. ViewPosition DICOM field
+    :param bits_stored: int. Bits per pixel used
+    :return: int. Size of the file in bytes
+    """
+    sop_class_uid = DBT_SOP_CLASS_UID if dbt else FFDM_SOP_CLASS_UID
+    meta = FileMetaDataset()
+    meta.MediaStorageSOPClassUID = sop_class_uid
+    meta.MediaStorageSOPInstanceUID = generate_uid()
+    meta.TransferSyntaxUID = TRANSFER_SYNTAXES[transfer_syntax]
+    ds = FileDataset(path, {}, file_meta=meta, preamble=b'\0' * 128)
+    ds.is_little_endian = True
+    ds.is_implicit_VR = False
+    ds.SOPClassUID = sop_class_uid
+    ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+    ds.Modality = 'MG'
+    ds.BurnedInAnnotation = 'NO'
+    ds.Manufacturer = manufacturer
+    ds.ManufacturerModelName = 'Synthetic'
+    ds.ViewPosition = view
+    ds.ImageLaterality = laterality
+    ds.PatientOrientation = ['A', 'R' if laterality == 'L' else 'L']
+    ds.Rows, ds.Columns = frames.shape[1], frames.shape[2]
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = 'MONOCHROME2'
+    ds.BitsAllocated = 16
+    ds.BitsStored = bits_stored
+    ds.HighBit = bits_stored - 1
+    ds.PixelRepresentation = 0
+    ds.WindowCenter = 2 ** (bits_stored - 1)
+    ds.WindowWidth = 2 ** bits_stored
+    if dbt:
+        ds.NumberOfFrames = frames.shape[0]
+    if transfer_syntax == 'j2k':
+        ds.PixelData = pydicom.encaps.encapsulate([encode_j2k(frame) for frame in frames])
+        ds['PixelData'].VR = 'OB'
+        ds['PixelData'].is_undefined_length = True
+    else:
+        ds.PixelData = frames.tobytes()
+    ds.save_as(path, write_like_original=False)
+    return os.path.getsize(path)
+
+
+def generate_dataset(output_dir, num_studies=4, ffdm_shape=(2560, 2048), dbt_shape=(1024, 768), dbt_frames=16,
+                     transfer_syntaxes=('raw',), manufacturers=MANUFACTURERS, seed=0):
+    """
+    Save a folder of study folders, each one with the 4 FFDM views and, if dbt_frames > 0, a DBT file. The
+    manufacturer and the transfer syntax change from one study to the next
+    :param output_dir: str. Output folder
+    :param num_studies: int. Number of studies
+    :param ffdm_shape: tuple. Rows and columns of the FFDM images
+    :param dbt_shape: tuple. Rows and columns of the DBT frames
+    :param dbt_frames: int. Number of frames of the DBT files (0: no DBT files)
+    :param transfer_syntaxes: list of str. Transfer syntaxes used (see TRANSFER_SYNTAXES)
+    :param manufacturers: list of str. Manufacturers used
+    :param seed: int. Seed of the pixel data
+    :return: dict. Description of the dataset (number of studies, files and frames, size in bytes)
+    """
+    rng = np.random.RandomState(seed)
+    num_files, num_frames, num_bytes = 0, 0, 0
+    for i in range(num_studies):
+        study_dir = os.path.join(output_dir, f'study_{i:04d}')
+        os.makedirs(study_dir, exist_ok=True)
+        manufacturer = manufacturers[i % len(manufacturers)]
+        transfer_syntax = transfer_syntaxes[i % len(transfer_syntaxes)]
+        for laterality, view in VIEWS:
+            frames = synthetic_frames(ffdm_shape[0], ffdm_shape[1], 1, rng, laterality)
+            num_bytes += write_dicom(os.path.join(study_dir, f'{laterality}{view}.dcm'), frames,
+                                     manufacturer=manufacturer, transfer_syntax=transfer_syntax,
+                                     laterality=laterality, view=view)
+            num_files += 1
+            num_frames += 1
+        if dbt_frames > 0:
+            frames = synthetic_frames(dbt_shape[0], dbt_shape[1], dbt_frames, rng)
+            num_bytes += write_dicom(os.path.join(study_dir, 'LCC_dbt.dcm'), frames, dbt=True,
+                                     manufacturer=manufacturer, transfer_syntax=transfer_syntax)
+            num_files += 1
+            num_frames += dbt_frames
+    return {'studies': num_studies, 'files': num_files, 'frames': num_frames, 'bytes': num_bytes,
+            'ffdm_shape': list(ffdm_shape), 'dbt_shape': list(dbt_shape), 'dbt_frames': dbt_frames,
+            'transfer_syntaxes': list(transfer_syntaxes), 'manufacturers': list(manufacturers)}
+
+
+def add_dataset_arguments(parser):
+    """
+    Add the arguments of generate_dataset to a parser
+    :param parser: ArgumentParser
+    :return: None
+    """
+    parser.add_argument('--studies', type=int, default=4, help='Number of studies (default: 4)')
+    parser.add_argument('--ffdm_shape', type=int, nargs=2, default=[2560, 2048],
+                        help='Rows and columns of the FFDM images (default: 2560 2048)')
+    parser.add_argument('--dbt_shape', type=int, nargs=2, default=[1024, 768],
+                        help='Rows and columns of the DBT frames (default: 1024 768)')
+    parser.add_argument('--dbt_frames', type=int, default=16,
+                        help='Number of frames of the DBT files, 0 for no DBT files (default: 16)')
+    parser.add_argument('--transfer_syntaxes', type=str, nargs='+', default=['raw', 'j2k'],
+                        choices=sorted(TRANSFER_SYNTAXES), help='Transfer syntaxes used (default: raw j2k)')
+    parser.add_argument('--manufacturers', type=str, nargs='+', default=MANUFACTURERS,
+                        help='Manufacturers used (default: Hologic, GE, Siemens and Fujifilm)')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the pixel data (default: 0)')
+
+
+def dataset_options(args):
+    """
+    :param args: Namespace. Parsed arguments (see add_dataset_arguments)
+    :return: dict. Keyword arguments of generate_dataset
+    """
+    return dict(num_studies=args.studies, ffdm_shape=tuple(args.ffdm_shape), dbt_shape=tuple(args.dbt_shape),
+                dbt_frames=args.dbt_frames, transfer_syntaxes=args.transfer_syntaxes,
+                manufacturers=args.manufacturers, seed=args.seed)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate synthetic FFDM and DBT DICOM files')
+    parser.add_argument('--output', type=str, required=True, help='Output directory')
+    add_dataset_arguments(parser)
+    args = parser.parse_args()
+    dataset = generate_dataset(args.output, **dataset_options(args))
+    print(f"{dataset['studies']} studies, {dataset['files']} files, {dataset['frames']} frames, "
+          f"{dataset['bytes'] / 2**20:.1f} MB saved to {args.output}")
@@ -0,0 +1,415 @@
+import hashlib
+import os
+import pickle
+import shutil
+import threading
+import time
+import uuid
+
+import pandas as pd
+
+import manifest_utils
+
+# Increase when the content of the preprocessed files changes, so that older cache entries are not used
+CACHE_VERSION = 2
+# Temporary folders of entries older than this were left by runs that did not finish (seconds)
+STALE_TMP_AGE = 24 * 3600
+
+# Cache folder -> [size in bytes found by the last evict of this process, bytes published since then]
+_cache_sizes = dict()
+_cache_sizes_lock = threading.Lock()
+
+
+class PreprocessCache(object):
+    """
+    On-disk cache of the preprocessed files of each DICOM file (metadata dict and encoded frames), so that files
+    that were already preprocessed in a previous run are not decoded again.
+    Entries are keyed by file path, size and modification time. The least recently used entries are evicted when an
+    entry is published and the cache exceeds its max size (see evict). The cache only holds paths, so it can be sent to
+    worker processes.
+    Several runs can share a cache folder: each run only removes its own temporary folders.
+    """
+
+    def __init__(self, cache_dir, max_bytes, variant=''):
+        """
+        :param cache_dir: str. Folder where the cache entries are stored
+        :param max_bytes: int. Max size of the cache in bytes
+        :param variant: str. Preprocessing options that change the preprocessed files (part of the key)
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.variant = variant
+        self.hits = 0
+        self.misses = 0
+        # Process that created the cache. Its worker processes get a copy of the cache, so their temporary folders
+        # belong to the same run
+        self.owner_pid = os.getpid()
+        os.makedirs(os.path.join(cache_dir, 'tmp'), exist_ok=True)
+
+    def _entry_dir(self, dicom_path, study_path_hash):
+        st = os.stat(dicom_path)
+        # The path as given, not its real path: the cached metadata and file names hold the hash of this path, so two
+        # links to the same file need their own entries
+        key = '\0'.join([str(CACHE_VERSION), self.variant, dicom_path, str(st.st_size),
+                         str(st.st_mtime_ns), study_path_hash])
+        key = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, key[0:2], key)
+
+    def load(self, dicom_path, study_path_hash, writer):
+        """
+        Write the cached preprocessed files of a DICOM file
+        :param dicom_path: str. Path to the DICOM file
+        :param study_path_hash: str. Hash of the study path
+        :param writer: Writer the preprocessed files are written to (see archive_utils)
+        :return: dict. DICOM metadata, or None if the file is not cached
+        """
+        entry_dir = self._entry_dir(dicom_path, study_path_hash)
+        # All the files of the entry are read before writing any, so that an entry evicted in the meantime is not
+        # written partially (the DICOM file is then preprocessed again and would write the same members twice)
+        members = []
+        try:
+            with open(os.path.join(entry_dir, 'metadata.pkl'), 'rb') as f:
+                metadata, arcnames = pickle.load(f)
+            for i, arcname in enumerate(arcnames):
+                with open(os.path.join(entry_dir, str(i)), 'rb') as f:
+                    members.append((arcname, f.read()))
+        except FileNotFoundError:
+            return None
+        for arcname, data in members:
+            writer.write(arcname, data)
+        # Mark the entry as recently used
+        os.utime(entry_dir)
+        return metadata
+
+    def find(self, dicom_path, study_path_hash, arcname):
+        """
+        Find a cached preprocessed file of a DICOM file
+        :param dicom_path: str. Path to the DICOM file
+        :param study_path_hash: str. Hash of the study path
+        :param arcname: str. Name of the preprocessed file (see utils.frame_arcname)
+        :return: str. Path to the cached file, or None if it is not cached
+        """
+        try:
+            entry_dir = self._entry_dir(dicom_path, study_path_hash)
+            with open(os.path.join(entry_dir, 'metadata.pkl'), 'rb') as f:
+                _, arcnames = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        if arcname not in arcnames:
+            return None
+        return os.path.join(entry_dir, str(arcnames.index(arcname)))
+
+    def create_entry(self, dicom_path, study_path_hash):
+        """
+        Create a cache entry for a DICOM file that is being preprocessed
+        :param dicom_path: str. Path to the DICOM file
+        :param study_path_hash: str. Hash of the study path
+        :return: CacheEntryWriter
+        """
+        return CacheEntryWriter(self, self._entry_dir(dicom_path, study_path_hash),
+                                os.path.join(self.cache_dir, 'tmp', f'{self.owner_pid}_{uuid.uuid4().hex}'))
+
+    def record(self, hit):
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+    def _entries(self):
+        """
+        :return: list of (mtime, size in bytes, path) tuples, one for each cache entry
+        """
+        entries = []
+        for prefix in os.scandir(self.cache_dir):
+            if not prefix.is_dir() or prefix.name == 'tmp':
+                continue
+            for entry in os.scandir(prefix.path):
+                try:
+                    size = sum(f.stat().st_size for f in os.scandir(entry.path))
+                    entries.append((entry.stat().st_mtime, size, entry.path))
+                except FileNotFoundError:
+                    # Evicted by another process in the meantime
+                    continue
+        return entries
+
+    def remove_stale_tmp(self):
+        """
+        Remove the temporary folders of the entries of this run that were not committed, and the ones left by other
+        runs more than STALE_TMP_AGE ago. Only called when no worker of this run is preprocessing files
+        :return: None
+        """
+        now = time.time()
+        for entry in os.scandir(os.path.join(self.cache_dir, 'tmp')):
+            try:
+                stale = entry.name.startswith(f'{self.owner_pid}_') or now - entry.stat().st_mtime > STALE_TMP_AGE
+            except FileNotFoundError:
+                continue
+            if stale:
+                shutil.rmtree(entry.path, ignore_errors=True)
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache size is under the max size
+        :return: int. Cache size in bytes
+        """
+        entries = sorted(self._entries())
+        cache_size = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if cache_size <= self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            cache_size -= size
+        with _cache_sizes_lock:
+            _cache_sizes[self.cache_dir] = [cache_size, 0]
+        return cache_size
+
+    def add_entry_size(self, size):
+        """
+        Count a published entry, and evict entries if the cache may have exceeded its max size. The size of the cache
+        is only scanned again when the size found by the last scan of this process plus the entries published since
+        then exceed the max size
+        :param size: int. Size of the entry in bytes
+        :return: None
+        """
+        with _cache_sizes_lock:
+            sizes = _cache_sizes.get(self.cache_dir)
+            if sizes is not None:
+                sizes[1] += size
+                if sizes[0] + sizes[1] <= self.max_bytes:
+                    return
+        self.evict()
+
+    def print_stats(self):
+        self.remove_stale_tmp()
+        cache_size = self.evict()
+        total = self.hits + self.misses
+        hit_rate = 100 * self.hits / total if total else 0
+        print(f"Preprocessing cache: {self.hits} hits, {self.misses} misses ({hit_rate:.1f}% hit rate), "
+              f"{cache_size / 2**30:.2f} GB used of {self.max_bytes / 2**30:.2f} GB")
+
+
+class CacheEntryWriter(object):
+    """
+    Writer (see archive_utils) that stores the preprocessed files of a DICOM file in a temporary folder, which becomes
+    a cache entry once the file has been fully preprocessed
+    """
+    process_safe = True
+
+    def __init__(self, cache, entry_dir, tmp_dir):
+        self.cache = cache
+        self.entry_dir = entry_dir
+        self.tmp_dir = tmp_dir
+        self.arcnames = []
+        self.size = 0
+        os.makedirs(tmp_dir)
+
+    def write(self, arcname, data):
+        with open(os.path.join(self.tmp_dir, str(len(self.arcnames))), 'wb') as f:
+            f.write(data)
+        self.arcnames.append(arcname)
+        self.size += len(data)
+
+    def commit(self, metadata):
+        """
+        Save the metadata and publish the entry
+        :param metadata: dict. DICOM metadata returned by read_dicom
+        :return: None
+        """
+        with open(os.path.join(self.tmp_dir, 'metadata.pkl'), 'wb') as f:
+            pickle.dump((metadata, self.arcnames), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.makedirs(os.path.dirname(self.entry_dir), exist_ok=True)
+        try:
+            os.rename(self.tmp_dir, self.entry_dir)
+        except OSError:
+            # The entry was created in the meantime by another process
+            self.discard()
+            return
+        self.cache.add_entry_size(self.size)
+
+    def discard(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+
+class ResultsCache(object):
+    """
+    On-disk store of the results returned by the server, keyed by the pixel hash of each file (hash of its
+    preprocessed frames and metadata, see utils.read_dicom), so that images that were already scored are not sent
+    again, also if they were moved or exported again.
+    The score of a study depends on all its images, so a study is only reused when the same set of images was scored
+    together. Studies with any new image are sent whole.
+    """
+    # Columns of the file results kept for each pixel hash
+    FILE_COLUMNS = ['x1', 'y1', 'x2', 'y2', 'slice', 'score']
+
+    def __init__(self, cache_dir):
+        """
+        :param cache_dir: str. Folder where the results are stored (studies.csv and files.csv)
+        """
+        self.studies_path = os.path.join(cache_dir, 'studies.csv')
+        self.files_path = os.path.join(cache_dir, 'files.csv')
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        # Study key (see study_key) -> study score
+        self.study_scores = dict()
+        if os.path.isfile(self.studies_path):
+            studies = pd.read_csv(self.studies_path, dtype={'study_key': str})
+            self.study_scores.update(zip(studies['study_key'], studies['score']))
+        # Pixel hash -> list of file result rows (dicts with FILE_COLUMNS)
+        self.file_rows = dict()
+        if os.path.isfile(self.files_path):
+            files = pd.read_csv(self.files_path, dtype={'pixel_hash': str})
+            for pixel_hash, rows in files.groupby('pixel_hash', sort=False):
+                self.file_rows[pixel_hash] = rows[self.FILE_COLUMNS].to_dict('records')
+
+    @staticmethod
+    def study_key(pixel_hashes):
+        """
+        :param pixel_hashes: list of str. Pixel hashes of the files of a study
+        :return: str. Hash of the set of files
+        """
+        return hashlib.sha256('\n'.join(sorted(set(pixel_hashes))).encode('utf-8')).hexdigest()
+
+    def find(self, study_path, dicom_paths, study_metadata):
+        """
+        Find the results of a study that was just preprocessed
+        :param study_path: str. Path to the study folder
+        :param dicom_paths: list of str. Paths to the DICOM files of the study
+        :param study_metadata: DataFrame. Study metadata returned by utils.read_study
+        :return: 2-tuple of DataFrame: study results (study_path, score) and file results (file_path, x1, y1, x2, y2,
+        slice, score), or None if the study has to be sent
+        """
+        with self._lock:
+            if len(study_metadata) == 0 or 'pixel_hash' not in study_metadata.columns or \
+                    study_metadata['pixel_hash'].isnull().any():
+                # Files preprocessed by an older version (see CACHE_VERSION)
+                self.misses += 1
+                return None
+            pixel_hashes = list(study_metadata['pixel_hash'])
+            score = self.study_scores.get(self.study_key(pixel_hashes))
+            if score is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        paths = {manifest_utils.create_hash(dicom_path): dicom_path for dicom_path in dicom_paths}
+        file_rows = []
+        for dcm_path_hash, pixel_hash in zip(study_metadata['SOPInstanceUID'], pixel_hashes):
+            for row in self.file_rows.get(pixel_hash, []):
+                file_rows.append(dict(file_path=paths[dcm_path_hash], **row))
+        return (pd.DataFrame({'study_path': [study_path], 'score': [score]}),
+                pd.DataFrame(file_rows, columns=['file_path'] + self.FILE_COLUMNS))
+
+    def add(self, pixel_hashes, study_df, dicom_df):
+        """
+        Store the results of a session
+        :param pixel_hashes: DataFrame. Study path, file path and pixel hash of each file sent (see
+        load_pixel_hashes)
+        :param study_df: DataFrame. Unhashed study results (study_path, score)
+        :param dicom_df: DataFrame. Unhashed file results (file_path, x1, y1, x2, y2, slice, score)
+        :return: None
+        """
+        study_scores = dict(zip(study_df['study_path'], study_df['score']))
+        file_hashes = dict(zip(pixel_hashes['file_path'], pixel_hashes['pixel_hash']))
+        new_studies = dict()
+        for study_path, files in pixel_hashes.groupby('study_path', sort=False):
+            if study_path in study_scores and not pd.isnull(study_scores[study_path]):
+                new_studies[self.study_key(files['pixel_hash'])] = study_scores[study_path]
+        new_files = dict()
+        for file_path, rows in dicom_df[dicom_df['file_path'].isin(file_hashes)].groupby('file_path', sort=False):
+            new_files[file_hashes[file_path]] = rows[self.FILE_COLUMNS].to_dict('records')
+        with self._lock:
+            new_studies = {key: score for key, score in new_studies.items() if key not in self.study_scores}
+            new_files = {key: rows for key, rows in new_files.items() if key not in self.file_rows}
+            self.study_scores.update(new_studies)
+            self.file_rows.update(new_files)
+            # Only new rows are appended, so that the files are not rewritten after each session
+            if len(new_studies) > 0:
+                pd.DataFrame({'study_key': list(new_studies.keys()), 'score': list(new_studies.values())}).to_csv(
+                    self.studies_path, mode='a', header=not os.path.isfile(self.studies_path), index=False)
+            if len(new_files) > 0:
+                pd.DataFrame([dict(pixel_hash=key, **row) for key, rows in new_files.items() for row in rows],
+                             columns=['pixel_hash'] + self.FILE_COLUMNS).to_csv(
+                    self.files_path, mode='a', header=not os.path.isfile(self.files_path), index=False)
+
+    def print_stats(self):
+        total = self.hits + self.misses
+        hit_rate = 100 * self.hits / total if total else 0
+        print(f"Results cache: {self.hits} studies reused, {self.misses} studies sent ({hit_rate:.1f}% hit rate)")
+
+
+class ResultsCacheSession(object):
+    """
+    Studies of a session found in a ResultsCache (not sent) and pixel hashes of the files that were sent. They are saved
+    next to the manifest of the session, so that the cached results are merged with the results of the server and the
+    new results are added to the cache when they are retrieved, also later with --results_url
+    """
+    # Files saved in the folder of the session
+    STUDY_FILE = 'cached_study.csv'
+    DICOM_FILE = 'cached_dicom.csv'
+    PIXEL_HASHES_FILE = 'pixel_hashes.csv'
+
+    def __init__(self):
+        self.study_dfs = []
+        self.dicom_dfs = []
+        # (study path, file path, pixel hash) of each file sent
+        self.pixel_hashes = []
+
+    def add_cached(self, results):
+        """
+        :param results: 2-tuple of DataFrame returned by ResultsCache.find
+        :return: None
+        """
+        self.study_dfs.append(results[0])
+        self.dicom_dfs.append(results[1])
+
+    def add_sent(self, study_path, dicom_paths, study_metadata):
+        """
+        :param study_path: str. Path to the study folder
+        :param dicom_paths: list of str. Paths to the DICOM files of the study
+        :param study_metadata: DataFrame. Study metadata returned by utils.read_study
+        :return: None
+        """
+        if 'pixel_hash' not in study_metadata.columns:
+            return
+        paths = {manifest_utils.create_hash(dicom_path): dicom_path for dicom_path in dicom_paths}
+        for dcm_path_hash, pixel_hash in zip(study_metadata['SOPInstanceUID'], study_metadata['pixel_hash']):
+            if not pd.isnull(pixel_hash):
+                self.pixel_hashes.append((study_path, paths[dcm_path_hash], pixel_hash))
+
+    def save(self, session_dir):
+        """
+        :param session_dir: str. Folder of the session (<output>/<session_id>)
+        :return: None
+        """
+        os.makedirs(session_dir, exist_ok=True)
+        if len(self.study_dfs) > 0:
+            pd.concat(self.study_dfs, ignore_index=True).to_csv(os.path.join(session_dir, self.STUDY_FILE),
+                                                                index=False)
+            pd.concat(self.dicom_dfs, ignore_index=True).to_csv(os.path.join(session_dir, self.DICOM_FILE),
+                                                                index=False)
+        pd.DataFrame(self.pixel_hashes, columns=['study_path', 'file_path', 'pixel_hash']).to_csv(
+            os.path.join(session_dir, self.PIXEL_HASHES_FILE), index=False)
+
+
+def load_cached_results(session_dir):
+    """
+    :param session_dir: str. Folder of the session (<output>/<session_id>)
+    :return: 2-tuple of DataFrame: study results and file results of the studies that were not sent, or None if there
+    are none
+    """
+    if not os.path.isfile(os.path.join(session_dir, ResultsCacheSession.STUDY_FILE)):
+        return None
+    return (pd.read_csv(os.path.join(session_dir, ResultsCacheSession.STUDY_FILE)),
+            pd.read_csv(os.path.join(session_dir, ResultsCacheSession.DICOM_FILE)))
+
+
+def load_pixel_hashes(session_dir):
+    """
+    :param session_dir: str. Folder of the session (<output>/<session_id>)
+    :return: DataFrame. Study path, file path and pixel hash of each file sent, or None if they were not saved
+    """
+    path = os.path.join(session_dir, ResultsCacheSession.PIXEL_HASHES_FILE)
+    if not os.path.isfile(path):
+        return None
+    return pd.read_csv(path, dtype=str)
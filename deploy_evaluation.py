@@ -1,99 +1,222 @@
 import argparse
+import atexit
+import collections
 import os
 import shutil
 import sys
 import tempfile
-import time
+import uuid
 import zipfile
-import requests
-import pandas as pd
-import utils
-from plotting_utils import plot_and_save_ims
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import discovery_utils
+import archive_utils
+import http_utils
+import image_args_utils
+import manifest_utils
+import metrics_utils
 from deploy_constants import *
 
+# pandas, cache_utils and plotting_utils are imported in the functions that use them, so that --help and the runs
+# that only wait for results start faster
 
-def zip_files(path):
+
+def zip_files(path, compresslevel=9, threads=None):
     """
     Create a temporary zip file with all the files in a given path
     :param path: str. Path to the file/folder
+    :param compresslevel: int. Deflate compression level (0-9)
+    :param threads: int. Number of threads used to compress the files (default: number of CPUs, up to 8)
     :return: str. Path to the temporary file
     """
     tmp_file = tempfile.mktemp(suffix="_upload.zip")
-    # Use max compression
-    zip_fp = zipfile.ZipFile(tmp_file, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=9)
-    if os.path.isfile(path):
-        zip_fp.write(path)
-    else:
-        for root, dirs, fns in os.walk(path):
-            for fn in fns:
-                filepath = os.path.abspath(os.path.join(root, fn))
-                zip_fp.write(filepath, os.path.join(os.path.relpath(root, path), fn))
-
+    with open(tmp_file, 'wb') as fp:
+        zip_fp = archive_utils.ParallelZipFile(fp, compresslevel=compresslevel, threads=threads)
+        # Large files are compressed while they are read from disk, not loaded in memory
+        if os.path.isfile(path):
+            zip_fp.write_file(path.lstrip('/'), path)
+        else:
+            for root, dirs, fns in os.walk(path):
+                for fn in fns:
+                    filepath = os.path.abspath(os.path.join(root, fn))
+                    zip_fp.write_file(os.path.join(os.path.relpath(root, path), fn), filepath)
+        zip_fp.close()
 
-    zip_fp.close()
     # Check if max file size is exceeded
-    file_size = os.stat(tmp_file).st_size
-    if file_size > MAX_FILE_SIZE_BYTES:
+    try:
+        archive_utils.check_file_size(os.stat(tmp_file).st_size)
+    except Exception:
         os.remove(tmp_file)
-        raise Exception(f"Max file size exceeded, the file cannot be uploaded ({file_size / 2**30} GB)." \
-                        f" Please limit the uploaded file size to {MAX_FILE_SIZE_BYTES / 2**30} GB")
+        raise
     return tmp_file
 
 
-def send_file(zip_file, access_key):
+def set_server(url):
     """
-    Send a zip file to the remote web server for processing
-    :param zip_file: str. Path to the zip file to send
+    Send the requests to another server than SERVER_IP (e.g. a local mock_server.py)
+    :param url: str. Base url of the server
+    :return: None
+    """
+    global SERVER_IP
+    SERVER_IP = url.rstrip('/')
+
+
+def new_session(access_key):
+    """
+    Create a new session in the remote web server
     :param access_key: str. Client ID
-    :return: tuple with SessionID assigned by the server and expected results url
+    :return: str. SessionID assigned by the server
     """
-    r = requests.post(SERVER_IP + "/new", json={'sender': access_key}, timeout=60)
+    r = http_utils.get_session().post(SERVER_IP + "/new", json={'sender': access_key}, timeout=60)
     if r.status_code != 200:
         raise Exception("The server could not be reached or the received response is incorrect: {}".format(r.text))
     if r.text.startswith("ERROR"):
         raise Exception("The server returned the following error: {}".format(r.text))
-    session_id = r.text
+    return r.text
+
+
+def upload_zip(session_id, access_key, fname, get_chunks, get_total=None, file_size=None):
+    """
+    Upload a zip file to a session of the remote web server, streaming its content
+    :param session_id: str. SessionID assigned by the server
+    :param access_key: str. Client ID
+    :param fname: str. Name of the zip file
+    :param get_chunks: function that returns a generator of the zip file content
+    :param get_total: function that returns the zip file size, or None while it is not known (optional)
+    :param file_size: int. Size of the zip file, if it is complete (sent with a Content-Length instead of chunked
+    transfer encoding) (optional)
+    :return: str. Expected results url
+    """
     headers = {
         'SessionId': session_id,
         'AccessKey': access_key,
     }
-    fname = os.path.basename(zip_file)
-    files = {'zip_file': (fname, open(zip_file, 'rb'), 'application/zip',
-                          {'session_id': session_id, 'access_key': access_key})}
-
-    r = requests.post(SERVER_IP + "/upload", files=files, headers=headers)
+    with metrics_utils.stage('upload') as counts:
+        r = http_utils.post_file_stream(SERVER_IP + "/upload", get_chunks, 'zip_file', fname, 'application/zip',
+                                        headers=headers,
+                                        part_headers={'session_id': session_id, 'access_key': access_key},
+                                        get_total=get_total, file_size=file_size)
+        counts['bytes_out'] = (get_total() if get_total is not None else None) or 0
 
     if r.status_code != 200:
         raise Exception("Error uploading files: {}".format(r.text))
     if r.text.startswith("ERROR"):
         raise Exception("The server returned the following error when uploading the files: {}".format(r.text))
-    expected_results_url = r.text
+    return r.text
+
+
+def send_file(zip_file, access_key):
+    """
+    Send a zip file to the remote web server for processing
+    :param zip_file: str. Path to the zip file to send
+    :param access_key: str. Client ID
+    :return: tuple with SessionID assigned by the server and expected results url
+    """
+    session_id = new_session(access_key)
+    file_size = os.stat(zip_file).st_size
+    expected_results_url = upload_zip(session_id, access_key, os.path.basename(zip_file),
+                                      lambda: http_utils.read_file_chunks(zip_file), lambda: file_size, file_size)
+    return session_id, expected_results_url
+
+
+def send_archive(archive, access_key):
+    """
+    Send a zip file to the remote web server while it is being written, so the upload overlaps with preprocessing.
+    The session is only created once the first file is added to the zip file.
+    :param archive: archive_utils.ArchiveWriter. Zip file being written
+    :param access_key: str. Client ID
+    :return: tuple with SessionID assigned by the server and expected results url, or None if the zip file was
+    closed without files
+    """
+    if not archive.wait_for_members():
+        return None
+    session_id = new_session(access_key)
+    expected_results_url = upload_zip(session_id, access_key, os.path.basename(archive.path), archive.iter_chunks,
+                                      lambda: archive.final_size)
     return session_id, expected_results_url
 
 
-def download_remote_results(expected_url, local_file_path, waiting_time_seconds=30, max_attempts=100):
+# Set once the user agreed with the Terms of Service, so they are asked only once per run (e.g. for all the shards)
+terms_accepted = False
+
+
+def confirm_terms_of_service():
+    """
+    Ask the user to agree with the Terms of Service. Exit if they do not agree
+    :return: None
+    """
+    global terms_accepted
+    print(f"I agree with the Terms of Service {TERMS_LINK} set by DeepHealth and certify that the images transferred do not include protected health information.")
+    n_attempts = 0
+    max_attempts = 5
+    while n_attempts < max_attempts:
+        answer = str(input('Confirm (y/n)?')).lower().strip()
+        if answer == 'y':
+            terms_accepted = True
+            break
+        n_attempts += 1
+        if answer == 'n' or n_attempts >= max_attempts:
+            print('You must agree to the Terms of Service to proceed.')
+            quit()
+
+
+def download_remote_results(expected_url, local_file_path, poll_timeout=3000):
     """
     Check if a remote file exists and download it.
     If it's found, download it to a local output folder.
     If file is not found after some time, return None
     :param expected_url: str. Remote url
     :param local_file_path: str. Local results file path
+    :param poll_timeout: float. Max time to wait for the results in seconds
     :return: str. Path to the local file once it has been downloaded, or None
     """
-    i = 0
-    while i < max_attempts:
-        req = requests.get(expected_url)
-        if req.status_code == 200:
-            # File found
-            with open(local_file_path, 'wb') as f:
-                f.write(req.content)
-            return local_file_path
+    with metrics_utils.stage('poll'):
+        found = http_utils.wait_for_remote_file(expected_url, poll_timeout)
+    if not found:
+        # Timeout error
+        return None
+    with metrics_utils.stage('download') as counts:
+        http_utils.download_file(expected_url, local_file_path)
+        counts['bytes_in'] = os.path.getsize(local_file_path)
+    return local_file_path
+
+
+def manifest_path(output_dir, session_id):
+    """
+    :return: str. Path to the local manifest of a session (see manifest_utils.save_manifest)
+    """
+    return os.path.join(output_dir, session_id, 'manifest.csv')
+
 
-        print("Results are being generated. Please wait...")
-        max_attempts += 1
-        time.sleep(waiting_time_seconds)
-    # Timeout error
-    return None
+def build_hash_map(input_):
+    """
+    Recreate the hash map from the input folder, for sessions without a local manifest
+    :param input_: str. Input folder or file
+    :return: dict. Hash -> path
+    """
+    hash_map = dict()
+    if os.path.isfile(input_):
+        root = '/'.join(input_.split('/')[0:-1])
+        hash_map[manifest_utils.create_hash(root)] = root
+        hash_map[manifest_utils.create_hash(input_)] = input_
+    else:
+        hash_map = discovery_utils.get_index(input_).hash_map()
+    return hash_map
+
+
+def unhash_column(df, hash_column, path_column, hash_map):
+    """
+    Add a column with the true paths of the hashes in a results dataframe
+    :param df: DataFrame. Results dataframe
+    :param hash_column: str. Column with the hashes
+    :param path_column: str. Column that will contain the paths
+    :param hash_map: Series. Path indexed by hash
+    :return: None
+    """
+    df[path_column] = df[hash_column].map(hash_map)
+    missing = df.loc[df[path_column].isnull(), hash_column]
+    if len(missing) > 0:
+        raise Exception(f"{len(missing)} {hash_column} hashes in the results could not be matched to an input path "
+                        f"(e.g. {missing.iloc[0]}). Please make sure the input has not changed since it was sent")
 
 
 def unhash_results(results_zip_file, input_, output_dir):
@@ -104,55 +227,440 @@ def unhash_results(results_zip_file, input_, output_dir):
     :param output_dir: str. Output folder
     :return: 2-tuple dataframe: study_df, dicom_df
     """
-    # Recreate hash map so we can convert to true paths
-    hash_map = dict()
-    if os.path.isfile(input_):
-        root = '/'.join(input_.split('/')[0:-1])
-        hash_map[utils.create_hash(root)] = root
-        hash_map[utils.create_hash(input_)] = input_
+    import pandas as pd
+    import cache_utils
+
+    session_id = results_zip_file.split('/')[-1].split('.zip')[0]
+    # Use the manifest saved when the files were sent, or recreate the hash map so we can convert to true paths
+    if os.path.isfile(manifest_path(output_dir, session_id)):
+        hash_map = manifest_utils.load_manifest(manifest_path(output_dir, session_id))
     else:
-        for root, dirs, files in os.walk(input_):
-            # Assume we are in a study folder when it only contains files
-            if len(dirs) == 0 and len(files) > 0:
-                hash_map[utils.create_hash(root)] = root
-                for file in files:
-                    hash_map[utils.create_hash(os.path.join(root, file))] = os.path.join(root, file)
+        hash_map = pd.Series(build_hash_map(input_), dtype=object)
 
     # Unzip results_file
-    session_id = results_zip_file.split('/')[-1].split('.zip')[0]
     unzip_destination = os.path.join(output_dir, session_id, "csv")
     with zipfile.ZipFile(results_zip_file, 'r') as zip_ref:
         zip_ref.extractall(unzip_destination)
 
     # Replace hash paths in study_df
     study_df_path = os.path.join(unzip_destination, session_id + '_study.csv')
-    study_df = pd.read_csv(study_df_path)
-    # Ensure the hashes are in a string format
-    study_df['StudyInstanceUID'] = study_df['StudyInstanceUID'].astype(str)
-    study_df['study_path'] = ''
-    for idx, row in study_df.iterrows():
-        study_df.loc[idx, 'study_path'] = hash_map[row['StudyInstanceUID']]
+    # Ensure the hashes are in a string format (read as str, so hashes like '00001234' are kept as they are)
+    study_df = pd.read_csv(study_df_path, dtype={'StudyInstanceUID': str})
+    unhash_column(study_df, 'StudyInstanceUID', 'study_path', hash_map)
 
     # Replace hash paths in dicom_df
     dicom_df_path = os.path.join(unzip_destination, session_id + '_dicom.csv')
-    dicom_df = pd.read_csv(dicom_df_path)
-    # Ensure the hashes are in a string format
-    dicom_df['StudyInstanceUID'] = dicom_df['StudyInstanceUID'].astype(str)
-    dicom_df['SOPInstanceUID'] = dicom_df['SOPInstanceUID'].astype(str)
-
-    dicom_df['study_path'] = ''
-    dicom_df['file_path'] = ''
-    for idx, row in dicom_df.iterrows():
-        dicom_df.loc[idx, 'study_path'] = hash_map[row['StudyInstanceUID']]
-        dicom_df.loc[idx, 'file_path'] = hash_map[row['SOPInstanceUID']]
+    dicom_df = pd.read_csv(dicom_df_path, dtype={'StudyInstanceUID': str, 'SOPInstanceUID': str})
+    unhash_column(dicom_df, 'StudyInstanceUID', 'study_path', hash_map)
+    unhash_column(dicom_df, 'SOPInstanceUID', 'file_path', hash_map)
 
     study_df = study_df[['study_path', 'score']]
-    study_df.to_csv(study_df_path, index=False)
     dicom_df = dicom_df[['file_path', 'x1', 'y1', 'x2', 'y2', 'slice', 'score']]
+    # Add the results of the studies that were not sent because they were found in the results cache
+    cached_results = cache_utils.load_cached_results(os.path.join(output_dir, session_id))
+    if cached_results is not None:
+        study_df = pd.concat([study_df, cached_results[0]], ignore_index=True)
+        dicom_df = pd.concat([dicom_df, cached_results[1]], ignore_index=True)
+    study_df.to_csv(study_df_path, index=False)
     dicom_df.to_csv(dicom_df_path, index=False)
     return study_df, dicom_df
 
 
+def iter_studies(input_):
+    """
+    Find the study folders of the input and their valid DICOM files, checking the headers of the files.
+    The input folder is scanned once per run (see discovery_utils.get_index)
+    :param input_: str. Folder of study folders
+    :return: generator of (study path, list of valid DICOM paths) tuples. Studies without valid files are skipped
+    """
+    # Check the headers first, so that only valid images are counted and read
+    return discovery_utils.get_index(input_).iter_studies()
+
+
+def finish_study(study_path, dicom_paths, metadata, staging=None, results_cache=None, session=None):
+    """
+    Send a study that was just preprocessed, unless its results are found in the results cache
+    :param study_path: str. Path to the study folder
+    :param dicom_paths: list of str. Paths to the DICOM files of the study
+    :param metadata: DataFrame. Study metadata returned by utils.read_study
+    :param staging: archive_utils.StudyStaging. Preprocessed files of the studies not committed yet (optional)
+    :param results_cache: cache_utils.ResultsCache. Results cache (optional)
+    :param session: cache_utils.ResultsCacheSession. Filled with the cached results and the pixel hashes sent
+    :return: int. Number of images sent, or None if the results of the study were found in the cache
+    """
+    if results_cache is None:
+        return len(metadata)
+    study_path_hash = manifest_utils.create_hash(study_path)
+    cached = results_cache.find(study_path, dicom_paths, metadata)
+    if cached is not None:
+        staging.discard(study_path_hash)
+        session.add_cached(cached)
+        return None
+    staging.commit(study_path_hash)
+    session.add_sent(study_path, dicom_paths, metadata)
+    return len(metadata)
+
+
+def preprocess_input(input_, writer, workers=1, cache=None, frame_threads=1, windowing='pydicom', manifest=None,
+                     studies=None, results_cache=None, session=None):
+    """
+    Read the DICOM files in the input path and save the preprocessed files, enforcing the evaluation limits
+    :param input_: str. Input DICOM file, study folder or folder of study folders
+    :param writer: Writer the preprocessed files are written to (see archive_utils)
+    :param workers: int. Number of processes used to read the DICOM files (1 reads them in the main process)
+    :param cache: cache_utils.PreprocessCache. Preprocessing cache (optional)
+    :param frame_threads: int. Number of threads used to decode the frames of each multi-frame file
+    :param windowing: str. Windowing engine: 'pydicom' (float64 output) or 'lut' (integer output)
+    :param manifest: dict. If set, it is filled with the hash -> path of every study and file read (optional)
+    :param studies: list of (study path, list of valid DICOM paths) tuples. If set, these studies are read instead
+    of all the studies of the input folder (optional)
+    :param results_cache: cache_utils.ResultsCache. If set, the studies whose results are cached are not sent and do
+    not count towards the evaluation limits (optional)
+    :param session: cache_utils.ResultsCacheSession. Filled with the cached results and the pixel hashes sent
+    (required with results_cache)
+    :return: int. Number of preprocessed images
+    """
+    # The DICOM libraries are only loaded when files are pre-processed (not to retrieve previous results)
+    import utils
+
+    if manifest is None:
+        manifest = dict()
+    staging = None
+    if results_cache is not None:
+        # The preprocessed files of each study are kept apart until it is known whether the study is sent
+        staging = archive_utils.StudyStaging(writer)
+        writer = staging.staging_writer
+    # If input is single file, treat parent folder like study folder
+    num_images = 0
+    try:
+        if os.path.isfile(input_):
+            root = '/'.join(input_.split('/')[0:-1])
+            manifest_utils.add_to_manifest(manifest, root, [input_])
+            metadata = utils.read_study(root, writer, input_, cache=cache, frame_threads=frame_threads,
+                                        windowing=windowing)
+            num_images += finish_study(root, [input_], metadata, staging, results_cache, session) or 0
+            assert num_images <= 1, \
+                f"ERROR: The input of {input_} is one file but more than one image would be uploaded."
+        elif os.path.isdir(input_):
+            if studies is None:
+                studies = iter_studies(input_)
+            if workers > 1:
+                return preprocess_studies_parallel(studies, writer, workers, cache, frame_threads, windowing, manifest,
+                                                   staging, results_cache, session)
+            num_studies = 0
+            for root, dicom_paths in studies:
+                num_studies += 1
+                num_images_preview = len(dicom_paths)
+
+                # Enforce Evaluation Limit
+                if num_studies > MAX_STUDIES or (num_images + num_images_preview) > MAX_IMAGES:
+                    print(f"WARNING: Enforcing Evaluation Limit of {MAX_STUDIES} studies and {MAX_IMAGES} images.")
+                    break
+
+                # Process folder
+                manifest_utils.add_to_manifest(manifest, root, dicom_paths)
+                metadata = utils.read_study(root, writer, dicom_paths=dicom_paths, cache=cache,
+                                            frame_threads=frame_threads, windowing=windowing)
+                # Update the number of images with the real number of preprocessed images
+                sent_images = finish_study(root, dicom_paths, metadata, staging, results_cache, session)
+                if sent_images is None:
+                    # Not sent: the study does not count towards the limits
+                    num_studies -= 1
+                else:
+                    num_images += sent_images
+
+        else:
+            raise Exception('Path {} does not exist.'.format(input_))
+    finally:
+        if staging is not None:
+            staging.close()
+    return num_images
+
+
+def preprocess_studies_parallel(studies, writer, workers, cache=None, frame_threads=1, windowing='pydicom',
+                                manifest=None, staging=None, results_cache=None, session=None):
+    """
+    Same as preprocess_input for a list of studies, but the DICOM files are read in a process pool.
+    Studies are submitted ahead while the evaluation limits can be guaranteed from the number of valid files
+    of the pending studies (an upper bound of their real number of images). Otherwise, the pending studies
+    are collected first, so the limits are enforced exactly as in the sequential mode.
+    :param studies: iterable of (study path, list of valid DICOM paths) tuples (see iter_studies)
+    :param writer: Writer the preprocessed files are written to (see archive_utils)
+    :param workers: int. Number of processes used to read the DICOM files
+    :param cache: cache_utils.PreprocessCache. Preprocessing cache (optional)
+    :param frame_threads: int. Number of threads used to decode the frames of each multi-frame file
+    :param windowing: str. Windowing engine: 'pydicom' (float64 output) or 'lut' (integer output)
+    :param staging: archive_utils.StudyStaging. Staging of the studies, with results_cache (see finish_study)
+    :param results_cache: cache_utils.ResultsCache. Results cache (optional)
+    :param session: cache_utils.ResultsCacheSession. Results cache lookups of the session (with results_cache)
+    :return: int. Number of preprocessed images
+    """
+    import utils
+
+    num_images = 0
+    num_studies = 0
+    # Studies submitted but not collected yet: (study path, valid DICOM paths, jobs)
+    pending = collections.deque()
+    pending_preview = 0
+    # Bound the number of files in flight, since their preprocessed files may be kept in memory until collected
+    max_pending_files = 4 * workers
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for root, dicom_paths in studies:
+            num_studies += 1
+            num_images_preview = len(dicom_paths)
+
+            # Collect pending studies until the Evaluation Limit can be checked with real numbers of images
+            while pending and (num_studies > MAX_STUDIES or pending_preview >= max_pending_files or
+                               (num_images + pending_preview + num_images_preview) > MAX_IMAGES):
+                study_path, study_dicom_paths, jobs = pending.popleft()
+                pending_preview -= len(study_dicom_paths)
+                sent_images = finish_study(study_path, study_dicom_paths,
+                                           utils.collect_study(study_path, writer, jobs, cache),
+                                           staging, results_cache, session)
+                if sent_images is None:
+                    num_studies -= 1
+                else:
+                    num_images += sent_images
+
+            # Enforce Evaluation Limit
+            if num_studies > MAX_STUDIES or (num_images + num_images_preview) > MAX_IMAGES:
+                print(f"WARNING: Enforcing Evaluation Limit of {MAX_STUDIES} studies and {MAX_IMAGES} images.")
+                break
+
+            # Process folder
+            manifest_utils.add_to_manifest(manifest, root, dicom_paths)
+            jobs = utils.submit_study(root, writer, executor, dicom_paths, cache, frame_threads, windowing)
+            pending.append((root, dicom_paths, jobs))
+            pending_preview += num_images_preview
+
+        while pending:
+            study_path, study_dicom_paths, jobs = pending.popleft()
+            num_images += finish_study(study_path, study_dicom_paths,
+                                       utils.collect_study(study_path, writer, jobs, cache),
+                                       staging, results_cache, session) or 0
+    return num_images
+
+
+def send_input(input_, args, cache=None, studies=None, preprocess_dir=None, ask_terms=True, results_cache=None):
+    """
+    Preprocess the input (or some of its studies), send it to the server and save the manifest of the session
+    :param input_: str. Input DICOM file, study folder or folder of study folders
+    :param args: Namespace. Command line arguments
+    :param cache: cache_utils.PreprocessCache. Preprocessing cache (optional)
+    :param studies: list of (study path, list of valid DICOM paths) tuples. Studies sent (default: all the input)
+    :param preprocess_dir: str. Directory where the pre-processed files are kept. If None, a temp directory is used
+    (or none at all when streaming)
+    :param ask_terms: bool. Ask the user to agree with the Terms of Service before sending the files, unless they
+    already agreed
+    :param results_cache: cache_utils.ResultsCache. The studies whose results are cached are not sent (optional)
+    :return: tuple with SessionID assigned by the server and expected results url, or None if there are no valid files.
+    If the results of all the studies were found in the results cache, nothing is sent and the url is None
+    """
+    if preprocess_dir is None:
+        # When streaming, the preprocessed files are only written into the zip file
+        preprocess_dir = None if args.stream else tempfile.mkdtemp(prefix="preprocessed_")
+        keep_preprocessed_dir = False
+    else:
+        os.makedirs(preprocess_dir, exist_ok=True)
+        keep_preprocessed_dir = True
+    writer = None if preprocess_dir is None else archive_utils.DirectoryWriter(preprocess_dir)
+    manifest = dict()
+    session = None
+    if results_cache is not None:
+        import cache_utils
+        session = cache_utils.ResultsCacheSession()
+
+    # Populate preprocessed_dir
+    if args.stream:
+        if ask_terms and not terms_accepted:
+            # The files are sent while they are read, so the Terms of Service must be accepted first
+            print("The files will be sent to the server while they are read. Please confirm the following statement to proceed:")
+            confirm_terms_of_service()
+        print("Reading files and sending them to the server...")
+        archive = archive_utils.ArchiveWriter(tempfile.mktemp(suffix="_upload.zip"),
+                                              compresslevel=args.compression_level,
+                                              threads=args.compression_threads)
+        writer = archive if writer is None else archive_utils.TeeWriter([archive, writer])
+        upload_executor = ThreadPoolExecutor(max_workers=1)
+        upload = upload_executor.submit(send_archive, archive, args.access_key)
+        try:
+            with metrics_utils.stage('preprocess'):
+                num_images = preprocess_input(input_, writer, workers=args.workers, cache=cache,
+                                              frame_threads=args.frame_threads, windowing=args.windowing,
+                                              manifest=manifest, studies=studies, results_cache=results_cache,
+                                              session=session)
+        except BaseException:
+            archive.abort()
+            raise
+        finally:
+            upload_executor.shutdown(wait=False)
+        zip_file_path = archive.close()
+    else:
+        print("Reading files...")
+        with metrics_utils.stage('preprocess'):
+            num_images = preprocess_input(input_, writer, workers=args.workers, cache=cache,
+                                          frame_threads=args.frame_threads, windowing=args.windowing,
+                                          manifest=manifest, studies=studies, results_cache=results_cache,
+                                          session=session)
+
+    if session is not None and len(session.study_dfs) > 0:
+        print(f"The results of {len(session.study_dfs)} studies were found in the results cache, they are not sent")
+
+    if num_images == 0:
+        if args.stream:
+            # Wait for the upload to end (if it started) before removing the zip file
+            upload.exception()
+            os.remove(zip_file_path)
+        if not keep_preprocessed_dir and preprocess_dir is not None:
+            shutil.rmtree(preprocess_dir)
+        if session is not None and len(session.study_dfs) > 0:
+            # Nothing to send: the results are only the cached ones, saved in a local session folder
+            session_id = 'cached_' + uuid.uuid4().hex[0:8]
+            manifest_utils.save_manifest(manifest, manifest_path(args.output, session_id))
+            session.save(os.path.join(args.output, session_id))
+            return session_id, None
+        print(f"No valid files were found in input '{input_}'")
+        return None
+
+    if not args.stream:
+        print("Preparing files for sending...")
+        with metrics_utils.stage('zip'):
+            zip_file_path = zip_files(preprocess_dir, compresslevel=args.compression_level,
+                                      threads=args.compression_threads)
+        if ask_terms and not terms_accepted:
+            print("Files are ready to send. Please confirm the following statement to proceed:")
+            confirm_terms_of_service()
+
+    try:
+        if args.stream:
+            print("All the files were read. Finishing the upload (temp files in {})...".format(zip_file_path))
+            session_id, expected_results_remote = upload.result()
+        else:
+            print("Sending files to the server (temp files in {})...".format(zip_file_path))
+            session_id, expected_results_remote = send_file(zip_file_path, args.access_key)
+        # Keep the hash -> path mapping of the session, so the results can be unhashed without reading the input
+        manifest_utils.save_manifest(manifest, manifest_path(args.output, session_id))
+        if session is not None:
+            session.save(os.path.join(args.output, session_id))
+    finally:
+        print("Cleaning temp files...")
+        if not keep_preprocessed_dir and preprocess_dir is not None:
+            shutil.rmtree(preprocess_dir)
+        os.remove(zip_file_path)
+    return session_id, expected_results_remote
+
+
+def retrieve_results(expected_results_remote, input_, args, results_cache=None):
+    """
+    Wait for the results of a session, download them and unhash the file paths
+    :param expected_results_remote: str. Results url
+    :param input_: str. Input DICOM file, study folder or folder of study folders
+    :param args: Namespace. Command line arguments
+    :param results_cache: cache_utils.ResultsCache. The results of the files sent are added to it (optional)
+    :return: 3-tuple: SessionID, study_df, dicom_df. None if the results could not be found
+    """
+    session_id = os.path.basename(expected_results_remote).replace(".zip", "")
+    results_local_file_path = os.path.join(args.output, "{}.zip".format(session_id))
+    print("Waiting for results to be ready in {}...".format(expected_results_remote))
+    results_file = download_remote_results(expected_results_remote, results_local_file_path, args.poll_timeout)
+    if not results_file:
+        return None
+    print(f"Results downloaded! See {results_local_file_path}")
+    # Generate dataframes
+    with metrics_utils.stage('unhash'):
+        study_df, dicom_df = unhash_results(results_file, input_, args.output)
+    # Remove temp file
+    os.remove(results_file)
+    if results_cache is not None:
+        import cache_utils
+        pixel_hashes = cache_utils.load_pixel_hashes(os.path.join(args.output, session_id))
+        if pixel_hashes is not None:
+            results_cache.add(pixel_hashes, study_df, dicom_df)
+    return session_id, study_df, dicom_df
+
+
+def load_cached_session(session_id, output_dir):
+    """
+    Results of a session whose studies were all found in the results cache (see send_input), saved in the same
+    folder and files as the results of the server
+    :param session_id: str. Local session id
+    :param output_dir: str. Output folder
+    :return: 3-tuple: SessionID, study_df, dicom_df
+    """
+    import cache_utils
+
+    study_df, dicom_df = cache_utils.load_cached_results(os.path.join(output_dir, session_id))
+    csv_dir = os.path.join(output_dir, session_id, "csv")
+    os.makedirs(csv_dir, exist_ok=True)
+    study_df.to_csv(os.path.join(csv_dir, session_id + '_study.csv'), index=False)
+    dicom_df.to_csv(os.path.join(csv_dir, session_id + '_dicom.csv'), index=False)
+    return session_id, study_df, dicom_df
+
+
+def merge_results(results, output_dir):
+    """
+    Merge the results of several sessions (shards of the same input) into one study-level and one file-level csv
+    :param results: list of (SessionID, study_df, dicom_df) tuples returned by retrieve_results
+    :param output_dir: str. Output folder
+    :return: 3-tuple: merged results folder, study_df, dicom_df
+    """
+    import pandas as pd
+
+    results_folder = os.path.join(output_dir, results[0][0] + "_merged")
+    os.makedirs(results_folder, exist_ok=True)
+    study_df = pd.concat([study_df for _, study_df, _ in results], ignore_index=True)
+    dicom_df = pd.concat([dicom_df for _, _, dicom_df in results], ignore_index=True)
+    study_df.to_csv(os.path.join(results_folder, "merged_study.csv"), index=False)
+    dicom_df.to_csv(os.path.join(results_folder, "merged_dicom.csv"), index=False)
+    pd.DataFrame({'session_id': [session_id for session_id, _, _ in results]}).to_csv(
+        os.path.join(results_folder, "sessions.csv"), index=False)
+    return results_folder, study_df, dicom_df
+
+
+def add_session_arguments(parser):
+    """
+    Add the command line arguments that control how the input is pre-processed, sent and retrieved
+    (shared with session_manager.py)
+    :param parser: argparse.ArgumentParser
+    :return: None
+    """
+    parser.add_argument('--stream', action='store_true',
+                        help='Write the pre-processed files straight into the zip file that will be uploaded, '
+                             'which is sent to the server while it is being written. If set, --preprocess_dir only '
+                             'keeps a copy of the pre-processed files (optional)')
+    parser.add_argument('--frame_threads', type=int, default=1,
+                        help='Number of threads used to decode the frames of each compressed multi-frame (DBT) file '
+                             '(default: 1)')
+    parser.add_argument('--windowing', type=str, choices=('pydicom', 'lut'), default='pydicom',
+                        help="Windowing engine for vendors other than GE and Hologic. 'pydicom' (default) saves float64 "
+                             "frames, 'lut' saves the same values rounded to integers using a cached lookup table, "
+                             "which is faster and makes the file sent to the server ~4x smaller")
+    parser.add_argument('--cache_dir', type=str,
+                        help='Directory of a persistent cache of pre-processed files, so that files that were already '
+                             'pre-processed in a previous run are not decoded again (optional)')
+    parser.add_argument('--cache_max_gb', type=float, default=50,
+                        help='Max size of the pre-processing cache in GB (default: 50)')
+    parser.add_argument('--compression_level', type=int, default=9, choices=range(10),
+                        help='Deflate compression level of the zip file sent to the server (0-9, default: 9)')
+    parser.add_argument('--compression_threads', type=int,
+                        help='Number of threads used to compress the zip file (default: number of CPUs, up to 8)')
+    parser.add_argument('--shard', action='store_true',
+                        help='Split an input larger than the evaluation limits or the max file size into shards of '
+                             'whole studies, each sent in its own session, and merge their results')
+    parser.add_argument('--poll_timeout', type=float, default=3000,
+                        help='Max time to wait for the results to be generated, in seconds (default: 3000)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of processes used to read the DICOM files and to generate the result images '
+                             '(default: 1)')
+    parser.add_argument('--server', type=str,
+                        help='Url of the evaluation server, e.g. a local mock_server.py for testing '
+                             '(default: SERVER_IP in deploy_constants.py)')
+    parser.add_argument('--results_cache_dir', type=str,
+                        help='Directory of a persistent store of the results returned by the server, keyed by the '
+                             'content of the pre-processed images. Studies whose images were already scored together '
+                             'are not sent again and their stored results are added to the results (optional)')
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Evaluation of AI algorithms for cancer detection in mammography.\n"
                                                  "Example of use: python deploy_evaluation.py "
@@ -164,107 +672,105 @@ if __name__ == '__main__':
     parser.add_argument('--output', type=str, required=True, help='Output directory to store results')
     parser.add_argument('--access_key', type=str, required=True, help='Access key provided by the authors')
     parser.add_argument('--preprocess_dir', type=str, help='Directory to store pre-processed files (optional)')
+    add_session_arguments(parser)
     parser.add_argument('--results_url', type=str,
                         help='Results url for a previous request (used to display the results asynchronously)')
     parser.add_argument('--plot_images', type=str, choices=('y', 'n'), help="Generate images/bounding boxes (y/n)")
+    image_args_utils.add_image_arguments(parser)
+    parser.add_argument('--metrics', type=str,
+                        help='Save the wall time, CPU time and bytes of each stage, the latency percentiles of the '
+                             'files and the peak RSS to this json file (optional)')
+    parser.add_argument('--profile_dir', type=str,
+                        help='With --metrics, save the cProfile stats of each stage to <profile_dir>/<stage>.prof '
+                             '(optional)')
 
     args = parser.parse_args()
 
     # If input is single file, treat parent folder like study folder
     input_ = os.path.realpath(args.input)
+    if args.server is not None:
+        set_server(args.server)
+    if args.metrics is not None:
+        # Saved when the script ends, also if it is stopped or no results are retrieved
+        atexit.register(metrics_utils.enable(args.profile_dir).save, args.metrics)
+
+    cache = None
+    if args.cache_dir is not None or args.results_cache_dir is not None:
+        import cache_utils
+    if args.cache_dir is not None:
+        # The windowing engine changes the pre-processed frames, so it is part of the cache keys
+        cache = cache_utils.PreprocessCache(args.cache_dir, int(args.cache_max_gb * 2**30), variant=args.windowing)
+    results_cache = None
+    if args.results_cache_dir is not None:
+        results_cache = cache_utils.ResultsCache(args.results_cache_dir)
 
     if args.results_url is None:
         # Process inputs
-        if args.preprocess_dir is None:
-            preprocess_dir = tempfile.mkdtemp(prefix="preprocessed_")
-            keep_preprocessed_dir = False
-        else:
-            preprocess_dir = args.preprocess_dir
-            if os.path.exists(preprocess_dir):
-                assert os.path.isdir(preprocess_dir) and len(os.listdir(preprocess_dir)) == 0, \
+        if args.preprocess_dir is not None:
+            if os.path.exists(args.preprocess_dir):
+                assert os.path.isdir(args.preprocess_dir) and len(os.listdir(args.preprocess_dir)) == 0, \
                         "Please use a new or empty folder as 'preprocess_dir' parameter"
             else:
-                os.makedirs(preprocess_dir)
-            keep_preprocessed_dir = True
-
-        # Populate preprocessed_dir
-        print("Reading files...")
-
-        # If input is single file, treat parent folder like study folder
-        num_images = 0
-        if os.path.isfile(input_):
-            root = '/'.join(input_.split('/')[0:-1])
-            metadata = utils.read_study(root, preprocess_dir, input_)
-            num_images += len(metadata)
-            assert num_images <= 1, f"ERROR: The input of {input_} is one file but more than one image would be uploaded."
-        elif os.path.isdir(input_):
-            num_studies = 0
-            for root, dirs, files in os.walk(input_):
-                # Assume we are in a study folder when it only contains files
-                if len(dirs) == 0 and len(files) > 0:
-                    num_studies += 1
-                    num_images_preview = len(files)
-
-                    # Enforce Evaluation Limit
-                    if num_studies > MAX_STUDIES or (num_images + num_images_preview) > MAX_IMAGES:
-                        print(f"WARNING: Enforcing Evaluation Limit of {MAX_STUDIES} studies and {MAX_IMAGES} images.")
-                        break
-
-                    # Process folder
-                    metadata = utils.read_study(root, preprocess_dir)
-                    # Update the number of images with the real number of preprocessed images
-                    num_images += len(metadata)
+                os.makedirs(args.preprocess_dir)
 
+        if args.shard and os.path.isdir(input_):
+            print("Planning the shards of the input...")
+            import shard_utils
+            shards = shard_utils.plan_shards(iter_studies(input_), args.windowing)
         else:
-            raise Exception('Path {} does not exist.'.format(input_))
+            # All the input in one session (None: the studies are found while they are read)
+            shards = [None]
 
-        if num_images == 0:
-            print(f"No valid files were found in input '{input_}'")
-            sys.exit(0)
+        results_urls = []
+        # Sessions whose studies were all found in the results cache (nothing was sent)
+        cached_sessions = []
+        for i, studies in enumerate(shards):
+            preprocess_dir = args.preprocess_dir
+            if len(shards) > 1:
+                print(f"Sending shard {i + 1}/{len(shards)}...")
+                if preprocess_dir is not None:
+                    preprocess_dir = os.path.join(preprocess_dir, f"shard_{i + 1}")
+            sent = send_input(input_, args, cache, studies, preprocess_dir, results_cache=results_cache)
+            if sent is None:
+                continue
+            if sent[1] is None:
+                cached_sessions.append(sent[0])
+            else:
+                results_urls.append(sent[1])
 
-        print("Preparing files for sending...")
-        zip_file_path = zip_files(preprocess_dir)
-
-        print("Files are ready to send. Please confirm the following statement to proceed:")
-        print(f"I agree with the Terms of Service {TERMS_LINK} set by DeepHealth and certify that the images transferred do not include protected health information.")
-        n_attempts = 0
-        max_attempts = 5
-        while n_attempts < max_attempts:
-            answer = str(input('Confirm (y/n)?')).lower().strip()
-            if answer == 'y':
-                break
-            n_attempts += 1
-            if answer == 'n' or n_attempts >= max_attempts:
-                print('You must agree to the Terms of Service to proceed.')
-                quit()
+        if cache is not None:
+            cache.print_stats()
+        if results_cache is not None:
+            results_cache.print_stats()
+        if len(results_urls) == 0 and len(cached_sessions) == 0:
+            sys.exit(0)
 
-        try:
-            print("Sending files to the server (temp files in {})...".format(zip_file_path))
-            session_id, expected_results_remote = send_file(zip_file_path, args.access_key)
-        finally:
-            print("Cleaning temp files...")
-            if not keep_preprocessed_dir:
-                shutil.rmtree(preprocess_dir)
-            os.remove(zip_file_path)
-        print("The results are being generated.\n"
-              "You can stop this process now pressing Ctrl+C or wait for the results to be generated\n"
-              "If you decide to stop the process, you can obtain and display the results later using this url as 'results_url' parameter:\n"
-              "{}".format(expected_results_remote))
+        if len(results_urls) > 0:
+            print("The results are being generated.\n"
+                  "You can stop this process now pressing Ctrl+C or wait for the results to be generated\n"
+                  "If you decide to stop the process, you can obtain and display the results later using this url as 'results_url' parameter:\n"
+                  "{}".format("\n".join(results_urls)))
     else:
         # The input files were already sent and just results should be displayed
-        expected_results_remote = args.results_url
-        session_id = os.path.basename(expected_results_remote).replace(".zip", "")
-
-    results_local_file_path = os.path.join(args.output, "{}.zip".format(session_id))
-    print("Waiting for results to be ready in {}...".format(expected_results_remote))
-    results_file = download_remote_results(expected_results_remote, results_local_file_path)
-    if results_file:
-        print(f"Results downloaded! See {results_local_file_path}")
-        session_id = os.path.basename(results_local_file_path).replace(".zip", "")
-        results_folder = os.path.join(args.output, session_id)
-        # Results available
-        # Generate dataframes
-        study_df, dicom_df = unhash_results(results_file, input_, args.output)
+        results_urls = [args.results_url]
+        cached_sessions = []
+
+    results = [load_cached_session(session_id, args.output) for session_id in cached_sessions]
+    for expected_results_remote in results_urls:
+        session_results = retrieve_results(expected_results_remote, input_, args, results_cache)
+        if session_results is None:
+            print(f"Results of {expected_results_remote} could not be found. "
+                  "Please try again later or contact the administrator")
+            continue
+        results.append(session_results)
+
+    if len(results) > 0:
+        if len(results) > 1:
+            # Shards of the same input: merge their results
+            results_folder, study_df, dicom_df = merge_results(results, args.output)
+        else:
+            session_id, study_df, dicom_df = results[0]
+            results_folder = os.path.join(args.output, session_id)
         # Generate images/bounding boxes (optional)
         if len(dicom_df) > 0:
             if args.plot_images == 'y':
@@ -278,10 +784,13 @@ if __name__ == '__main__':
                     answer = str(input("Do you want to generate images for the results? (y/n)")).lower().strip()
                 plot_images = answer == 'y'
             if plot_images:
-                plot_and_save_ims(dicom_df, os.path.join(args.output, session_id))
+                import plotting_utils
+
+                # Reuse the pre-processed frames when they were kept, so the DICOM files are not decoded again
+                frames = plotting_utils.PreprocessedFrames(
+                    plotting_utils.preprocess_dirs(args.preprocess_dir) if args.preprocess_dir else [], cache)
+                with metrics_utils.stage('plot'):
+                    plotting_utils.plot_and_save_ims(dicom_df, results_folder, workers=args.workers, frames=frames,
+                                                     **image_args_utils.image_options(args))
                 print("Images generated!")
         print("All the results files have been saved to the folder {}".format(results_folder))
-        # Remove temp file
-        os.remove(results_file)
-    else:
-        print("Results could not be found. Please try again later or contact the administrator")
@@ -0,0 +1,119 @@
+import collections
+import os
+import threading
+
+import manifest_utils
+
+# DICOM files start with a 128-byte preamble followed by the 'DICM' prefix
+DICOM_PREAMBLE_SIZE = 128
+DICOM_PREFIX = b'DICM'
+# Media directory files have a DICOM header but no image
+DICOMDIR_NAME = 'DICOMDIR'
+
+_indexes = dict()
+_indexes_lock = threading.Lock()
+
+
+def has_dicom_prefix(path):
+    """
+    Check the 'DICM' prefix after the preamble, without parsing the file. pydicom rejects files without it as well
+    :param path: str. Path to the file
+    :return: bool
+    """
+    try:
+        with open(path, 'rb') as f:
+            return f.read(DICOM_PREAMBLE_SIZE + len(DICOM_PREFIX))[DICOM_PREAMBLE_SIZE:] == DICOM_PREFIX
+    except OSError:
+        return False
+
+
+class DicomIndex(object):
+    """
+    Study folders of an input folder and their DICOM files, found with a single os.scandir pass.
+    Study folders are the folders that only contain files (same rule and order as os.walk). Files without the DICOM
+    prefix and DICOMDIR files are skipped without being parsed.
+    """
+
+    def __init__(self, input_):
+        """
+        :param input_: str. Folder of study folders (or study folder)
+        """
+        self.input = input_
+        # Study path -> list of paths of the files with a DICOM prefix, in directory listing order
+        self.studies = collections.OrderedDict()
+        # Number of files of the study folders that were skipped (not DICOM or DICOMDIR)
+        self.num_skipped = 0
+        self._scan(input_)
+
+    def _scan(self, path):
+        try:
+            entries = list(os.scandir(path))
+        except OSError:
+            # Same as os.walk: folders that cannot be listed are ignored
+            return
+        dirs = []
+        files = []
+        for entry in entries:
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            (dirs if is_dir else files).append(entry)
+        if len(dirs) == 0 and len(files) > 0:
+            dicom_paths = []
+            for entry in files:
+                if entry.name.upper() == DICOMDIR_NAME or not has_dicom_prefix(entry.path):
+                    self.num_skipped += 1
+                    continue
+                dicom_paths.append(entry.path)
+            self.studies[path] = dicom_paths
+        for entry in dirs:
+            # Symbolic links to folders are not followed, same as os.walk
+            if not entry.is_symlink():
+                self._scan(entry.path)
+
+    @property
+    def num_files(self):
+        return sum(len(dicom_paths) for dicom_paths in self.studies.values())
+
+    def iter_studies(self):
+        """
+        Check the headers of the DICOM files of each study
+        :return: generator of (study path, list of valid DICOM paths) tuples. Studies without valid files are skipped
+        """
+        # Imported here, so that the index can be used to match results to paths without loading the DICOM libraries
+        import utils
+
+        for study_path, dicom_paths in self.studies.items():
+            dicom_paths = utils.validate_study(study_path, candidates=dicom_paths)
+            if len(dicom_paths) == 0:
+                continue
+            yield study_path, dicom_paths
+
+    def hash_map(self):
+        """
+        :return: dict. Hash -> path of the study folders and their DICOM files (see manifest_utils.add_to_manifest)
+        """
+        hash_map = dict()
+        for study_path, dicom_paths in self.studies.items():
+            manifest_utils.add_to_manifest(hash_map, study_path, dicom_paths)
+        return hash_map
+
+    def print_summary(self):
+        print(f"Found {len(self.studies)} study folders with {self.num_files} DICOM files" +
+              (f", {self.num_skipped} other files skipped" if self.num_skipped else ""))
+
+
+def get_index(input_):
+    """
+    Index of an input folder, scanned the first time it is requested and shared by the rest of the run
+    :param input_: str. Folder of study folders
+    :return: DicomIndex
+    """
+    # Paths are kept as given, since the hashes sent to the server are computed from them
+    key = os.path.realpath(input_)
+    with _indexes_lock:
+        if key not in _indexes or _indexes[key].input != input_:
+            _indexes[key] = DicomIndex(input_)
+            _indexes[key].print_summary()
+        return _indexes[key]
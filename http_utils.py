@@ -0,0 +1,293 @@
+import os
+import time
+import uuid
+
+import requests
+
+# Size of the chunks used to stream downloads to disk
+CHUNK_SIZE = 2**20
+
+_session = None
+
+
+def get_session(pool_maxsize=8):
+    """
+    Session shared by all the requests sent to the server, so that the connections are pooled and reused (keep-alive)
+    instead of opening a new connection for every request
+    :param pool_maxsize: int. Max number of connections kept open (only used by the first call)
+    :return: requests.Session
+    """
+    global _session
+    if _session is None:
+        _session = requests.Session()
+        # Only failed connections are retried by the adapter, the requests that reached the server are never resent
+        # (post_file_stream only sends an upload again if its body was not completely sent)
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=pool_maxsize, max_retries=3)
+        _session.mount('http://', adapter)
+        _session.mount('https://', adapter)
+    return _session
+
+
+def backoff_delays(initial_delay, max_delay, factor=1.5):
+    """
+    Exponential backoff
+    :param initial_delay: float. First delay in seconds
+    :param max_delay: float. Max delay in seconds
+    :param factor: float. Growth factor of the delay
+    :return: generator of delays in seconds
+    """
+    delay = initial_delay
+    while True:
+        yield delay
+        delay = min(delay * factor, max_delay)
+
+
+def remote_file_exists(url, session=None):
+    """
+    Check if a remote file exists with a HEAD request (the body is not downloaded). If the HEAD request fails, the
+    file is checked with a GET of its first byte, since presigned and GET-only urls can answer HEAD requests with an
+    error (e.g. 403 or 404) even when the file exists
+    :param url: str. Remote url
+    :param session: requests.Session. Session used (default: get_session())
+    :return: bool
+    """
+    session = session or get_session()
+    try:
+        r = session.head(url, allow_redirects=True, timeout=30)
+        if r.status_code != 200:
+            # The body is not read: at most one byte if the server supports ranges, nothing otherwise
+            with session.get(url, headers={'Range': 'bytes=0-0'}, stream=True, timeout=30) as r:
+                pass
+        return r.status_code in (200, 206)
+    except requests.exceptions.RequestException as e:
+        print(f"The results could not be checked ({e}). Retrying...")
+        return False
+
+
+def wait_for_remote_file(url, poll_timeout, initial_delay=5, max_delay=60, session=None):
+    """
+    Poll a remote url until it exists, with exponential backoff between the checks (see remote_file_exists)
+    :param url: str. Remote url
+    :param poll_timeout: float. Max time to wait in seconds
+    :param initial_delay: float. Time before the second check in seconds
+    :param max_delay: float. Max time between checks in seconds
+    :param session: requests.Session. Session used (default: get_session())
+    :return: bool. True if the file exists, False if it was not found before the timeout
+    """
+    deadline = time.monotonic() + poll_timeout
+    for delay in backoff_delays(initial_delay, max_delay):
+        if remote_file_exists(url, session):
+            return True
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        print("Results are being generated. Please wait...")
+        time.sleep(min(delay, remaining))
+
+
+def download_file(url, local_file_path, max_attempts=5, session=None):
+    """
+    Stream a remote file to disk in chunks. The data is written to a '.part' file that is renamed once it is
+    complete. If the download is interrupted, it is resumed from the last byte received with a Range request
+    (also when the '.part' file was left by a previous run).
+    :param url: str. Remote url
+    :param local_file_path: str. Local file path
+    :param max_attempts: int. Max number of consecutive attempts that fail without receiving any data
+    :param session: requests.Session. Session used (default: get_session())
+    :return: str. Path to the local file
+    """
+    session = session or get_session()
+    part_file_path = local_file_path + '.part'
+    delays = backoff_delays(1, 30, factor=2)
+    failed_attempts = 0
+    validator = None
+    while True:
+        offset = os.path.getsize(part_file_path) if os.path.isfile(part_file_path) else 0
+        headers = {'Range': f'bytes={offset}-'} if offset > 0 else {}
+        if offset > 0 and validator is not None:
+            # The server sends the whole file again (200) if it changed since the previous attempt
+            headers['If-Range'] = validator
+        received = 0
+        try:
+            with session.get(url, headers=headers, stream=True, timeout=60) as r:
+                if r.status_code == 416:
+                    # Nothing left to download
+                    break
+                if r.status_code == 200:
+                    # Range not supported (or first request): download the whole file again
+                    offset = 0
+                elif r.status_code != 206:
+                    raise Exception(f"Error downloading {url} (status code {r.status_code}): {r.text}")
+                validator = r.headers.get('ETag', r.headers.get('Last-Modified', validator))
+                total = offset + int(r.headers['Content-Length']) if 'Content-Length' in r.headers else None
+                with open(part_file_path, 'ab' if offset > 0 else 'wb') as f:
+                    for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                        f.write(chunk)
+                        received += len(chunk)
+            if total is None or offset + received >= total:
+                break
+            raise requests.exceptions.ChunkedEncodingError(f"{offset + received} of {total} bytes received")
+        except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError,
+                requests.exceptions.Timeout) as e:
+            failed_attempts = 0 if received > 0 else failed_attempts + 1
+            if failed_attempts >= max_attempts:
+                raise Exception(f"Error downloading {url}: {e}")
+            print(f"Download interrupted ({e}). Resuming...")
+            time.sleep(next(delays))
+    os.replace(part_file_path, local_file_path)
+    return local_file_path
+
+
+def read_file_chunks(path, chunk_size=CHUNK_SIZE):
+    """
+    :param path: str. Path to a local file
+    :param chunk_size: int. Max size of the chunks in bytes
+    :return: generator of bytes
+    """
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+
+class TransferProgress(object):
+    """
+    Prints the amount of data transferred, the throughput and the estimated time left every few seconds
+    """
+
+    def __init__(self, get_total=None, interval=10):
+        """
+        :param get_total: function that returns the total size in bytes, or None while it is not known (optional)
+        :param interval: float. Time between two messages in seconds
+        """
+        self.get_total = get_total
+        self.interval = interval
+        self.transferred = 0
+        # Set when the whole body was handed to the connection
+        self.complete = False
+        self.start = time.monotonic()
+        self._last_print = self.start
+
+    def update(self, num_bytes):
+        self.transferred += num_bytes
+        now = time.monotonic()
+        if now - self._last_print >= self.interval:
+            self._last_print = now
+            self.print_status(now)
+
+    def print_status(self, now=None):
+        elapsed = (now or time.monotonic()) - self.start
+        throughput = self.transferred / elapsed if elapsed > 0 else 0
+        message = f"{self.transferred / 2**20:.1f} MB sent ({throughput / 2**20:.2f} MB/s"
+        total = self.get_total() if self.get_total is not None else None
+        if total and throughput > 0:
+            eta = max(total - self.transferred, 0) / throughput
+            message += f", {100 * self.transferred / total:.0f}%, ETA {eta:.0f} s"
+        print(message + ")")
+
+
+def multipart_body(chunks, boundary, field_name, filename, content_type, part_headers=None, progress=None):
+    """
+    Body of a multipart/form-data request with a single file, generated as the file chunks are produced
+    :param chunks: iterable of bytes. Content of the file
+    :param boundary: str. Multipart boundary
+    :param field_name: str. Name of the form field
+    :param filename: str. Name of the file
+    :param content_type: str. Content type of the file
+    :param part_headers: dict. Additional headers of the file part (optional)
+    :param progress: TransferProgress (optional)
+    :return: generator of bytes
+    """
+    head, tail = multipart_framing(boundary, field_name, filename, content_type, part_headers)
+    yield head
+    for chunk in chunks:
+        yield chunk
+        if progress is not None:
+            progress.update(len(chunk))
+    yield tail
+    if progress is not None:
+        progress.complete = True
+
+
+def multipart_framing(boundary, field_name, filename, content_type, part_headers=None):
+    """
+    Bytes sent before and after the file in a multipart/form-data body (see multipart_body)
+    :return: tuple of bytes. Head and tail of the body
+    """
+    headers = [f'--{boundary}',
+               f'Content-Disposition: form-data; name="{field_name}"; filename="{filename}"',
+               f'Content-Type: {content_type}']
+    headers += [f'{name}: {value}' for name, value in (part_headers or dict()).items()]
+    return ('\r\n'.join(headers) + '\r\n\r\n').encode('utf-8'), f'\r\n--{boundary}--\r\n'.encode('utf-8')
+
+
+class SizedBody(object):
+    """
+    Request body generated in chunks, with a known size. requests sends it with a Content-Length header instead of
+    chunked transfer encoding
+    """
+
+    def __init__(self, chunks, size):
+        self.chunks = chunks
+        self.size = size
+
+    def __iter__(self):
+        return iter(self.chunks)
+
+    def __len__(self):
+        return self.size
+
+
+def post_file_stream(url, get_chunks, field_name, filename, content_type='application/octet-stream', headers=None,
+                     part_headers=None, get_total=None, file_size=None, max_attempts=3, timeout=(60, 600),
+                     session=None):
+    """
+    Upload a file in a multipart/form-data POST request, streaming its content so that it is not loaded in memory.
+    If the size of the file is known, the request has a Content-Length header. Otherwise it is sent with chunked
+    transfer encoding, so the file does not need to be complete when the upload starts.
+    Requests that fail to connect or lose the connection before the whole file is sent are sent again. The server
+    does not support resuming uploads, so the file is sent again from the beginning. Once the whole file was sent, the
+    server may have received it, so read timeouts and connection errors are raised instead of sending it again.
+    :param url: str. Remote url
+    :param get_chunks: function that returns a generator of the file content (called once per attempt)
+    :param field_name: str. Name of the form field
+    :param filename: str. Name of the file
+    :param content_type: str. Content type of the file
+    :param headers: dict. Request headers (optional)
+    :param part_headers: dict. Additional headers of the file part (optional)
+    :param get_total: function that returns the file size, or None while it is not known (optional)
+    :param file_size: int. Size of the file, if it is complete when the upload starts (optional)
+    :param max_attempts: int. Max number of attempts
+    :param timeout: tuple. Connect and read timeouts in seconds
+    :param session: requests.Session. Session used (default: get_session())
+    :return: requests.Response
+    """
+    session = session or get_session()
+    delays = backoff_delays(5, 60, factor=2)
+    attempt = 0
+    while True:
+        attempt += 1
+        boundary = uuid.uuid4().hex
+        request_headers = dict(headers or dict())
+        request_headers['Content-Type'] = f'multipart/form-data; boundary={boundary}'
+        progress = TransferProgress(get_total)
+        body = multipart_body(get_chunks(), boundary, field_name, filename, content_type, part_headers, progress)
+        if file_size is not None:
+            head, tail = multipart_framing(boundary, field_name, filename, content_type, part_headers)
+            body = SizedBody(body, len(head) + file_size + len(tail))
+        try:
+            r = session.post(url, data=body, headers=request_headers, timeout=timeout)
+        except requests.exceptions.ReadTimeout as e:
+            raise Exception(f"The server did not answer after receiving the file ({e}). The file is not sent again, "
+                            f"since it may have been received") from e
+        except requests.exceptions.ConnectionError as e:
+            # ConnectTimeout is a ConnectionError
+            if progress.complete or attempt >= max_attempts:
+                raise
+            print(f"Upload failed ({e}). Sending the file again...")
+            time.sleep(next(delays))
+            continue
+        progress.print_status()
+        return r
@@ -0,0 +1,46 @@
+"""
+Command line arguments of the output images, shared by deploy_evaluation.py and plotting_utils.py. Kept apart from
+plotting_utils so that they can be added to a parser without importing numpy or the image libraries
+"""
+
+# File extension of each output image format
+IMAGE_EXTENSIONS = {'png': '.png', 'jpeg': '.jpg', 'webp': '.webp'}
+# Output of the images: one plotted image per dicom file, or tile pyramids and montages (see save_review_im)
+IMAGE_OUTPUTS = ('image', 'review')
+
+
+def add_image_arguments(parser):
+    """
+    Add the arguments of the output images to a parser
+    :param parser: ArgumentParser
+    :return: None
+    """
+    parser.add_argument('--image_format', type=str, default='png', choices=sorted(IMAGE_EXTENSIONS),
+                        help="Format of the generated images: 'png' (lossless), 'jpeg' or 'webp' (smaller and faster "
+                             "to save) (default: png)")
+    parser.add_argument('--png_compress_level', type=int, default=6, choices=range(10),
+                        help='Compression level of the png images, from 0 (fastest, larger files) to 9 (default: 6)')
+    parser.add_argument('--image_quality', type=int, default=90,
+                        help='Quality of the jpeg and webp images, from 1 to 100 (default: 90)')
+    parser.add_argument('--image_max_dim', type=int,
+                        help='If set, the images are downscaled so that their largest side is at most this number of '
+                             'pixels (optional)')
+    parser.add_argument('--image_output', type=str, default='image', choices=IMAGE_OUTPUTS,
+                        help="'image': one plotted image per dicom file. 'review': for each image, a tile pyramid "
+                             "(thumbnail first, full resolution tiles on demand) and, for DBT files, a strip of the "
+                             "slices around the box, plus one montage of the images of each study (default: image)")
+    parser.add_argument('--tile_size', type=int, default=512,
+                        help='Size of the tiles of the review output, in pixels (default: 512)')
+    parser.add_argument('--strip_slices', type=int, default=2,
+                        help='Number of slices on each side of the box slice in the DBT strips of the review output '
+                             '(default: 2)')
+
+
+def image_options(args):
+    """
+    :param args: Namespace. Parsed arguments (see add_image_arguments)
+    :return: dict. Keyword arguments of plotting_utils.plot_and_save_ims
+    """
+    return dict(image_format=args.image_format, png_compress_level=args.png_compress_level,
+                quality=args.image_quality, max_dim=args.image_max_dim, image_output=args.image_output,
+                tile_size=args.tile_size, strip_slices=args.strip_slices)
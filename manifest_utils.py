@@ -0,0 +1,47 @@
+import hashlib
+import os
+
+# Hashes of the paths and names of the files sent to the server, kept out of utils so that they can be used without
+# loading the DICOM libraries (e.g. to retrieve the results of a previous session). pandas is only loaded to save and
+# load the manifests
+
+def create_hash(string):
+    return hashlib.sha256(string.encode('ASCII')).hexdigest()[0:8]
+
+def add_to_manifest(manifest, study_path, dicom_paths):
+    """
+    Add the hashes of a study and its files to a manifest
+    :param manifest: dict. Hash -> path
+    :param study_path: str. Path to the study folder
+    :param dicom_paths: list of str. Paths to the DICOM files of the study
+    :return: None
+    """
+    manifest[create_hash(study_path)] = study_path
+    for dicom_path in dicom_paths:
+        manifest[create_hash(dicom_path)] = dicom_path
+
+def save_manifest(manifest, manifest_path):
+    """
+    Save the hash -> path mapping of the files sent to the server
+    :param manifest: dict. Hash -> path
+    :param manifest_path: str. Path to the csv file
+    :return: None
+    """
+    import pandas as pd
+
+    os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+    pd.DataFrame({'hash': list(manifest.keys()), 'path': list(manifest.values())}).to_csv(manifest_path, index=False)
+
+def load_manifest(manifest_path):
+    """
+    Load a manifest saved by save_manifest
+    :param manifest_path: str. Path to the csv file
+    :return: Series. Path indexed by hash
+    """
+    import pandas as pd
+
+    manifest = pd.read_csv(manifest_path, dtype=str)
+    return pd.Series(manifest['path'].values, index=manifest['hash'].values)
+
+def frame_arcname(study_path_hash, dcm_path_hash, frame_index):
+    return '{}/{}/frame_{}.npy'.format(study_path_hash, dcm_path_hash, frame_index)
@@ -0,0 +1,242 @@
+import cProfile
+import collections
+import contextlib
+import json
+import os
+import resource
+import sys
+import threading
+import time
+
+# Metrics collected in this process, or None if they are not collected (see enable)
+_metrics = None
+
+
+class Metrics(object):
+    """
+    Wall time, CPU time and bytes in/out of each stage of a run, and latencies of single operations (e.g. the
+    preprocessing of one DICOM file). CPU times are the user and system time of the process (and of the child
+    processes that finished) while the stage ran. Stages can be profiled with cProfile (one .prof file per stage).
+    """
+
+    def __init__(self, profile_dir=None):
+        """
+        :param profile_dir: str. If set, the top level stages of the main thread are profiled and their stats are
+        saved to <profile_dir>/<stage>.prof
+        """
+        self.profile_dir = profile_dir
+        self.stages = collections.OrderedDict()
+        self.latencies = collections.defaultdict(list)
+        self.start = time.perf_counter()
+        self._profiles = dict()
+        self._profiling = False
+        self._lock = threading.Lock()
+
+    def add(self, name, wall_s=0, cpu_s=0, bytes_in=0, bytes_out=0, calls=1):
+        with self._lock:
+            stage = self.stages.setdefault(name, {'calls': 0, 'wall_s': 0, 'cpu_s': 0, 'bytes_in': 0,
+                                                  'bytes_out': 0})
+            stage['calls'] += calls
+            stage['wall_s'] += wall_s
+            stage['cpu_s'] += cpu_s
+            stage['bytes_in'] += bytes_in
+            stage['bytes_out'] += bytes_out
+
+    def add_latency(self, name, seconds):
+        with self._lock:
+            self.latencies[name].append(seconds)
+
+    def merge(self, other):
+        """
+        Add the metrics collected in another process (see run_measured)
+        :param other: Metrics
+        :return: None
+        """
+        for name, stage in other.stages.items():
+            self.add(name, **stage)
+        for name, latencies in other.latencies.items():
+            with self._lock:
+                self.latencies[name].extend(latencies)
+
+    def start_profile(self, name):
+        """
+        :return: cProfile.Profile enabled for the stage, or None if the stage is not profiled
+        """
+        if self.profile_dir is None or self._profiling or threading.current_thread() is not threading.main_thread():
+            return None
+        self._profiling = True
+        profile = self._profiles.setdefault(name, cProfile.Profile())
+        profile.enable()
+        return profile
+
+    def stop_profile(self, profile):
+        profile.disable()
+        self._profiling = False
+
+    def summary(self):
+        """
+        :return: dict. Stages, latency percentiles and peak RSS, ready to be saved as json
+        """
+        # Only needed for the percentiles, so that the runs that do not save metrics do not load numpy
+        import numpy as np
+
+        latencies = dict()
+        for name, values in self.latencies.items():
+            values = np.array(values)
+            latencies[name] = {'count': len(values), 'mean_s': float(values.mean()),
+                               'p50_s': float(np.percentile(values, 50)), 'p90_s': float(np.percentile(values, 90)),
+                               'p99_s': float(np.percentile(values, 99)), 'max_s': float(values.max())}
+        # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+        unit = 1 if sys.platform == 'darwin' else 1024
+        return {'total_wall_s': time.perf_counter() - self.start,
+                'stages': self.stages,
+                'latencies': latencies,
+                'peak_rss_bytes': unit * resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                'peak_rss_children_bytes': unit * resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+                'profiles': {name: os.path.join(self.profile_dir, name + '.prof') for name in self._profiles}}
+
+    def save(self, path):
+        """
+        Save the summary to a json file and the profiles of the stages to the profile folder
+        :param path: str. Path to the json file
+        :return: None
+        """
+        if self.profile_dir is not None:
+            os.makedirs(self.profile_dir, exist_ok=True)
+            for name, profile in self._profiles.items():
+                profile.dump_stats(os.path.join(self.profile_dir, name + '.prof'))
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+
+    def __getstate__(self):
+        # Only the collected values are sent back from worker processes
+        return {'stages': self.stages, 'latencies': dict(self.latencies)}
+
+    def __setstate__(self, state):
+        self.__init__()
+        self.stages.update(state['stages'])
+        self.latencies.update(state['latencies'])
+
+
+def enable(profile_dir=None):
+    """
+    Start collecting metrics in this process
+    :param profile_dir: str. Folder of the cProfile stats of each stage (optional)
+    :return: Metrics
+    """
+    global _metrics
+    _metrics = Metrics(profile_dir)
+    return _metrics
+
+
+def enabled():
+    return _metrics is not None
+
+
+def cpu_seconds():
+    """
+    :return: float. User and system CPU time of this process and of its finished child processes in seconds
+    """
+    return sum(r.ru_utime + r.ru_stime for r in (resource.getrusage(resource.RUSAGE_SELF),
+                                                 resource.getrusage(resource.RUSAGE_CHILDREN)))
+
+
+@contextlib.contextmanager
+def stage(name, bytes_in=0, latency=False):
+    """
+    Measure a stage. Does nothing if the metrics are not enabled
+    :param name: str. Name of the stage
+    :param bytes_in: int. Bytes read by the stage (more can be added to the yielded dict)
+    :param latency: bool. Also record the wall time of this call as a latency of the stage
+    :return: dict with 'bytes_in' and 'bytes_out' keys, that the stage can increase
+    """
+    counts = {'bytes_in': bytes_in, 'bytes_out': 0}
+    metrics = _metrics
+    if metrics is None:
+        yield counts
+        return
+    profile = metrics.start_profile(name)
+    cpu_start = cpu_seconds()
+    start = time.perf_counter()
+    try:
+        yield counts
+    finally:
+        wall_s = time.perf_counter() - start
+        metrics.add(name, wall_s, cpu_seconds() - cpu_start, counts['bytes_in'], counts['bytes_out'])
+        if latency:
+            metrics.add_latency(name, wall_s)
+        if profile is not None:
+            metrics.stop_profile(profile)
+
+
+def add_bytes(name, bytes_in=0, bytes_out=0):
+    """
+    Count the bytes of a stage without measuring its time (e.g. for work done in background threads)
+    """
+    if _metrics is not None:
+        _metrics.add(name, bytes_in=bytes_in, bytes_out=bytes_out, calls=0)
+
+
+def timed_iter(name, iterable, size=None):
+    """
+    Measure the time spent producing each item of an iterable as a stage (e.g. decoding the frames of a file)
+    :param name: str. Name of the stage
+    :param iterable: iterable
+    :param size: function that returns the size of an item in bytes, counted as bytes out (optional)
+    :return: generator with the same items
+    """
+    metrics = _metrics
+    if metrics is None:
+        yield from iterable
+        return
+    iterator = iter(iterable)
+    while True:
+        cpu_start = cpu_seconds()
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        metrics.add(name, time.perf_counter() - start, cpu_seconds() - cpu_start,
+                    bytes_out=size(item) if size is not None else 0)
+        yield item
+
+
+def run_measured(function, *args):
+    """
+    Run a function in a worker process collecting its metrics, so that they can be merged in the main process
+    :return: 2-tuple: result of the function, Metrics
+    """
+    global _metrics
+    previous, _metrics = _metrics, Metrics()
+    try:
+        return function(*args), _metrics
+    finally:
+        _metrics = previous
+
+
+def submit(executor, function, *args):
+    """
+    Same as executor.submit, but the metrics of the job are collected if they are enabled. The result of the job
+    must be read with job_result
+    :return: Future
+    """
+    if _metrics is None:
+        return executor.submit(function, *args)
+    job = executor.submit(run_measured, function, *args)
+    job.measured = True
+    return job
+
+
+def job_result(job):
+    """
+    Result of a job created by submit, merging its metrics
+    :param job: Future
+    :return: result of the function
+    """
+    if not getattr(job, 'measured', False):
+        return job.result()
+    result, metrics = job.result()
+    if _metrics is not None:
+        _metrics.merge(metrics)
+    return result
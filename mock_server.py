@@ -0,0 +1,348 @@
+"""
+Local stand-in for the evaluation server, to test and load-test the client pipeline without sending data to the real
+server. It speaks the same protocol as the real server:
+* POST /new with a json body {'sender': access_key}: returns a new SessionID
+* POST /upload with a multipart/form-data body (chunked or with a Content-Length) that contains the zip file, and the
+SessionId and AccessKey headers: validates the zip file and returns the results url
+* GET/HEAD /results/<SessionID>.zip: 404 until the results are ready (after --delay seconds), then the results zip
+file with the <SessionID>_study.csv and <SessionID>_dicom.csv files, with Range support
+No model is run: the scores and boxes are derived from the hashes of the files. Example of use:
+python mock_server.py --port 8000 --delay 30
+python deploy_evaluation.py --server http://127.0.0.1:8000 --input /my/local/dicom_data --output /my/local/output/folder
+--access_key XXX
+"""
+import argparse
+import http.server
+import io
+import itertools
+import json
+import os
+import pickle
+import re
+import shutil
+import tempfile
+import threading
+import time
+import zipfile
+
+import pandas as pd
+
+from deploy_constants import MAX_FILE_SIZE_BYTES, MAX_STUDIES, MAX_IMAGES
+
+# Names of the members of the uploaded zip file
+STUDY_METADATA_PATTERN = re.compile(r'^([0-9a-f]{8})/study_metadata\.pkl$')
+FRAME_PATTERN = re.compile(r'^([0-9a-f]{8})/([0-9a-f]{8})/frame_(\d+)\.npy$')
+DBT_SOP_CLASS_UID = '1.2.840.10008.5.1.4.1.1.13.1.3'
+COPY_CHUNK_SIZE = 2**20
+
+
+def validate_upload(zip_path, max_studies=MAX_STUDIES, max_images=MAX_IMAGES):
+    """
+    Check the layout of an uploaded zip file: every study folder has a study_metadata.pkl, the metadata of every file
+    points to its frames, and the evaluation limits are respected
+    :param zip_path: str. Path to the zip file
+    :param max_studies: int. Max number of studies
+    :param max_images: int. Max number of images
+    :return: DataFrame. Metadata of all the files (concatenated study_metadata.pkl files)
+    """
+    if os.path.getsize(zip_path) > MAX_FILE_SIZE_BYTES:
+        raise Exception("The zip file exceeds the max file size")
+    with zipfile.ZipFile(zip_path) as zip_fp:
+        names = zip_fp.namelist()
+        frames = set()
+        study_metadata = []
+        for name in names:
+            match = FRAME_PATTERN.match(name)
+            if match:
+                frames.add((match.group(1), match.group(2), int(match.group(3))))
+                continue
+            if not STUDY_METADATA_PATTERN.match(name):
+                raise Exception(f"Unexpected file in the zip file: {name}")
+            study_metadata.append(pickle.loads(zip_fp.read(name)))
+    if len(study_metadata) == 0:
+        raise Exception("The zip file does not contain any study")
+    if len(study_metadata) > max_studies:
+        raise Exception(f"Max number of studies exceeded ({len(study_metadata)} > {max_studies})")
+    metadata = pd.concat(study_metadata, ignore_index=True)
+    if len(metadata) > max_images:
+        raise Exception(f"Max number of images exceeded ({len(metadata)} > {max_images})")
+
+    files_with_frames = set((study_hash, dcm_hash) for study_hash, dcm_hash, _ in frames)
+    for _, row in metadata.iterrows():
+        key = (row['StudyInstanceUID'], row['SOPInstanceUID'])
+        if row['np_paths'] != '/'.join(key):
+            raise Exception(f"Inconsistent metadata for file {key[1]}")
+        if key not in files_with_frames:
+            raise Exception(f"No frames found for file {key[1]}")
+        num_frames = int(row['NumberOfFrames'] or 1) if row['SOPClassUID'] == DBT_SOP_CLASS_UID else 1
+        missing = [i for i in range(num_frames) if key + (i,) not in frames]
+        if len(missing) > 0:
+            raise Exception(f"{len(missing)} frames missing for file {key[1]}")
+    return metadata
+
+
+def hash_score(path_hash):
+    """
+    :return: float. Deterministic score in [0, 1) derived from a hash
+    """
+    return int(path_hash, 16) % 1000 / 1000
+
+
+def make_results(session_id, metadata):
+    """
+    Results zip file of a session, with the same columns as the real results
+    :param session_id: str. SessionID
+    :param metadata: DataFrame. Metadata of the uploaded files (see validate_upload)
+    :return: bytes
+    """
+    dicom_rows = []
+    for _, row in metadata.iterrows():
+        rows, cols = int(row['Rows'] or 100), int(row['Columns'] or 100)
+        is_dbt = row['SOPClassUID'] == DBT_SOP_CLASS_UID
+        dicom_rows.append({'StudyInstanceUID': row['StudyInstanceUID'], 'SOPInstanceUID': row['SOPInstanceUID'],
+                           'x1': cols // 4, 'y1': rows // 4, 'x2': cols // 2, 'y2': rows // 2,
+                           'slice': int(row['NumberOfFrames'] or 1) // 2 if is_dbt else -1,
+                           'score': hash_score(row['SOPInstanceUID'])})
+    dicom_df = pd.DataFrame(dicom_rows, columns=['StudyInstanceUID', 'SOPInstanceUID', 'x1', 'y1', 'x2', 'y2',
+                                                 'slice', 'score'])
+    study_df = dicom_df.groupby('StudyInstanceUID', as_index=False, sort=False)['score'].max()
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_DEFLATED) as zip_fp:
+        zip_fp.writestr(f'{session_id}_study.csv', study_df.to_csv(index=False))
+        zip_fp.writestr(f'{session_id}_dicom.csv', dicom_df.to_csv(index=False))
+    return buffer.getvalue()
+
+
+class MockServer(http.server.ThreadingHTTPServer):
+    """
+    HTTP server with the state of the sessions
+    """
+    daemon_threads = True
+
+    def __init__(self, address, delay=0, access_keys=None, storage_dir=None, verbose=False):
+        """
+        :param address: tuple. Host and port
+        :param delay: float. Time between the end of an upload and the results being available in seconds
+        :param access_keys: list of str. Accepted access keys (default: any)
+        :param storage_dir: str. Folder where the uploads are saved while they are validated (default: temp folder)
+        :param verbose: bool. Log the requests
+        """
+        super().__init__(address, MockRequestHandler)
+        self.delay = delay
+        self.verbose = verbose
+        self.access_keys = set(access_keys) if access_keys else None
+        self.storage_dir = storage_dir or tempfile.mkdtemp(prefix='mock_server_')
+        # SessionID -> dict with the access key, the results (bytes) and the time they are available
+        self.sessions = dict()
+        self.lock = threading.Lock()
+        self._counter = itertools.count(1)
+        self.stats = {'sessions': 0, 'uploads': 0, 'rejected_uploads': 0, 'uploaded_bytes': 0, 'result_downloads': 0}
+
+    def new_session(self, access_key):
+        with self.lock:
+            session_id = f"mock{next(self._counter):06d}"
+            self.sessions[session_id] = {'access_key': access_key, 'results': None, 'ready_time': None}
+            self.stats['sessions'] += 1
+        return session_id
+
+    def count(self, stat, value=1):
+        with self.lock:
+            self.stats[stat] += value
+
+
+class MockRequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def reply(self, body, status=200, headers=None):
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or dict()).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def iter_body(self):
+        """
+        Read the request body, with chunked transfer encoding or a Content-Length
+        :return: generator of bytes
+        """
+        if 'chunked' in self.headers.get('Transfer-Encoding', '').lower():
+            while True:
+                size = int(self.rfile.readline().split(b';')[0].strip(), 16)
+                if size == 0:
+                    # Trailers end with an empty line
+                    while self.rfile.readline() not in (b'\r\n', b'\n', b''):
+                        pass
+                    return
+                while size > 0:
+                    chunk = self.rfile.read(min(size, COPY_CHUNK_SIZE))
+                    if not chunk:
+                        raise Exception("Connection closed during the upload")
+                    size -= len(chunk)
+                    yield chunk
+                self.rfile.readline()
+        else:
+            remaining = int(self.headers.get('Content-Length', 0))
+            while remaining > 0:
+                chunk = self.rfile.read(min(remaining, COPY_CHUNK_SIZE))
+                if not chunk:
+                    raise Exception("Connection closed during the upload")
+                remaining -= len(chunk)
+                yield chunk
+
+    def save_multipart_file(self, path):
+        """
+        Save the file of a multipart/form-data body (a single file part, as sent by the client) without keeping the
+        body in memory
+        :param path: str. Path to the output file
+        :return: int. Size of the body in bytes
+        """
+        match = re.search(r'boundary="?([^";]+)"?', self.headers.get('Content-Type', ''))
+        if match is None:
+            raise Exception("multipart/form-data body expected")
+        delimiter = b'\r\n--' + match.group(1).encode('utf-8')
+        body_path = path + '.body'
+        size = 0
+        with open(body_path, 'wb') as f:
+            for chunk in self.iter_body():
+                f.write(chunk)
+                size += len(chunk)
+        try:
+            with open(body_path, 'rb') as f:
+                head = f.read(64 * 1024)
+                start = head.find(b'\r\n\r\n')
+                if not head.startswith(delimiter[2:]) or start < 0:
+                    raise Exception("Malformed multipart body")
+                start += 4
+                # The file ends at the closing delimiter, at the end of the body
+                f.seek(max(0, size - len(delimiter) - 64))
+                tail_offset = f.tell()
+                end = f.read().rfind(delimiter)
+                if end < 0 or tail_offset + end < start:
+                    raise Exception("Malformed multipart body")
+                remaining = tail_offset + end - start
+                f.seek(start)
+                with open(path, 'wb') as out:
+                    while remaining > 0:
+                        chunk = f.read(min(remaining, COPY_CHUNK_SIZE))
+                        out.write(chunk)
+                        remaining -= len(chunk)
+        finally:
+            os.remove(body_path)
+        return size
+
+    def do_POST(self):
+        try:
+            if self.path == '/new':
+                request = json.loads(b''.join(self.iter_body()).decode('utf-8') or '{}')
+                access_key = request.get('sender')
+                if self.server.access_keys is not None and access_key not in self.server.access_keys:
+                    return self.reply("ERROR: Invalid access key")
+                return self.reply(self.server.new_session(access_key))
+            if self.path == '/upload':
+                return self.upload()
+            self.reply("Not found", 404)
+        except Exception as ex:
+            self.close_connection = True
+            self.reply(f"ERROR: {ex}")
+
+    def upload(self):
+        session_id = self.headers.get('SessionId')
+        with self.server.lock:
+            session = self.server.sessions.get(session_id)
+        if session is None:
+            # Read the body anyway, so the client gets the response
+            for _ in self.iter_body():
+                pass
+            return self.reply("ERROR: Unknown session")
+        zip_path = os.path.join(self.server.storage_dir, session_id + '.zip')
+        try:
+            self.server.count('uploaded_bytes', self.save_multipart_file(zip_path))
+            if session['access_key'] != self.headers.get('AccessKey'):
+                raise Exception("The access key does not match the session")
+            metadata = validate_upload(zip_path)
+        except Exception as ex:
+            self.server.count('rejected_uploads')
+            return self.reply(f"ERROR: {ex}")
+        finally:
+            if os.path.exists(zip_path):
+                os.remove(zip_path)
+        results = make_results(session_id, metadata)
+        with self.server.lock:
+            session['results'] = results
+            session['ready_time'] = time.monotonic() + self.server.delay
+            self.server.stats['uploads'] += 1
+        host = self.headers.get('Host', '{}:{}'.format(*self.server.server_address))
+        self.reply(f"http://{host}/results/{session_id}.zip")
+
+    def do_GET(self):
+        match = re.match(r'^/results/([^/]+)\.zip$', self.path)
+        with self.server.lock:
+            session = self.server.sessions.get(match.group(1)) if match else None
+        if session is None or session['results'] is None or time.monotonic() < session['ready_time']:
+            return self.reply(b'', 404)
+        results = session['results']
+        etag = '"{}-{}"'.format(match.group(1), len(results))
+        headers = {'ETag': etag, 'Accept-Ranges': 'bytes', 'Content-Type': 'application/zip'}
+        range_match = re.match(r'^bytes=(\d+)-(\d*)$', self.headers.get('Range', ''))
+        if range_match and self.headers.get('If-Range', etag) == etag:
+            start = int(range_match.group(1))
+            end = int(range_match.group(2)) if range_match.group(2) else len(results) - 1
+            if start >= len(results):
+                headers['Content-Range'] = f'bytes */{len(results)}'
+                return self.reply(b'', 416, headers)
+            headers['Content-Range'] = f'bytes {start}-{min(end, len(results) - 1)}/{len(results)}'
+            return self.reply(results[start:end + 1], 206, headers)
+        if self.command == 'GET':
+            self.server.count('result_downloads')
+        self.reply(results, 200, headers)
+
+    do_HEAD = do_GET
+
+
+def start_server(host='127.0.0.1', port=0, delay=0, access_keys=None, storage_dir=None, verbose=False):
+    """
+    Start a mock server in a background thread
+    :param host: str. Host to listen on
+    :param port: int. Port to listen on (0: any free port)
+    :param delay: float. Time between the end of an upload and the results being available in seconds
+    :param access_keys: list of str. Accepted access keys (default: any)
+    :param storage_dir: str. Folder where the uploads are saved while they are validated (default: temp folder)
+    :param verbose: bool. Log the requests
+    :return: MockServer. Its url is http://<host>:<server.server_address[1]>
+    """
+    server = MockServer((host, port), delay, access_keys, storage_dir, verbose)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local stand-in for the evaluation server')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='Host to listen on (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=8000, help='Port to listen on (default: 8000)')
+    parser.add_argument('--delay', type=float, default=10,
+                        help='Seconds between the end of an upload and the results being available (default: 10)')
+    parser.add_argument('--access_keys', type=str, nargs='+', help='Accepted access keys (default: any)')
+    parser.add_argument('--storage_dir', type=str,
+                        help='Directory where the uploads are saved while they are validated (default: temp directory)')
+    parser.add_argument('--verbose', action='store_true', help='Log the requests')
+    args = parser.parse_args()
+
+    server = MockServer((args.host, args.port), args.delay, args.access_keys, args.storage_dir, args.verbose)
+    print(f"Mock evaluation server listening on http://{args.host}:{args.port} (results after {args.delay} s)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.storage_dir is None:
+            shutil.rmtree(server.storage_dir, ignore_errors=True)
+        print(json.dumps(server.stats))
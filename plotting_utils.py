@@ -1,34 +1,388 @@
 import os
-import cv2
-import pydicom
+import json
 import argparse
 import numpy as np
-import pandas as pd
-from PIL import Image
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
+import image_args_utils
+import manifest_utils
+import metrics_utils
 
-def plot_and_save_ims(bbox_df, output_dir):
+# cv2, PIL, pydicom, utils and pandas are imported in the functions that use them, so that PreprocessedFrames can be
+# used without loading them
+
+
+class PreprocessedFrames(object):
+    """
+    Finds the frames saved when the dicom files were preprocessed (in the preprocess folders or in the preprocessing
+    cache), so that the images can be plotted without decoding the dicom files again.
+    The frames are found by the hashes of the study and file paths, the same ones saved in the manifest of the session.
+    It only holds paths, so it can be sent to worker processes.
+    """
+
+    def __init__(self, preprocess_dirs=(), cache=None):
+        """
+        :param preprocess_dirs: list of str. Folders with the preprocessed files (see archive_utils.DirectoryWriter)
+        :param cache: cache_utils.PreprocessCache. Preprocessing cache (optional)
+        """
+        self.preprocess_dirs = list(preprocess_dirs)
+        self.cache = cache
+
+    def find(self, file_path, slice_num):
+        """
+        :param file_path: str. The absolute path to the dicom file
+        :param slice_num: int. Index of the frame
+        :return: str. Path to the .npy file of the preprocessed frame, or None if it is not available
+        """
+        study_path_hash = manifest_utils.create_hash(os.path.dirname(file_path))
+        arcname = manifest_utils.frame_arcname(study_path_hash, manifest_utils.create_hash(file_path), slice_num)
+        for preprocess_dir in self.preprocess_dirs:
+            frame_path = os.path.join(preprocess_dir, arcname)
+            if os.path.isfile(frame_path):
+                return frame_path
+        if self.cache is not None:
+            return self.cache.find(file_path, study_path_hash, arcname)
+        return None
+
+
+def preprocess_dirs(preprocess_dir):
+    """
+    :param preprocess_dir: str. Folder with the preprocessed files (--preprocess_dir)
+    :return: list of str. The folder and its shard subfolders (see deploy_evaluation)
+    """
+    if not os.path.isdir(preprocess_dir):
+        return []
+    return [preprocess_dir] + sorted(entry.path for entry in os.scandir(preprocess_dir)
+                                     if entry.is_dir() and entry.name.startswith('shard_'))
+
+
+def plot_and_save_ims(bbox_df, output_dir, workers=1, frames=None, image_format='png', png_compress_level=6,
+                      quality=90, max_dim=None, image_output='image', tile_size=512, strip_slices=2):
     """
     Plots and saved predicted bounding boxes and scores on dicom images
     :param bbox_df: DataFrame. A DataFrame with the columns ['file_path', 'x1', 'y1', 'x2', 'y2', 'score', 'slice'],
     where file_path is the absolute path to the dicom file
     :param output_dir: str. The absolute path to the output directory to which the images will be saved
+    :param workers: int. Number of processes used to generate the images (1 generates them in the main process)
+    :param frames: PreprocessedFrames. Preprocessed frames used instead of decoding the dicom files (optional)
+    :param image_format: str. Format of the images: 'png', 'jpeg' or 'webp'
+    :param png_compress_level: int. zlib compression level of the png images (0-9, lower is faster)
+    :param quality: int. Quality of the jpeg and webp images (1-100)
+    :param max_dim: int. If set, the images are downscaled so that their largest side is at most max_dim pixels
+    (not used by the review output)
+    :param image_output: str. 'image': one plotted image per dicom file. 'review': tile pyramid of each image, DBT
+    slice strips and one montage per study (see save_review_im)
+    :param tile_size: int. Size of the tiles of the review output, in pixels
+    :param strip_slices: int. Number of slices on each side of the box slice in the DBT strips of the review output
     :return: None
     """
     assert all([col in bbox_df.columns for col in ['file_path', 'x1', 'y1', 'x2', 'y2', 'score', 'slice']]), \
         'The expected columns in the bbox DF were not all found'
-    files = bbox_df[bbox_df['score'].notnull()].groupby('file_path').apply(lambda df: df.loc[df['score'].idxmax()])
-    for index, row in files.iterrows():
-        if row.isnull().any():
-            # No predictions available for this image
-            continue
-        im = load_im(row['file_path'], int(row['slice']))
-        im = plot_box(im, row['x1'], row['y1'], row['x2'], row['y2'], row['score'])
-        path_head, fname = os.path.split(row['file_path'])
-        _, file_dirname = os.path.split(path_head)
-        if not os.path.isdir(os.path.join(output_dir, file_dirname)):
-            os.makedirs(os.path.join(output_dir, file_dirname))
-        Image.fromarray(im).save(os.path.join(output_dir, file_dirname, fname + '_plot.png'))
+    assert image_format in image_args_utils.IMAGE_EXTENSIONS, 'Unknown image format {}'.format(image_format)
+    assert image_output in image_args_utils.IMAGE_OUTPUTS, 'Unknown image output {}'.format(image_output)
+    from PIL import features
+    if image_format == 'webp' and not features.check('webp'):
+        raise Exception('WebP images are not supported by the installed version of Pillow')
+    save_options = (image_format, png_compress_level, quality, max_dim)
+    # Box with the highest score of each file
+    boxes = bbox_df[bbox_df['score'].notnull()]
+    files = boxes.loc[boxes.groupby('file_path')['score'].idxmax()]
+    # No predictions available for the images with missing values
+    files = files[files[['x1', 'y1', 'x2', 'y2', 'slice']].notnull().all(axis=1)]
+    rows = files[['file_path', 'x1', 'y1', 'x2', 'y2', 'score', 'slice']].to_dict('records')
+
+    if image_output == 'review':
+        plot_fn = save_review_im
+        save_options = (image_format, png_compress_level, quality, tile_size, strip_slices)
+    else:
+        plot_fn = plot_and_save_im
+
+    # Thumbnails of the review output, by study folder
+    thumbnails = dict()
+    if workers > 1 and len(rows) > 1:
+        for row, result in run_plot_jobs(plot_fn, rows, workers, output_dir, frames, *save_options):
+            collect_plot_result(row, result, thumbnails)
+    else:
+        for row in rows:
+            collect_plot_result(row, plot_fn(row, output_dir, frames, *save_options), thumbnails)
+
+    for study_dirname, study_thumbnails in thumbnails.items():
+        path = os.path.join(output_dir, study_dirname, 'montage' + image_args_utils.IMAGE_EXTENSIONS[image_format])
+        error = save_montage([im for _, im in sorted(study_thumbnails)], path, image_format, png_compress_level,
+                             quality)
+        if error is not None:
+            print('Montage {} could not be saved: {}'.format(path, error))
+
+
+def run_plot_jobs(plot_fn, rows, workers, *args):
+    """
+    Runs plot_fn for each row in worker processes. If a worker process dies (e.g. out of memory on a large DBT file
+    or a crash of a decoder), the images that were not generated are generated again in a single worker process, and
+    the image that makes the process die again is run on its own and reported as failed
+    :param plot_fn: function. plot_and_save_im or save_review_im
+    :param rows: list of dict. Rows of the bbox DF (see plot_and_save_ims)
+    :param workers: int. Number of processes
+    :param args: arguments of plot_fn after the row
+    :return: generator of (row, result of plot_fn or BrokenProcessPool) tuples
+    """
+    remaining = rows
+    while remaining:
+        broken = []
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            jobs = [metrics_utils.submit(executor, plot_fn, row, *args) for row in remaining]
+            for row, job in zip(remaining, jobs):
+                try:
+                    result = metrics_utils.job_result(job)
+                except BrokenProcessPool:
+                    broken.append(row)
+                    continue
+                yield row, result
+        if len(broken) == 0:
+            break
+        if workers == 1 or len(broken) == 1:
+            # The jobs of a single process run in order, so the first broken image is the likely cause
+            row = broken.pop(0)
+            with ProcessPoolExecutor(max_workers=1) as executor:
+                job = metrics_utils.submit(executor, plot_fn, row, *args)
+                try:
+                    result = metrics_utils.job_result(job)
+                except BrokenProcessPool as ex:
+                    result = ex
+            yield row, result
+        if broken:
+            print('A worker process died, generating the remaining {} images again'.format(len(broken)))
+        remaining = broken
+        workers = 1
+
+
+def collect_plot_result(row, result, thumbnails):
+    """
+    Reports the error of an image and keeps the thumbnail of the review output
+    :param row: dict. Row of the bbox DF (see plot_and_save_ims)
+    :param result: Exception or None (plot_and_save_im or a worker process that died), or 2-tuple: Exception or None,
+    thumbnail (save_review_im)
+    :param thumbnails: dict. Study folder name -> list of (file path, thumbnail) tuples
+    :return: None
+    """
+    if isinstance(result, tuple):
+        result, thumbnail = result
+        if thumbnail is not None:
+            study_dirname = os.path.basename(os.path.dirname(row['file_path']))
+            thumbnails.setdefault(study_dirname, []).append((row['file_path'], thumbnail))
+    report_plot_error(row, result)
+
+
+def plot_and_save_im(row, output_dir, frames=None, image_format='png', png_compress_level=6, quality=90,
+                     max_dim=None):
+    """
+    Plots and saves the bounding box and score of one dicom image. Errors are returned instead of raised, so that
+    one image that cannot be plotted does not stop the rest
+    :param row: dict. Row of the bbox DF (see plot_and_save_ims)
+    :param output_dir: str. The absolute path to the output directory to which the image will be saved
+    :param frames: PreprocessedFrames. Preprocessed frames used instead of decoding the dicom files (optional)
+    :param image_format: str. Format of the image: 'png', 'jpeg' or 'webp'
+    :param png_compress_level: int. zlib compression level of the png image (0-9, lower is faster)
+    :param quality: int. Quality of the jpeg and webp images (1-100)
+    :param max_dim: int. If set, the image is downscaled so that its largest side is at most max_dim pixels
+    :return: Exception if the image could not be plotted, otherwise None
+    """
+    import cv2
+
+    try:
+        with metrics_utils.stage('plot_image', latency=True):
+            with metrics_utils.stage('load_image'):
+                im = load_im(row['file_path'], int(row['slice']), frames)
+            with metrics_utils.stage('draw'):
+                scale = 1.0 if max_dim is None else min(1.0, max_dim / max(im.shape))
+                if scale < 1:
+                    # Downscale before drawing, so that the 3-channel image is only allocated at the output size.
+                    # The box and the text are scaled with the image
+                    im = cv2.resize(im, (max(1, round(im.shape[1] * scale)), max(1, round(im.shape[0] * scale))),
+                                    interpolation=cv2.INTER_AREA)
+                im = draw_box(im, row, scale)
+            path_head, fname = os.path.split(row['file_path'])
+            _, file_dirname = os.path.split(path_head)
+            os.makedirs(os.path.join(output_dir, file_dirname), exist_ok=True)
+            path = os.path.join(output_dir, file_dirname,
+                                fname + '_plot' + image_args_utils.IMAGE_EXTENSIONS[image_format])
+            with metrics_utils.stage('encode', bytes_in=im.nbytes) as counts:
+                save_im(im, path, image_format, png_compress_level, quality)
+                counts['bytes_out'] = os.path.getsize(path)
+    except Exception as ex:
+        return ex
+    return None
+
+
+def save_review_im(row, output_dir, frames=None, image_format='png', png_compress_level=6, quality=90, tile_size=512,
+                   strip_slices=2):
+    """
+    Saves the review output of one dicom image, decoding the dicom file once (or loading its preprocessed frames):
+    - <study folder>/<file name>_tiles/: tile pyramid of the plotted image. Level 0 has the full resolution, and each
+      level halves the size of the previous one until the image fits in one tile. Tiles are saved as
+      <level>/<column>_<row>.<ext>, and pyramid.json describes the pyramid
+    - <study folder>/<file name>_strip.<ext>: DBT files only. Low resolution strip of the slices around the box slice
+    Errors are returned instead of raised (see plot_and_save_im)
+    :param row: dict. Row of the bbox DF (see plot_and_save_ims)
+    :param output_dir: str. The absolute path to the output directory to which the images will be saved
+    :param frames: PreprocessedFrames. Preprocessed frames used instead of decoding the dicom files (optional)
+    :param image_format: str. Format of the images: 'png', 'jpeg' or 'webp'
+    :param png_compress_level: int. zlib compression level of the png images (0-9, lower is faster)
+    :param quality: int. Quality of the jpeg and webp images (1-100)
+    :param tile_size: int. Size of the tiles, in pixels
+    :param strip_slices: int. Number of slices on each side of the box slice in the DBT strip
+    :return: 2-tuple: Exception if the image could not be plotted, otherwise None. Thumbnail (top level of the
+    pyramid, 3-channel array of dtype uint8), or None
+    """
+    try:
+        with metrics_utils.stage('plot_image', latency=True):
+            with metrics_utils.stage('load_image'):
+                slice_num, ims = load_ims(row['file_path'], int(row['slice']), frames, neighbors=strip_slices)
+            path_head, fname = os.path.split(row['file_path'])
+            _, file_dirname = os.path.split(path_head)
+            study_dir = os.path.join(output_dir, file_dirname)
+            thumbnail = save_tile_pyramid(ims[slice_num], row, os.path.join(study_dir, fname + '_tiles'),
+                                          image_format, png_compress_level, quality, tile_size)
+            if len(ims) > 1:
+                save_strip(ims, slice_num, row, os.path.join(study_dir, fname + '_strip' +
+                                                              image_args_utils.IMAGE_EXTENSIONS[image_format]),
+                           image_format, png_compress_level, quality, tile_size)
+    except Exception as ex:
+        return ex, None
+    return None, thumbnail
+
+
+def save_tile_pyramid(im, row, tiles_dir, image_format='png', png_compress_level=6, quality=90, tile_size=512):
+    """
+    Saves the tile pyramid of a plotted image (see save_review_im)
+    :param im: numpy array. 2D array of dtype uint8
+    :param row: dict. Row of the bbox DF, with the box drawn on every level
+    :param tiles_dir: str. Output folder of the pyramid
+    :param image_format: str. 'png', 'jpeg' or 'webp'
+    :param png_compress_level: int. zlib compression level of the png images (0-9, lower is faster)
+    :param quality: int. Quality of the jpeg and webp images (1-100)
+    :param tile_size: int. Size of the tiles, in pixels
+    :return: numpy array. Top level of the pyramid (3-channel array of dtype uint8)
+    """
+    import cv2
+
+    assert tile_size > 0, 'The tile size must be positive, got {}'.format(tile_size)
+    height, width = im.shape
+    level = 0
+    while True:
+        with metrics_utils.stage('draw'):
+            scale = im.shape[1] / width
+            plotted = draw_box(im, row, scale)
+        level_dir = os.path.join(tiles_dir, str(level))
+        os.makedirs(level_dir, exist_ok=True)
+        with metrics_utils.stage('encode', bytes_in=plotted.nbytes) as counts:
+            for y in range(0, plotted.shape[0], tile_size):
+                for x in range(0, plotted.shape[1], tile_size):
+                    path = os.path.join(level_dir, '{}_{}{}'.format(x // tile_size, y // tile_size,
+                                                                   image_args_utils.IMAGE_EXTENSIONS[image_format]))
+                    save_im(np.ascontiguousarray(plotted[y:y + tile_size, x:x + tile_size]), path, image_format,
+                            png_compress_level, quality)
+                    counts['bytes_out'] += os.path.getsize(path)
+        if max(im.shape) <= tile_size:
+            break
+        # Each level is downscaled from the previous one, not from the full resolution image
+        im = cv2.resize(im, (max(1, im.shape[1] // 2), max(1, im.shape[0] // 2)), interpolation=cv2.INTER_AREA)
+        level += 1
+
+    with open(os.path.join(tiles_dir, 'pyramid.json'), 'w') as f:
+        json.dump({'width': width, 'height': height, 'tile_size': tile_size, 'levels': level + 1,
+                   'format': image_format, 'extension': image_args_utils.IMAGE_EXTENSIONS[image_format]}, f, indent=2)
+    return plotted
+
+
+def save_strip(ims, slice_num, row, path, image_format='png', png_compress_level=6, quality=90, tile_size=512):
+    """
+    Saves the slices of a DBT file side by side, downscaled to fit in a tile. The box is drawn on its slice
+    :param ims: dict. Frame index -> 2D array of dtype uint8
+    :param slice_num: int. Index of the frame of the box
+    :param row: dict. Row of the bbox DF
+    :param path: str. Path to the output image
+    :param image_format: str. 'png', 'jpeg' or 'webp'
+    :param png_compress_level: int. zlib compression level of the png image (0-9, lower is faster)
+    :param quality: int. Quality of the jpeg and webp images (1-100)
+    :param tile_size: int. Largest side of each slice, in pixels
+    :return: None
+    """
+    import cv2
+
+    with metrics_utils.stage('draw'):
+        slices = []
+        for i in sorted(ims):
+            im = ims[i]
+            scale = min(1.0, tile_size / max(im.shape))
+            if scale < 1:
+                im = cv2.resize(im, (max(1, round(im.shape[1] * scale)), max(1, round(im.shape[0] * scale))),
+                                interpolation=cv2.INTER_AREA)
+            if i == slice_num:
+                im = draw_box(im, row, scale)
+            else:
+                im = cv2.cvtColor(im, cv2.COLOR_GRAY2RGB)
+            slices.append(im)
+        strip = np.concatenate(slices, axis=1)
+    with metrics_utils.stage('encode', bytes_in=strip.nbytes) as counts:
+        save_im(strip, path, image_format, png_compress_level, quality)
+        counts['bytes_out'] = os.path.getsize(path)
+
+
+def save_montage(thumbnails, path, image_format='png', png_compress_level=6, quality=90, gap=8):
+    """
+    Saves the thumbnails of the images of a study side by side, resized to the same height
+    :param thumbnails: list of numpy arrays. 3-channel arrays of dtype uint8
+    :param path: str. Path to the output image
+    :param image_format: str. 'png', 'jpeg' or 'webp'
+    :param png_compress_level: int. zlib compression level of the png image (0-9, lower is faster)
+    :param quality: int. Quality of the jpeg and webp images (1-100)
+    :param gap: int. Black space between the thumbnails, in pixels
+    :return: Exception if the montage could not be saved, otherwise None
+    """
+    import cv2
+
+    try:
+        height = min(im.shape[0] for im in thumbnails)
+        columns = []
+        for im in thumbnails:
+            if im.shape[0] != height:
+                im = cv2.resize(im, (max(1, round(im.shape[1] * height / im.shape[0])), height),
+                                interpolation=cv2.INTER_AREA)
+            if columns:
+                columns.append(np.zeros((height, gap, 3), dtype=np.uint8))
+            columns.append(im)
+        save_im(np.concatenate(columns, axis=1), path, image_format, png_compress_level, quality)
+    except Exception as ex:
+        return ex
+    return None
+
+
+def save_im(im, path, image_format='png', png_compress_level=6, quality=90):
+    """
+    Saves a plotted image
+    :param im: numpy array. 3-channel array of dtype uint8
+    :param path: str. Path to the output image
+    :param image_format: str. 'png', 'jpeg' or 'webp'
+    :param png_compress_level: int. zlib compression level of the png image (0-9, lower is faster)
+    :param quality: int. Quality of the jpeg and webp images (1-100)
+    :return: None
+    """
+    from PIL import Image
+
+    if image_format == 'png':
+        Image.fromarray(im).save(path, format='PNG', compress_level=png_compress_level)
+    elif image_format == 'jpeg':
+        Image.fromarray(im).save(path, format='JPEG', quality=quality)
+    elif image_format == 'webp':
+        Image.fromarray(im).save(path, format='WEBP', quality=quality)
+    else:
+        raise Exception('Unknown image format {}'.format(image_format))
+
+
+def report_plot_error(row, error):
+    if error is not None:
+        print('The image of {} could not be generated ({}) (skipped)'.format(row['file_path'], error))
 
 
 def plot_box(im_orig, x1, y1, x2, y2, score, thickness=3, box_color=(255, 0, 0), text_color=(255, 0, 0), font_scale=3.5, font_thickness=4, line_type=2):
@@ -48,6 +402,8 @@ def plot_box(im_orig, x1, y1, x2, y2, score, thickness=3, box_color=(255, 0, 0),
     :param line_type: int. lineType argument for cv2.putText (see documentation for lineType details) (optional)
     :return: numpy array. 3-channel numpy array with the bounding box and score text drawn
     """
+    import cv2
+
     assert isinstance(im_orig, np.ndarray), 'Expected type ndarray for the image, got type {}'.format(type(im_orig))
     assert all([isinstance(coord, int) or isinstance(coord, float) for coord in [x1, y1, x2, y2]]), 'Expected all coordinates to have type int or float'
     assert isinstance(score, int) or isinstance(score, float), 'Expected score to have type int or float, got type {}'.format(type(score))
@@ -65,43 +421,125 @@ def plot_box(im_orig, x1, y1, x2, y2, score, thickness=3, box_color=(255, 0, 0),
     return im
 
 
-def load_im(file_path, slice_num):
+def draw_box(im, row, scale=1.0):
+    """
+    Plots the box and the score of a row of the bbox DF on an image that was resized by a factor
+    :param im: numpy array. 2D array of dtype uint8
+    :param row: dict. Row of the bbox DF, with the coordinates of the box in the full resolution image
+    :param scale: float. Size of the image relative to the full resolution image. The box and the text are scaled
+    :return: numpy array. 3-channel array of dtype uint8
+    """
+    x1, y1 = int(row['x1'] * scale), int(row['y1'] * scale)
+    # Boxes of a few pixels can collapse in the low resolution levels
+    x2, y2 = max(int(row['x2'] * scale), x1 + 1), max(int(row['y2'] * scale), y1 + 1)
+    return plot_box(im, x1, y1, x2, y2, row['score'], thickness=max(1, round(3 * scale)), font_scale=3.5 * scale,
+                    font_thickness=max(1, round(4 * scale)))
+
+
+def load_im(file_path, slice_num, frames=None):
     """
     Loads the pixel array from the specified dicom file.
+    If the frame was preprocessed, the saved frame is memory-mapped instead of decoding the dicom file. Otherwise only
+    the frame that is plotted is decoded and windowed (see utils.read_frame)
     :param file_path: str. The absolute path to the dicom file
     :param slice_num: int. The number of the slice that the box is found on
+    :param frames: PreprocessedFrames. Preprocessed frames (optional)
     :return: numpy array. 2D loaded pixel array of dtype uint8
     """
-    ds = pydicom.dcmread(file_path)
+    slice_num, ims = load_ims(file_path, slice_num, frames)
+    return ims[slice_num]
+
+
+def load_ims(file_path, slice_num, frames=None, neighbors=0):
+    """
+    Loads the frame of the box and, for DBT files, the frames around it, reading the dicom file once (see load_im)
+    :param file_path: str. The absolute path to the dicom file
+    :param slice_num: int. The number of the slice that the box is found on (-1: middle slice of DBT files)
+    :param frames: PreprocessedFrames. Preprocessed frames (optional)
+    :param neighbors: int. Number of frames loaded on each side of the box slice of DBT files
+    :return: 2-tuple: index of the frame of the box, dict frame index -> 2D pixel array of dtype uint8
+    """
+    import pydicom
+    import utils
+
     assert isinstance(slice_num, int), 'Expected slice_num to be an int, got type {}'.format(type(slice_num))
+    if frames is not None:
+        loaded = load_preprocessed_ims(file_path, slice_num, frames, neighbors)
+        if loaded is not None:
+            slice_num, ims = loaded
+            return slice_num, {i: bytescale(im) for i, im in ims.items()}
+
+    ds = pydicom.dcmread(file_path, defer_size=utils.DEFER_SIZE)
 
     # When slice_number = -1 but file is DBT, set slice_num to be middle slice
     if ds.SOPClassUID == '1.2.840.10008.5.1.4.1.1.13.1.3':
-        if slice_num == -1:
-            num_frames = int(getattr(ds, 'NumberOfFrames', -1))
-            # If NumberOfFrames is not a field in DBT, try to infer from pixel_array
-            if num_frames == -1:
-                im = ds.pixel_array
-                if len(im.shape) != 3:
-                    raise Exception('DBT file contains 2 dimensional pixel_array')
-                num_frames = im.shape[0]
-            slice_num = int(num_frames / 2)
-        im = ds.pixel_array
-        im = pydicom.pixel_data_handlers.apply_voi_lut(im, ds)[slice_num, :, :]
+        indices = [slice_num]
+        if slice_num == -1 or neighbors > 0:
+            # If NumberOfFrames is not a field in DBT, the frames are counted without decoding them
+            num_frames = utils.count_frames(ds)
+            if slice_num == -1:
+                slice_num = int(num_frames / 2)
+            indices = range(max(0, slice_num - neighbors), min(num_frames, slice_num + neighbors + 1))
 
     elif ds.SOPClassUID == '1.2.840.10008.5.1.4.1.1.1.2':
-        im = ds.pixel_array
-        im = pydicom.pixel_data_handlers.apply_voi_lut(im, ds)
+        slice_num = 0
+        indices = [0]
+
+    else:
+        raise Exception('DICOM at {} is not DXM or DBT file.'.format(file_path, ds.SOPClassUID))
+
+    ims = {i: bytescale(pydicom.pixel_data_handlers.apply_voi_lut(im, ds))
+           for i, im in zip(sorted(indices), utils.read_frames(ds, indices))}
+    return slice_num, ims
+
 
+def load_preprocessed_ims(file_path, slice_num, frames, neighbors=0):
+    """
+    Loads the preprocessed frames of a dicom file (see load_ims), reading only the header of the dicom file
+    :param file_path: str. The absolute path to the dicom file
+    :param slice_num: int. The number of the slice that the box is found on
+    :param frames: PreprocessedFrames. Preprocessed frames
+    :param neighbors: int. Number of frames loaded on each side of the box slice of DBT files
+    :return: 2-tuple: index of the frame of the box, dict frame index -> 2D windowed frame. None if any of the frames
+    was not preprocessed
+    """
+    import pydicom
+    import utils
+
+    ds = pydicom.dcmread(file_path, stop_before_pixels=True)
+    if ds.SOPClassUID == '1.2.840.10008.5.1.4.1.1.13.1.3':
+        indices = [slice_num]
+        if slice_num == -1 or neighbors > 0:
+            if 'NumberOfFrames' not in ds:
+                # The frames can only be counted from the pixel data
+                return None
+            num_frames = int(ds.NumberOfFrames)
+            if slice_num == -1:
+                slice_num = int(num_frames / 2)
+            indices = range(max(0, slice_num - neighbors), min(num_frames, slice_num + neighbors + 1))
+    elif ds.SOPClassUID == '1.2.840.10008.5.1.4.1.1.1.2':
+        slice_num = 0
+        indices = [0]
     else:
         raise Exception('DICOM at {} is not DXM or DBT file.'.format(file_path, ds.SOPClassUID))
 
-    return bytescale(im)
+    ims = dict()
+    for i in indices:
+        frame_path = frames.find(file_path, i)
+        if frame_path is None:
+            return None
+        im = np.load(frame_path, mmap_mode='r')
+        # Hologic and GE frames are saved without windowing (see utils.read_dicom)
+        if not utils.is_windowed(str(ds.get('Manufacturer', None) or '')):
+            im = pydicom.pixel_data_handlers.apply_voi_lut(im, ds)
+        ims[i] = im
+    return slice_num, ims
 
 
 def bytescale(data, cmin=None, cmax=None, high=255, low=0):
     """
     COPIED FROM SCIPY SOURCE CODE, NOW DEPRECATED
+    Scaled in float32 and in place, so that only one float copy of the image is allocated
     """
     if data.dtype == np.uint8:
         return data
@@ -121,11 +559,14 @@ def bytescale(data, cmin=None, cmax=None, high=255, low=0):
         cscale = 1
 
     scale = float(high - low) / cscale
-    bytedata = (data * 1.0 - cmin) * scale + 0.4999
-    bytedata[bytedata > high] = high
-    bytedata[bytedata < 0] = 0
+    bytedata = np.subtract(data, cmin, dtype=np.float32)
+    bytedata *= scale
+    bytedata += 0.4999
+    np.clip(bytedata, 0, high, out=bytedata)
 
-    return np.cast[np.uint8](bytedata) + np.cast[np.uint8](low)
+    bytedata = bytedata.astype(np.uint8)
+    bytedata += np.uint8(low)
+    return bytedata
 
 
 def parse_args():
@@ -137,13 +578,23 @@ def parse_args():
                         help='The path to the top-level directory that the plotted images will be saved to. '
                              'One subdirectory will be created inside this directory for each initial subdirectory '
                              'containing dicom files as specified by the "file_path" column in the bounding box CSV')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of processes used to generate the images (default: 1)')
+    parser.add_argument('--preprocess_dir', type=str,
+                        help='Directory with the pre-processed files of the dicom files (optional). The images are '
+                             'generated from the pre-processed frames found in it instead of decoding the dicom files')
+    image_args_utils.add_image_arguments(parser)
     return parser.parse_args()
 
 
 if __name__ == '__main__':
+    import pandas as pd
+
     args = parse_args()
     try:
         bbox_df = pd.read_csv(args.bbox_df)
-        plot_and_save_ims(bbox_df=bbox_df, output_dir=args.output_dir)
+        frames = None if args.preprocess_dir is None else PreprocessedFrames(preprocess_dirs(args.preprocess_dir))
+        plot_and_save_ims(bbox_df=bbox_df, output_dir=args.output_dir, workers=args.workers, frames=frames,
+                          **image_args_utils.image_options(args))
     except FileNotFoundError:
         print('{} was not found. Please make sure that you have entered the full (absolute) path to the CSV.'.format(args.bbox_df))
\ No newline at end of file
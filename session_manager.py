@@ -0,0 +1,226 @@
+"""
+Send several inputs (or the shards of large inputs) to the evaluation server and retrieve their results, running the
+uploads, the polling and the downloads of the sessions concurrently.
+The state of every session (input, SessionID, results url) is saved in a json file after each step, so an interrupted
+run resumes where it stopped when it is run again with the same state file (sent inputs are not sent again and the
+results urls do not need to be passed by hand). Example of use:
+python session_manager.py --input /my/local/dicom_data/site_a /my/local/dicom_data/site_b --shard
+--output /my/local/output/folder --access_key XXX --concurrency 4
+"""
+import argparse
+import asyncio
+import collections
+import json
+import os
+
+import pandas as pd
+
+import cache_utils
+import deploy_evaluation
+import http_utils
+import shard_utils
+
+# Status of a session
+PENDING = 'pending'     # Not sent yet
+SENT = 'sent'           # Sent, waiting for the results
+DONE = 'done'           # Results downloaded and unhashed
+EMPTY = 'empty'         # No valid files to send
+
+
+class SessionState(object):
+    """
+    Sessions of a run, saved in a json file
+    """
+
+    def __init__(self, path):
+        """
+        :param path: str. Path to the json file. If it exists, the sessions are loaded from it
+        """
+        self.path = path
+        self.sessions = []
+        if os.path.isfile(path):
+            with open(path) as f:
+                self.sessions = json.load(f)['sessions']
+
+    def save(self):
+        # Write a new file and rename it, so the state file is never left half written
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'sessions': self.sessions}, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+
+def plan_sessions(inputs, shard=False, windowing='pydicom'):
+    """
+    :param inputs: list of str. Input DICOM files, study folders or folders of study folders
+    :param shard: bool. Split each input folder into shards (see shard_utils.plan_shards)
+    :param windowing: str. Windowing engine: 'pydicom' (float64 output) or 'lut' (integer output)
+    :return: list of dict. One pending session for each input or shard
+    """
+    sessions = []
+    for input_ in inputs:
+        input_ = os.path.realpath(input_)
+        if shard and os.path.isdir(input_):
+            print(f"Planning the shards of {input_}...")
+            shards = shard_utils.plan_shards(deploy_evaluation.iter_studies(input_), windowing)
+        else:
+            shards = [None]
+        for studies in shards:
+            sessions.append({'name': f"{len(sessions) + 1}", 'input': input_, 'studies': studies,
+                             'status': PENDING, 'session_id': None, 'results_url': None, 'error': None})
+    return sessions
+
+
+async def poll_results(url, poll_timeout, initial_delay=5, max_delay=60):
+    """
+    Same as http_utils.wait_for_remote_file, but other sessions keep running while waiting
+    :param url: str. Results url
+    :param poll_timeout: float. Max time to wait in seconds
+    :return: bool. True if the results exist, False if they were not found before the timeout
+    """
+    loop = asyncio.get_event_loop()
+    deadline = loop.time() + poll_timeout
+    for delay in http_utils.backoff_delays(initial_delay, max_delay):
+        if await loop.run_in_executor(None, http_utils.remote_file_exists, url):
+            return True
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            return False
+        await asyncio.sleep(min(delay, remaining))
+
+
+async def run_session(session, state, args, cache, results_cache, limit):
+    """
+    Send the input of a session and retrieve its results, starting from its current status
+    :param session: dict. Session (see plan_sessions)
+    :param state: SessionState. Saved after each step
+    :param args: Namespace. Command line arguments
+    :param cache: cache_utils.PreprocessCache. Preprocessing cache (optional)
+    :param results_cache: cache_utils.ResultsCache. Results cache (optional)
+    :param limit: asyncio.Semaphore. Bounds the number of sessions sending or downloading files at the same time
+    :return: None
+    """
+    loop = asyncio.get_event_loop()
+    try:
+        if session['status'] == PENDING:
+            async with limit:
+                print(f"[{session['name']}] Sending {session['input']}...")
+                sent = await loop.run_in_executor(None, deploy_evaluation.send_input, session['input'], args, cache,
+                                                  session['studies'], None, False, results_cache)
+            if sent is None:
+                session['status'] = EMPTY
+            elif sent[1] is None:
+                # All the studies were found in the results cache, nothing was sent
+                session['session_id'] = sent[0]
+                deploy_evaluation.load_cached_session(session['session_id'], args.output)
+                session['status'] = DONE
+                print(f"[{session['name']}] Results found in the results cache, saved to "
+                      f"{os.path.join(args.output, session['session_id'])}")
+            else:
+                session['session_id'], session['results_url'] = sent
+                session['status'] = SENT
+                print(f"[{session['name']}] Sent. Results url: {session['results_url']}")
+            session['error'] = None
+            state.save()
+
+        if session['status'] == SENT:
+            if not await poll_results(session['results_url'], args.poll_timeout):
+                print(f"[{session['name']}] The results were not ready before the timeout. "
+                      f"Run the same command again later to retrieve them")
+                return
+            async with limit:
+                results = await loop.run_in_executor(None, deploy_evaluation.retrieve_results,
+                                                     session['results_url'], session['input'], args, results_cache)
+            if results is None:
+                return
+            session['status'] = DONE
+            session['error'] = None
+            state.save()
+            print(f"[{session['name']}] Results saved to {os.path.join(args.output, session['session_id'])}")
+    except Exception as ex:
+        # Keep the status, so the failed step is retried when the same command is run again
+        print(f"[{session['name']}] Error: {ex}")
+        session['error'] = str(ex)
+        state.save()
+
+
+def load_results(session, output_dir):
+    """
+    :param session: dict. Session with status DONE
+    :param output_dir: str. Output folder
+    :return: 3-tuple: SessionID, study_df, dicom_df (see deploy_evaluation.retrieve_results)
+    """
+    session_id = session['session_id']
+    csv_folder = os.path.join(output_dir, session_id, "csv")
+    study_df = pd.read_csv(os.path.join(csv_folder, session_id + '_study.csv'))
+    dicom_df = pd.read_csv(os.path.join(csv_folder, session_id + '_dicom.csv'))
+    return session_id, study_df, dicom_df
+
+
+async def run_sessions(state, args, cache, results_cache):
+    limit = asyncio.Semaphore(args.concurrency)
+    await asyncio.gather(*[run_session(session, state, args, cache, results_cache, limit)
+                           for session in state.sessions])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Send several inputs to the evaluation server and retrieve their "
+                                                 "results concurrently, saving the state of the sessions so that an "
+                                                 "interrupted run can be resumed")
+    parser.add_argument('--input', type=str, nargs='+', required=True,
+                        help='DICOM files, study directories or directories of study directories. Each input (or '
+                             'shard with --shard) is sent in its own session')
+    parser.add_argument('--output', type=str, required=True, help='Output directory to store results')
+    parser.add_argument('--access_key', type=str, required=True, help='Access key provided by the authors')
+    parser.add_argument('--state_file', type=str,
+                        help='Json file with the state of the sessions. If it exists, the sessions saved in it are '
+                             'resumed and --input is not read again (default: <output>/sessions.json)')
+    parser.add_argument('--concurrency', type=int, default=2,
+                        help='Max number of sessions sending or downloading files at the same time (default: 2)')
+    deploy_evaluation.add_session_arguments(parser)
+    args = parser.parse_args()
+
+    if args.server is not None:
+        deploy_evaluation.set_server(args.server)
+    os.makedirs(args.output, exist_ok=True)
+    state = SessionState(args.state_file or os.path.join(args.output, 'sessions.json'))
+    if len(state.sessions) == 0:
+        state.sessions = plan_sessions(args.input, args.shard, args.windowing)
+        state.save()
+    else:
+        print(f"Resuming the sessions saved in {state.path}")
+
+    if any(session['status'] == PENDING for session in state.sessions):
+        print("The files will be sent to the server. Please confirm the following statement to proceed:")
+        deploy_evaluation.confirm_terms_of_service()
+
+    cache = None
+    if args.cache_dir is not None:
+        cache = cache_utils.PreprocessCache(args.cache_dir, int(args.cache_max_gb * 2**30), variant=args.windowing)
+    results_cache = None
+    if args.results_cache_dir is not None:
+        results_cache = cache_utils.ResultsCache(args.results_cache_dir)
+    # Enough pooled connections for the sessions that send or download files and the ones polling
+    http_utils.get_session(pool_maxsize=max(8, 2 * args.concurrency))
+    asyncio.run(run_sessions(state, args, cache, results_cache))
+    if cache is not None:
+        cache.print_stats()
+    if results_cache is not None:
+        results_cache.print_stats()
+
+    for session in state.sessions:
+        print(f"[{session['name']}] {session['input']}: {session['status']}"
+              + (f" ({session['error']})" if session['error'] else ""))
+    done = [session for session in state.sessions if session['status'] == DONE]
+    # Only the shards of the same input are merged, the results of different inputs are kept separate
+    done_by_input = collections.OrderedDict()
+    for session in done:
+        done_by_input.setdefault(session['input'], []).append(session)
+    for input_, input_sessions in done_by_input.items():
+        if len(input_sessions) > 1:
+            results_folder, _, _ = deploy_evaluation.merge_results([load_results(session, args.output)
+                                                                     for session in input_sessions], args.output)
+            print("The results of the finished sessions of {} have been merged into the folder {}".format(
+                input_, results_folder))
+    if len(done) + sum(session['status'] == EMPTY for session in state.sessions) < len(state.sessions):
+        print(f"Some sessions are not finished. Run the same command again to resume them (state file: {state.path})")
@@ -0,0 +1,79 @@
+import pydicom
+
+import utils
+from deploy_constants import MAX_FILE_SIZE_BYTES, MAX_STUDIES, MAX_IMAGES
+
+# Expected zip size / preprocessed size, by dtype of the saved frames. Conservative values, so that shards rarely
+# exceed the max file size: frames keep the background of the images and the unused high bits of the pixel values,
+# and windowed float64 frames only hold integer values
+COMPRESSION_RATIOS = {'raw': 0.75, 'float64': 0.35, 'lut': 0.75}
+# Fraction of the max file size that the estimated size of a shard can use
+SHARD_FILL = 0.9
+# Size of the .npy header of each frame and of the zip entry headers, in bytes
+FRAME_OVERHEAD_BYTES = 256
+
+
+def estimate_dicom_size(dicom_path, windowing='pydicom'):
+    """
+    Estimate the size of the preprocessed frames of a DICOM file in the zip file, reading only its header
+    :param dicom_path: str. Path to the DICOM file
+    :param windowing: str. Windowing engine: 'pydicom' (float64 output) or 'lut' (integer output)
+    :return: int. Estimated size in bytes
+    """
+    ds = pydicom.dcmread(dicom_path, stop_before_pixels=True,
+                         specific_tags=['Rows', 'Columns', 'NumberOfFrames', 'BitsAllocated', 'Manufacturer'])
+    num_frames = int(ds.get('NumberOfFrames', None) or 1)
+    # GE and Hologic frames are saved without windowing
+    if not utils.is_windowed(str(ds.get('Manufacturer', None) or '')):
+        itemsize, ratio = int(ds.get('BitsAllocated', None) or 16) // 8, COMPRESSION_RATIOS['raw']
+    elif windowing == 'lut':
+        itemsize, ratio = 2, COMPRESSION_RATIOS['lut']
+    else:
+        itemsize, ratio = 8, COMPRESSION_RATIOS['float64']
+    frame_size = int(ds.Rows) * int(ds.Columns) * itemsize
+    return num_frames * int(frame_size * ratio + FRAME_OVERHEAD_BYTES)
+
+
+def plan_shards(studies, windowing='pydicom', max_bytes=int(SHARD_FILL * MAX_FILE_SIZE_BYTES),
+                max_studies=MAX_STUDIES, max_images=MAX_IMAGES):
+    """
+    Pack whole studies into shards that can each be sent in a session, within the evaluation limits and the max file
+    size. Studies are placed in the first shard with room for them (first fit), keeping their order within a shard.
+    :param studies: iterable of (study path, list of valid DICOM paths) tuples
+    :param windowing: str. Windowing engine: 'pydicom' (float64 output) or 'lut' (integer output)
+    :param max_bytes: int. Max estimated size of a shard in bytes
+    :param max_studies: int. Max number of studies of a shard
+    :param max_images: int. Max number of images of a shard
+    :return: list of shards, each of them a list of (study path, list of valid DICOM paths) tuples
+    """
+    shards = []
+    # Number of images and estimated size of each shard
+    totals = []
+    for study_path, dicom_paths in studies:
+        if len(dicom_paths) > max_images:
+            print(f"WARNING: The study {study_path} has more than {max_images} images and cannot be sent (skipped)")
+            continue
+        study_size = 0
+        for dicom_path in dicom_paths:
+            try:
+                study_size += estimate_dicom_size(dicom_path, windowing)
+            except Exception as ex:
+                print(f"The size of {dicom_path} could not be estimated ({ex})")
+        if study_size > max_bytes:
+            print(f"WARNING: The study {study_path} may exceed the max file size on its own "
+                  f"(estimated {study_size / 2**30:.2f} GB)")
+        for i, (num_images, shard_size) in enumerate(totals):
+            if len(shards[i]) < max_studies and num_images + len(dicom_paths) <= max_images and \
+                    shard_size + study_size <= max_bytes:
+                break
+        else:
+            i = len(shards)
+            shards.append([])
+            totals.append((0, 0))
+        shards[i].append((study_path, dicom_paths))
+        totals[i] = (totals[i][0] + len(dicom_paths), totals[i][1] + study_size)
+
+    for i, (shard, (num_images, shard_size)) in enumerate(zip(shards, totals)):
+        print(f"Shard {i + 1}/{len(shards)}: {len(shard)} studies, {num_images} images, "
+              f"estimated size {shard_size / 2**30:.2f} GB")
+    return shards
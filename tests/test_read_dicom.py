@@ -0,0 +1,91 @@
+"""
+The frames of a DICOM file are written only once the whole file is preprocessed (utils.read_dicom), so a file that
+fails to decode halfway does not leave some of its frames in the upload. Run with: python -m pytest tests
+"""
+import os
+import sys
+
+import numpy as np
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+import archive_utils
+import synthetic_dicom
+import utils
+
+NUM_FRAMES = 3
+STUDY_PATH_HASH = 'study'
+
+
+class RecordingWriter(object):
+    """
+    Writer that is not written in place by archive_utils.FileStaging (like the zip file being uploaded)
+    """
+    process_safe = False
+
+    def __init__(self):
+        self.members = []
+
+    def write(self, arcname, data):
+        self.members.append((arcname, data))
+
+
+@pytest.fixture
+def dbt_path(tmp_path):
+    frames = np.random.RandomState(0).randint(0, 4096, size=(NUM_FRAMES, 32, 24)).astype(np.uint16)
+    path = str(tmp_path / 'dbt.dcm')
+    synthetic_dicom.write_dicom(path, frames, dbt=True)
+    return path
+
+
+@pytest.fixture
+def failing_decode(monkeypatch):
+    iter_frames = utils.iter_frames
+
+    def fail_on_second_frame(ds, threads=1):
+        frames = iter_frames(ds, threads)
+        yield next(frames)
+        raise ValueError('Frame 1 could not be decoded')
+
+    monkeypatch.setattr(utils, 'iter_frames', fail_on_second_frame)
+
+
+def make_writer(kind, tmp_path):
+    if kind == 'buffer':
+        return archive_utils.MemberBuffer()
+    if kind == 'directory':
+        return archive_utils.DirectoryWriter(str(tmp_path / 'preprocessed'))
+    return RecordingWriter()
+
+
+def written_files(writer):
+    if isinstance(writer, archive_utils.DirectoryWriter):
+        return sorted(os.path.relpath(os.path.join(root, name), writer.directory)
+                      for root, _, names in os.walk(writer.directory) for name in names)
+    return sorted(arcname for arcname, _ in (writer if isinstance(writer, list) else writer.members))
+
+
+@pytest.mark.parametrize('memory_bytes', (archive_utils.FILE_STAGING_MEMORY_BYTES, 0))
+@pytest.mark.parametrize('kind', ('buffer', 'directory', 'recording'))
+def test_all_frames_are_written(kind, memory_bytes, dbt_path, tmp_path, monkeypatch):
+    monkeypatch.setattr(archive_utils, 'FILE_STAGING_MEMORY_BYTES', memory_bytes)
+    writer = make_writer(kind, tmp_path)
+    utils.read_dicom(dbt_path, writer, STUDY_PATH_HASH)
+    dcm_path_hash = utils.create_hash(dbt_path)
+    assert written_files(writer) == sorted(utils.frame_arcname(STUDY_PATH_HASH, dcm_path_hash, i)
+                                           for i in range(NUM_FRAMES))
+
+
+@pytest.mark.parametrize('memory_bytes', (archive_utils.FILE_STAGING_MEMORY_BYTES, 0))
+@pytest.mark.parametrize('kind', ('buffer', 'directory', 'recording'))
+def test_decode_failure_writes_no_frames(kind, memory_bytes, dbt_path, tmp_path, monkeypatch, failing_decode):
+    monkeypatch.setattr(archive_utils, 'FILE_STAGING_MEMORY_BYTES', memory_bytes)
+    writer = make_writer(kind, tmp_path)
+    if kind == 'buffer':
+        # Members of the files read before are kept
+        writer.write('previous.npy', b'data')
+    with pytest.raises(ValueError):
+        utils.read_dicom(dbt_path, writer, STUDY_PATH_HASH)
+    assert written_files(writer) == (['previous.npy'] if kind == 'buffer' else [])
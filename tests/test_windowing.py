@@ -0,0 +1,127 @@
+"""
+Numeric equivalence of the lookup table windowing (windowing_utils.apply_voi_lut, --windowing lut) and
+pydicom.pixel_data_handlers.apply_voi_lut (default). The lookup table output is the pydicom output rounded to integers,
+so the absolute difference must be <= 0.5 for every pixel. Run with: python -m pytest tests
+"""
+import os
+import sys
+
+import numpy as np
+import pydicom
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import windowing_utils
+
+# Max absolute difference between both engines (rounding to the nearest integer)
+MAX_ABS_DIFF = 0.5
+VOI_FUNCTIONS = ('LINEAR', 'LINEAR_EXACT', 'SIGMOID')
+# (bits stored, pixel representation)
+PIXEL_FORMATS = ((12, 0), (14, 0), (16, 0), (12, 1), (16, 1))
+
+
+def make_frame(bits_stored, pixel_representation, shape=(64, 48), seed=0):
+    """
+    :return: numpy array. Random frame covering the whole range of the bit depth
+    """
+    rng = np.random.RandomState(seed)
+    low = -2 ** (bits_stored - 1) if pixel_representation else 0
+    high = 2 ** (bits_stored - 1) if pixel_representation else 2 ** bits_stored
+    dtype = np.int16 if pixel_representation else np.uint16
+    frame = rng.randint(low, high, size=shape).astype(dtype)
+    # The extremes of the range are always checked
+    frame.flat[0], frame.flat[1] = low, high - 1
+    return frame
+
+
+def make_dataset(bits_stored, pixel_representation, voi_function='LINEAR', center=None, width=None):
+    """
+    :return: pydicom Dataset with the windowing attributes. The window is centered on the range by default
+    """
+    ds = pydicom.Dataset()
+    ds.PhotometricInterpretation = 'MONOCHROME2'
+    ds.PixelRepresentation = pixel_representation
+    ds.BitsStored = bits_stored
+    if center is None:
+        center = 0 if pixel_representation else 2 ** (bits_stored - 1)
+    ds.WindowCenter = center
+    ds.WindowWidth = 2 ** (bits_stored - 1) + 0.5 if width is None else width
+    ds.VOILUTFunction = voi_function
+    return ds
+
+
+def assert_equivalent(frame, ds):
+    expected = pydicom.pixel_data_handlers.apply_voi_lut(frame, ds)
+    result = windowing_utils.apply_voi_lut(frame, ds)
+    assert result.shape == expected.shape
+    assert result.dtype.kind in ('u', 'i')
+    assert np.abs(result.astype(np.float64) - expected).max() <= MAX_ABS_DIFF
+
+
+@pytest.mark.parametrize('voi_function', VOI_FUNCTIONS)
+@pytest.mark.parametrize('bits_stored,pixel_representation', PIXEL_FORMATS)
+def test_window(voi_function, bits_stored, pixel_representation):
+    frame = make_frame(bits_stored, pixel_representation)
+    assert_equivalent(frame, make_dataset(bits_stored, pixel_representation, voi_function))
+
+
+@pytest.mark.parametrize('voi_function', VOI_FUNCTIONS)
+@pytest.mark.parametrize('bits_stored,pixel_representation', PIXEL_FORMATS)
+def test_window_with_rescale(voi_function, bits_stored, pixel_representation):
+    frame = make_frame(bits_stored, pixel_representation)
+    ds = make_dataset(bits_stored, pixel_representation, voi_function, center=100.0, width=3000.0)
+    ds.RescaleSlope = 1.5
+    ds.RescaleIntercept = -1024
+    assert_equivalent(frame, ds)
+
+
+@pytest.mark.parametrize('voi_function', VOI_FUNCTIONS)
+@pytest.mark.parametrize('bits_stored,pixel_representation', PIXEL_FORMATS)
+def test_multi_value_window(voi_function, bits_stored, pixel_representation):
+    # pydicom uses the first window
+    frame = make_frame(bits_stored, pixel_representation)
+    ds = make_dataset(bits_stored, pixel_representation, voi_function)
+    ds.WindowCenter = [2 ** (bits_stored - 2), 2 ** (bits_stored - 3)]
+    ds.WindowWidth = [2 ** (bits_stored - 1) + 0.5, 2 ** (bits_stored - 2)]
+    assert_equivalent(frame, ds)
+
+
+def test_narrow_window():
+    frame = make_frame(12, 0)
+    assert_equivalent(frame, make_dataset(12, 0, 'LINEAR', center=2048.0, width=1.0))
+
+
+def test_voi_lut_sequence_uses_pydicom():
+    frame = make_frame(12, 0)
+    ds = make_dataset(12, 0)
+    item = pydicom.Dataset()
+    item.LUTDescriptor = [4096, 0, 16]
+    item.LUTData = list(range(0, 65536, 16))
+    ds.VOILUTSequence = [item]
+    ds.BitsAllocated = 16
+    result = windowing_utils.apply_voi_lut(frame, ds)
+    expected = pydicom.pixel_data_handlers.apply_voi_lut(frame, ds)
+    assert result.dtype == expected.dtype
+    assert np.array_equal(result, expected)
+
+
+def test_modality_lut_sequence_uses_pydicom():
+    frame = make_frame(12, 0)
+    ds = make_dataset(12, 0)
+    item = pydicom.Dataset()
+    item.LUTDescriptor = [4096, 0, 16]
+    item.LUTData = list(range(4096))
+    item.ModalityLUTType = 'US'
+    ds.ModalityLUTSequence = [item]
+    result = windowing_utils.apply_voi_lut(frame, ds)
+    expected = pydicom.pixel_data_handlers.apply_voi_lut(frame, ds)
+    assert result.dtype == expected.dtype
+    assert np.array_equal(result, expected)
+
+
+def test_window_lut_is_shared():
+    frame = make_frame(12, 0)
+    windowing_utils.window_lut.cache_clear()
+    windowing_utils.apply_voi_lut(frame, make_dataset(12, 0))
+    windowing_utils.apply_voi_lut(make_frame(12, 0, seed=1), make_dataset(12, 0))
+    assert windowing_utils.window_lut.cache_info().hits == 1
@@ -1,13 +1,23 @@
+import io
 import os
-import logging
+import collections
+import itertools
+import pickle
 import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
 
 import pydicom
 import numpy as np
 import pandas as pd
 
-def create_hash(string):
-    return hashlib.sha256(string.encode('ASCII')).hexdigest()[0:8]
+import archive_utils
+import metrics_utils
+from manifest_utils import create_hash, frame_arcname
+import windowing_utils
+
+# Elements larger than this are not loaded by dcmread, so that the pixel data can be decoded frame by frame
+DEFER_SIZE = 2**20
 
 def verbose_position_to_code(string):
     # dictionary based on http://dicom.nema.org/dicom/2013/output/chtml/part16/sect_CID_4014.html
@@ -47,19 +57,12 @@ def nested_index(data, index_array_in):
             raise ValueError('Value not found')
         return nested_index(data, index_array)
 
-def read_dicom(dicom_path, preprocess_dir, study_path_hash):
-    def map_manufacturer(manufacturer):
-        if 'hologic' in manufacturer.lower() or 'lorad' in manufacturer.lower():
-            return 'hologic'
-        elif 'gemedicalsystems' in manufacturer.replace(' ', '').lower():
-            return 'ge'
-        else:
-            return manufacturer
-    # Read in dicom
-    ds = pydicom.dcmread(dicom_path)
-    is_dbt = ds.SOPClassUID == '1.2.840.10008.5.1.4.1.1.13.1.3'
-
-    # Preprocessing
+def check_dicom(ds):
+    """
+    Make sure that a DICOM file can be sent to the server
+    :param ds: pydicom Dataset. It only needs the SOPClassUID and BurnedInAnnotation tags
+    :return: None
+    """
     # Ensure the SOPClassUID is valid
     allowed_sop_uids = ('1.2.840.10008.5.1.4.1.1.1.2', '1.2.840.10008.5.1.4.1.1.13.1.3')
     assert ds.SOPClassUID in allowed_sop_uids, \
@@ -68,6 +71,40 @@ def read_dicom(dicom_path, preprocess_dir, study_path_hash):
     assert 'BurnedInAnnotation' in ds and ds.BurnedInAnnotation.upper() == 'NO', \
         'BurnedInAnnotation not found or != "NO"'
 
+def validate_dicom(dicom_path):
+    """
+    Same checks read_dicom runs before preprocessing a file, but only the needed tags are read (no pixel data)
+    :param dicom_path: str. Path to the DICOM file
+    :return: None
+    """
+    ds = pydicom.dcmread(dicom_path, stop_before_pixels=True, specific_tags=['SOPClassUID', 'BurnedInAnnotation'])
+    check_dicom(ds)
+
+def map_manufacturer(manufacturer):
+    if 'hologic' in manufacturer.lower() or 'lorad' in manufacturer.lower():
+        return 'hologic'
+    elif 'gemedicalsystems' in manufacturer.replace(' ', '').lower():
+        return 'ge'
+    else:
+        return manufacturer
+
+def is_windowed(manufacturer):
+    """
+    :param manufacturer: str. Manufacturer DICOM field
+    :return: bool. True if pydicom windowing is applied to the preprocessed frames (all manufacturers except Hologic
+    and GE, whose frames are saved as they are)
+    """
+    return map_manufacturer(manufacturer).lower() not in ['ge', 'hologic']
+
+def read_dicom(dicom_path, writer, study_path_hash, frame_threads=1, windowing='pydicom'):
+    # Read in dicom. The pixel data is not loaded here, frames are decoded one at a time below
+    with metrics_utils.stage('read_header'):
+        ds = pydicom.dcmread(dicom_path, defer_size=DEFER_SIZE)
+    is_dbt = ds.SOPClassUID == '1.2.840.10008.5.1.4.1.1.13.1.3'
+
+    # Preprocessing
+    check_dicom(ds)
+
     # Hash path in case the path contains PHI
     dcm_path_hash = create_hash(dicom_path)
 
@@ -111,60 +148,368 @@ def read_dicom(dicom_path, preprocess_dir, study_path_hash):
             field_val = ''
         metadata[field] = field_val
 
+    # Hash of the pre-processed frames and of the metadata sent with them, which identifies the image independently
+    # of its path (see cache_utils.ResultsCache)
+    pixel_hash = hashlib.sha256(repr(sorted((field, str(value)) for field, value in metadata.items())).encode('utf-8'))
+
     metadata['dcm_path'] = dcm_path_hash
     metadata['np_paths'] = os.path.join(study_path_hash, dcm_path_hash)
     metadata['SOPInstanceUID'] = dcm_path_hash
     metadata['StudyInstanceUID'] = study_path_hash
 
-    # Convert pixel_array into dictionary of frames
+    # Decode the frames one at a time, so that memory usage is proportional to one frame and not to the whole volume
+    # If the manufacturer is not Hologic or GE, apply pydicom windowing.
+    apply_windowing = is_windowed(str(metadata['Manufacturer']))
+    # 'lut' windowing gives the same values rounded to integers, which keeps the frames compact
+    apply_voi_lut = windowing_utils.apply_voi_lut if windowing == 'lut' else pydicom.pixel_data_handlers.apply_voi_lut
+    # The frames are only written once all of them are decoded, so that a file that fails to decode halfway is not
+    # sent partially
+    staging = archive_utils.FileStaging(writer)
+    try:
+        frames = metrics_utils.timed_iter('decode', iter_frames(ds, frame_threads), size=lambda frame: frame.nbytes)
+        for i, frame in enumerate(frames):
+            if apply_windowing:
+                with metrics_utils.stage('windowing', bytes_in=frame.nbytes) as counts:
+                    frame = apply_voi_lut(frame, ds)
+                    counts['bytes_out'] = frame.nbytes
+            # Save frame to numpy
+            with metrics_utils.stage('serialize', bytes_in=frame.nbytes) as counts:
+                data = frame_to_bytes(frame)
+                counts['bytes_out'] = len(data)
+            with metrics_utils.stage('write', bytes_in=len(data)):
+                staging.write(frame_arcname(study_path_hash, dcm_path_hash, i), data)
+            pixel_hash.update(data)
+    except BaseException:
+        staging.discard()
+        raise
+    with metrics_utils.stage('write'):
+        staging.commit()
+    metadata['pixel_hash'] = pixel_hash.hexdigest()
+
+    return metadata
+
+def iter_frames(ds, threads=1):
+    """
+    Decode the frames of a DICOM file one at a time, in frame order.
+    Native (uncompressed) pixel data is memory-mapped from the file and encapsulated pixel data is decoded frame by
+    frame, so only one decoded frame is held in memory. Other pixel data formats fall back to ds.pixel_array.
+    :param ds: pydicom Dataset. Read with a defer_size, so that dcmread did not load the pixel data
+    :param threads: int. Number of threads used to decode encapsulated frames. With more than one thread, frames are
+    decoded ahead in a thread pool and up to 2 * threads decoded frames are held in memory
+    :return: generator of 2D numpy arrays. Single-frame files yield one frame
+    """
+    num_frames = getattr(ds, 'NumberOfFrames', None)
+    if num_frames is None:
+        num_frames = ''
+    if ds.file_meta.TransferSyntaxUID.is_compressed:
+        # Split the encapsulated pixel data first, so that inconsistent files fail before any frame is written
+        frames = encapsulated_frames(ds)
+        if threads <= 1 or len(frames) <= 1:
+            for frame in frames:
+                yield decode_frame(ds, frame)
+            return
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            pending = collections.deque()
+            for frame in frames:
+                pending.append(executor.submit(decode_frame, ds, frame))
+                if len(pending) >= 2 * threads:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        return
+
+    pxl_array = native_pixel_array(ds)
+    if pxl_array is not None:
+        for i in range(pxl_array.shape[0]):
+            yield np.asarray(pxl_array[i])
+        return
+
     pxl_array = ds.pixel_array
-    pxl_dict = dict()
-    num_frames = metadata['NumberOfFrames']
-    # If the manufacturer is not Hologic or GE, apply pydicom windowing. 
-    manufacturer = map_manufacturer(str(metadata['Manufacturer']))
-    if manufacturer.lower() not in ['ge', 'hologic']:
-        pxl_array = pydicom.pixel_data_handlers.apply_voi_lut(pxl_array, ds)
-    if num_frames is '':
-        pxl_dict[0] = pxl_array
+    if num_frames == '':
+        yield pxl_array
     else:
         assert pxl_array.shape[0] == num_frames, \
             f"The NumberOfFrames dicom metadata field ({num_frames}) and the pixel data shape ({pxl_array.shape})" \
             " are inconsistent"
         for i in range(int(num_frames)):
-            pxl_dict[i] = pxl_array[i]
+            yield pxl_array[i]
+
+def read_frame(ds, index):
+    """
+    Decode a single frame of a DICOM file, without decoding the other frames (see iter_frames)
+    :param ds: pydicom Dataset. Read with a defer_size, so that dcmread did not load the pixel data
+    :param index: int. Frame index
+    :return: 2D numpy array
+    """
+    return next(read_frames(ds, [index]))
+
+def read_frames(ds, indices):
+    """
+    Decode some frames of a DICOM file in a single pass over its pixel data, without decoding the other frames
+    :param ds: pydicom Dataset. Read with a defer_size, so that dcmread did not load the pixel data
+    :param indices: list of int. Frame indices
+    :return: generator of 2D numpy arrays, in increasing frame index order
+    """
+    indices = sorted(set(indices))
+    if ds.file_meta.TransferSyntaxUID.is_compressed:
+        frames = pydicom.encaps.generate_pixel_data_frame(ds.PixelData, count_frames(ds))
+        # The encapsulated frames are only split (not decoded) until the last requested one
+        frames = itertools.islice(frames, indices[-1] + 1)
+        decoded = 0
+        for i, frame in enumerate(frames):
+            if i == indices[decoded]:
+                yield decode_frame(ds, frame)
+                decoded += 1
+        if decoded < len(indices):
+            raise IndexError(f"Frame {indices[decoded]} not found in the encapsulated pixel data")
+        return
+
+    pxl_array = native_pixel_array(ds)
+    if pxl_array is None:
+        pxl_array = ds.pixel_array
+        if pxl_array.ndim == 2:
+            # Single frame
+            pxl_array = pxl_array[np.newaxis]
+    for index in indices:
+        yield np.asarray(pxl_array[index])
 
-    # Save dictionary of frames to numpys
-    dicom_preprocess_dest = os.path.join(preprocess_dir, study_path_hash, dcm_path_hash)
-    os.makedirs(dicom_preprocess_dest, exist_ok=True)
-    for i, frame in pxl_dict.items():
-        path_ = os.path.join(dicom_preprocess_dest, 'frame_{}.npy'.format(i))
-        np.save(path_, frame)
+def count_frames(ds):
+    """
+    Number of frames of a DICOM file, without decoding the pixel data. If NumberOfFrames is missing, the frames of
+    encapsulated pixel data are counted from the frame table (Basic Offset Table, or its fragments if it is empty)
+    :param ds: pydicom Dataset
+    :return: int
+    """
+    num_frames = getattr(ds, 'NumberOfFrames', None)
+    if num_frames:
+        return int(num_frames)
+    if not ds.file_meta.TransferSyntaxUID.is_compressed:
+        return 1
+    fp = pydicom.filebase.DicomBytesIO(ds.PixelData)
+    fp.is_little_endian = True
+    has_bot, offsets = pydicom.encaps.get_frame_offsets(fp)
+    if has_bot:
+        return len(offsets)
+    # Without a Basic Offset Table, assume one fragment per frame
+    return pydicom.encaps.get_nr_fragments(fp)
 
+def encapsulated_frames(ds):
+    """
+    Split encapsulated pixel data into frames (still encoded)
+    :param ds: pydicom Dataset
+    :return: list of bytes. One item per frame
+    """
+    num_frames = getattr(ds, 'NumberOfFrames', None)
+    if num_frames is None:
+        num_frames = ''
+    frames = list(pydicom.encaps.generate_pixel_data_frame(ds.PixelData, int(num_frames or 1)))
+    assert len(frames) == int(num_frames or 1), \
+        f"The NumberOfFrames dicom metadata field ({num_frames}) and the number of encapsulated frames " \
+        f"({len(frames)}) are inconsistent"
+    return frames
+
+def native_pixel_array(ds):
+    """
+    Native little endian unsigned pixel data, memory-mapped from the file when the value was deferred by dcmread.
+    Frames are only read from the file when they are accessed
+    :param ds: pydicom Dataset
+    :return: 3D numpy array (frames, rows, columns), or None if the pixel data is not in a supported native format
+    """
+    if ds.file_meta.TransferSyntaxUID not in (pydicom.uid.ExplicitVRLittleEndian, pydicom.uid.ImplicitVRLittleEndian) \
+            or ds.get('SamplesPerPixel', 1) != 1 or ds.get('PixelRepresentation') != 0 \
+            or ds.get('BitsAllocated') not in (8, 16):
+        return None
+    dtype = np.dtype('<u{}'.format(ds.BitsAllocated // 8))
+    shape = (int(getattr(ds, 'NumberOfFrames', None) or 1), ds.Rows, ds.Columns)
+    # Raw element: if the value was deferred, it holds the position of the pixel data in the file
+    raw = dict(ds.items())[pydicom.tag.Tag('PixelData')]
+    length = raw.length if raw.value is None else len(raw.value)
+    if length < int(np.prod(shape)) * dtype.itemsize:
+        raise ValueError(f"The length of the pixel data ({length} bytes) doesn't match the expected "
+                         f"length for {shape} pixels of {ds.BitsAllocated} bits")
+    if raw.value is not None:
+        return np.frombuffer(raw.value, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+    if getattr(raw, 'value_tell', None) is not None:
+        return np.memmap(ds.filename, dtype=dtype, mode='r', offset=raw.value_tell, shape=shape)
+    return None
+
+def decode_frame(ds, frame):
+    """
+    Decode one frame of encapsulated pixel data
+    :param ds: pydicom Dataset. Dataset the frame belongs to
+    :param frame: bytes. Encapsulated frame, as returned by pydicom.encaps.generate_pixel_data_frame
+    :return: 2D numpy array
+    """
+    # Single-frame dataset with the attributes needed by the pixel data handlers
+    frame_ds = pydicom.Dataset()
+    frame_ds.file_meta = ds.file_meta
+    frame_ds.is_little_endian = ds.is_little_endian
+    frame_ds.is_implicit_VR = ds.is_implicit_VR
+    for keyword in ('SamplesPerPixel', 'PhotometricInterpretation', 'PlanarConfiguration', 'Rows', 'Columns',
+                    'BitsAllocated', 'BitsStored', 'HighBit', 'PixelRepresentation'):
+        if keyword in ds:
+            setattr(frame_ds, keyword, ds[keyword].value)
+    frame_ds.PixelData = pydicom.encaps.encapsulate([frame])
+    return frame_ds.pixel_array
+
+def read_dicom_job(dicom_path, writer, study_path_hash, cache=None, frame_threads=1, windowing='pydicom'):
+    """
+    Read a DICOM file with read_dicom, going through the preprocessing cache if there is one
+    :param dicom_path: str. Path to the DICOM file
+    :param writer: Writer the preprocessed files are written to (see archive_utils). If None, the preprocessed files
+    are returned instead, which is used to read files in worker processes when the writer lives in the main process
+    :param study_path_hash: str. Hash of the study path
+    :param cache: cache_utils.PreprocessCache. Preprocessing cache (optional)
+    :param frame_threads: int. Number of threads used to decode the frames of multi-frame files
+    :param windowing: str. Windowing engine: 'pydicom' (float64 output) or 'lut' (integer output)
+    :return: 3-tuple: metadata dict, list of (arcname, data) tuples (None if a writer was given), bool cache hit
+    """
+    members = None
+    if writer is None:
+        writer = members = archive_utils.MemberBuffer()
+    # Preprocessing time of each file, including the cache lookup
+    with metrics_utils.stage('read_dicom', bytes_in=os.path.getsize(dicom_path), latency=True):
+        if cache is None:
+            return read_dicom(dicom_path, writer, study_path_hash, frame_threads, windowing), members, False
+
+        with metrics_utils.stage('cache_load'):
+            metadata = cache.load(dicom_path, study_path_hash, writer)
+        if metadata is not None:
+            return metadata, members, True
+        entry = cache.create_entry(dicom_path, study_path_hash)
+        try:
+            entry_writer = archive_utils.TeeWriter([writer, entry])
+            metadata = read_dicom(dicom_path, entry_writer, study_path_hash, frame_threads, windowing)
+        except Exception:
+            entry.discard()
+            raise
+        entry.commit(metadata)
+        return metadata, members, False
+
+def finish_dicom_job(result, writer, cache=None):
+    """
+    Write the preprocessed files returned by read_dicom_job (if any) and update the cache statistics
+    :param result: 3-tuple returned by read_dicom_job
+    :param writer: Writer the preprocessed files are written to (see archive_utils)
+    :param cache: cache_utils.PreprocessCache. Preprocessing cache (optional)
+    :return: dict. DICOM metadata
+    """
+    metadata, members, cache_hit = result
+    if members is not None:
+        for arcname, data in members:
+            writer.write(arcname, data)
+    if cache is not None:
+        cache.record(cache_hit)
     return metadata
 
-def read_study(study_path, preprocess_dir, only_include=None):
+def frame_to_bytes(frame):
+    """
+    Serialize a frame in .npy format (same content np.save writes to a file)
+    :param frame: numpy array
+    :return: bytes
+    """
+    buffer = io.BytesIO()
+    np.save(buffer, frame)
+    return buffer.getvalue()
+
+def read_study(study_path, writer, only_include=None, dicom_paths=None, cache=None, frame_threads=1,
+               windowing='pydicom'):
     # Hash study_path in case it has PHI
     study_path_hash = create_hash(study_path)
     study_metadata = []
+    if dicom_paths is None:
+        dicom_paths = validate_study(study_path, only_include)
 
     # Iterate through and read each dicom
-    for dicom in os.listdir(study_path):
-        dicom_path = os.path.join(study_path, dicom)
-
-        if only_include is not None and dicom_path != only_include:
-            continue
+    for dicom_path in dicom_paths:
         try:
-            dicom_metadata = read_dicom(dicom_path, preprocess_dir, study_path_hash)
+            result = read_dicom_job(dicom_path, writer, study_path_hash, cache, frame_threads, windowing)
+            dicom_metadata = finish_dicom_job(result, writer, cache)
         except Exception as ex:
             print("File {} could not be processed correctly as a DICOM file ({}) (skipped)".format(dicom_path, ex))
             continue
         study_metadata.append(dicom_metadata)
 
+    return save_study_metadata(study_path, writer, study_metadata)
+
+def validate_study(study_path, only_include=None, candidates=None):
+    """
+    List the files of a study folder that can be sent to the server, reading only their headers.
+    Files that are not valid are reported and skipped, so that their pixel data is never decoded
+    :param study_path: str. Path to the study folder
+    :param only_include: str. If set, only this file path is checked (optional)
+    :param candidates: list of str. If set, only these file paths are checked instead of listing the folder
+    (e.g. the files found by discovery_utils.DicomIndex) (optional)
+    :return: list of str. Valid DICOM file paths, in directory listing order
+    """
+    dicom_paths = []
+    if candidates is None:
+        candidates = [os.path.join(study_path, dicom) for dicom in os.listdir(study_path)]
+    with metrics_utils.stage('scan'):
+        for dicom_path in candidates:
+            if only_include is not None and dicom_path != only_include:
+                continue
+            try:
+                validate_dicom(dicom_path)
+            except Exception as ex:
+                print("File {} could not be processed correctly as a DICOM file ({}) (skipped)".format(dicom_path, ex))
+                continue
+            dicom_paths.append(dicom_path)
+    return dicom_paths
+
+def save_study_metadata(study_path, writer, study_metadata):
+    """
+    Save the metadata of all the DICOM files of a study as study_metadata.pkl
+    :param study_path: str. Path to the study folder
+    :param writer: Writer the preprocessed files are written to (see archive_utils)
+    :param study_metadata: list of dict. Metadata returned by read_dicom for each file
+    :return: DataFrame. Study metadata, with the pixel hash of each file (not sent to the server)
+    """
+    study_path_hash = create_hash(study_path)
     # Convert study_metadata into a Pandas DataFrame
     study_metadata = pd.DataFrame.from_dict(study_metadata, orient='columns')
 
-    # Save study_metadata in preprocessed_dir
-    study_preprocess_dest = os.path.join(preprocess_dir, study_path_hash)
-    os.makedirs(study_preprocess_dest, exist_ok=True)
-    study_metadata.to_pickle(os.path.join(study_preprocess_dest, 'study_metadata.pkl'))
+    # Save study_metadata in preprocessed_dir (same content as DataFrame.to_pickle)
+    writer.write('{}/study_metadata.pkl'.format(study_path_hash),
+                 pickle.dumps(study_metadata.drop(columns=['pixel_hash'], errors='ignore'),
+                              protocol=pickle.HIGHEST_PROTOCOL))
     return study_metadata
+
+def submit_study(study_path, writer, executor, dicom_paths, cache=None, frame_threads=1, windowing='pydicom'):
+    """
+    Submit a read_dicom job for each file of a study to a process pool
+    :param study_path: str. Path to the study folder
+    :param writer: Writer the preprocessed files are written to (see archive_utils)
+    :param executor: concurrent.futures.Executor. Pool the files are read in
+    :param dicom_paths: list of str. Files to read, as returned by validate_study
+    :param cache: cache_utils.PreprocessCache. Preprocessing cache (optional)
+    :param frame_threads: int. Number of threads used to decode the frames of multi-frame files
+    :param windowing: str. Windowing engine: 'pydicom' (float64 output) or 'lut' (integer output)
+    :return: list of (str, Future) tuples. File path and pending job for each file, in read_study order
+    """
+    study_path_hash = create_hash(study_path)
+    # If the writer cannot be shared with the workers, the files are sent back and written by collect_study
+    job_writer = writer if writer.process_safe else None
+    return [(dicom_path, metrics_utils.submit(executor, read_dicom_job, dicom_path, job_writer, study_path_hash, cache,
+                                              frame_threads, windowing))
+            for dicom_path in dicom_paths]
+
+def collect_study(study_path, writer, jobs, cache=None):
+    """
+    Wait for the jobs created by submit_study and save the study metadata, same as read_study does
+    :param study_path: str. Path to the study folder
+    :param writer: Writer the preprocessed files are written to (see archive_utils)
+    :param jobs: list of (str, Future) tuples returned by submit_study
+    :param cache: cache_utils.PreprocessCache. Preprocessing cache (optional)
+    :return: DataFrame. Study metadata
+    """
+    study_metadata = []
+    for dicom_path, job in jobs:
+        try:
+            dicom_metadata = finish_dicom_job(metrics_utils.job_result(job), writer, cache)
+        except Exception as ex:
+            print("File {} could not be processed correctly as a DICOM file ({}) (skipped)".format(dicom_path, ex))
+            continue
+        study_metadata.append(dicom_metadata)
+
+    return save_study_metadata(study_path, writer, study_metadata)
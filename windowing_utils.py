@@ -0,0 +1,97 @@
+import functools
+
+import numpy as np
+import pydicom
+
+
+def apply_voi_lut(arr, ds):
+    """
+    Same as pydicom.pixel_data_handlers.apply_voi_lut, but windowing is applied with a lookup table and the result is
+    rounded to the smallest integer dtype that holds it (instead of float64).
+    The lookup table is computed once per window center/width/function, bit depth and dtype and is shared by all the
+    files with the same parameters. Cases without a lookup table (VOI LUT sequence, Modality LUT, non integer pixels)
+    use pydicom directly.
+    :param arr: numpy array. Pixel data
+    :param ds: pydicom Dataset. Dataset the pixel data belongs to
+    :return: numpy array. Windowed pixel data
+    """
+    params = window_params(ds, arr.dtype)
+    if params is None:
+        return pydicom.pixel_data_handlers.apply_voi_lut(arr, ds)
+    lut = window_lut(*params)
+    # The table is indexed by the unsigned bit pattern of the pixel values
+    return lut[arr.view('u{}'.format(arr.dtype.itemsize))]
+
+
+def window_params(ds, dtype):
+    """
+    Parameters of the windowing operation that pydicom would apply to the pixel data
+    :param ds: pydicom Dataset
+    :param dtype: numpy dtype. Pixel data dtype
+    :return: tuple with the window_lut arguments, or None if a lookup table cannot be used
+    """
+    if dtype.kind not in ('u', 'i') or dtype.itemsize > 2:
+        return None
+    if 'VOILUTSequence' in ds or 'ModalityLUTSequence' in ds:
+        return None
+    if ds.get('WindowCenter', None) is None or ds.get('WindowWidth', None) is None:
+        return None
+    if ds.get('PhotometricInterpretation', None) not in ('MONOCHROME1', 'MONOCHROME2'):
+        return None
+
+    def first_value(keyword):
+        elem = ds[keyword]
+        return float(elem.value[0] if elem.VM > 1 else elem.value)
+
+    slope = ds.get('RescaleSlope', None)
+    intercept = ds.get('RescaleIntercept', None)
+    if slope is None or intercept is None:
+        slope, intercept = None, None
+    else:
+        slope, intercept = float(slope), float(intercept)
+    return (first_value('WindowCenter'), first_value('WindowWidth'), str(ds.get('VOILUTFunction', 'LINEAR')),
+            int(ds.PixelRepresentation), int(ds.BitsStored), slope, intercept, dtype.str)
+
+
+@functools.lru_cache(maxsize=64)
+def window_lut(center, width, voi_function, pixel_representation, bits_stored, slope, intercept, dtype):
+    """
+    Lookup table with the windowed value of every possible pixel value
+    :param center: float. Window center
+    :param width: float. Window width
+    :param voi_function: str. VOI LUT function (LINEAR, LINEAR_EXACT or SIGMOID)
+    :param pixel_representation: int. 0 for unsigned pixel data, 1 for signed
+    :param bits_stored: int. Bits stored
+    :param slope: float. Rescale slope (None if not present)
+    :param intercept: float. Rescale intercept (None if not present)
+    :param dtype: str. Pixel data dtype
+    :return: numpy array with 2 ** (8 * itemsize) entries, indexed by the unsigned bit pattern of the pixel values
+    """
+    dtype = np.dtype(dtype)
+    unsigned = np.dtype('u{}'.format(dtype.itemsize))
+    domain = np.arange(2 ** (8 * dtype.itemsize), dtype=np.int64).astype(unsigned).view(dtype)
+
+    # Dataset with only the attributes used by pydicom's windowing, so the table matches it exactly
+    lut_ds = pydicom.Dataset()
+    lut_ds.PhotometricInterpretation = 'MONOCHROME2'
+    lut_ds.WindowCenter = center
+    lut_ds.WindowWidth = width
+    lut_ds.VOILUTFunction = voi_function
+    lut_ds.PixelRepresentation = pixel_representation
+    lut_ds.BitsStored = bits_stored
+    if slope is not None:
+        lut_ds.RescaleSlope = slope
+        lut_ds.RescaleIntercept = intercept
+    values = np.rint(pydicom.pixel_data_handlers.apply_voi_lut(domain, lut_ds)).astype(np.int64)
+    return values.astype(smallest_int_dtype(int(values.min()), int(values.max())))
+
+
+def smallest_int_dtype(min_value, max_value):
+    """
+    :return: numpy dtype. Smallest integer dtype that holds all the values in [min_value, max_value]
+    """
+    dtypes = (np.uint8, np.uint16, np.uint32) if min_value >= 0 else (np.int8, np.int16, np.int32)
+    for dtype in dtypes:
+        if np.iinfo(dtype).min <= min_value and max_value <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    return np.dtype(np.int64)